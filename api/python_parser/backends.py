@@ -0,0 +1,112 @@
+import json
+import math
+import time
+from generation import statistiche_token
+from metrics import metriche
+from rules import estrai_campi
+
+# Capacità dichiarate dai backend
+TESTO = "testo"  # trascrizione del testo della pagina
+JSON = "json"  # campi del tipo di documento in JSON (OCR_EXTRACTION_MODE=json, /ocr-nanonets/?modalita=json)
+BATCH = "batch"  # più immagini nella stessa chiamata
+ARRESTO_CAMPI = "arresto_campi"  # si ferma appena le regole trovano i campi richiesti
+LAYOUT = "layout"  # analisi del layout della pagina (livello pdf_extract_kit)
+
+
+class BackendOCR:
+    """Un motore OCR o di estrazione, intercambiabile nei ruoli "layout" e "ocr".
+
+    carica(model_config) restituisce le risorse (es. modello e processor) che il
+    registro dei modelli conserva, condivide e scarica; warmup(risorse) le riscalda.
+    elabora(risorse, immagini, limiti, file_type, modalita) restituisce un risultato
+    per immagine con almeno "text" (per l'OCR anche tokens, max_new_tokens e stop).
+    capacita è l'insieme delle funzioni supportate; costo riporta stime indicative
+    (secondi per pagina su CPU e GPU, memoria in MB) esposte su /health.
+    """
+
+    def __init__(self, nome: str, carica, elabora, warmup=None, capacita=(), costo=None):
+        self.nome = nome
+        self.carica = carica
+        self.elabora = elabora
+        self.warmup = warmup
+        self.capacita = frozenset(capacita)
+        self.costo = costo or {}
+
+    def supporta(self, capacita: str) -> bool:
+        return capacita in self.capacita
+
+    def descrivi(self) -> dict:
+        return {"capacita": sorted(self.capacita), "costo": self.costo}
+
+
+# Testo restituito dal backend finto: contiene i campi che le regole cercano per ogni tipo di documento
+TESTI_FINTI = {
+    "contratto": "\n".join([
+        "CONTRATTO DI FINANZIAMENTO CONTRO CESSIONE DEL QUINTO DELLA RETRIBUZIONE",
+        "COGNOME: ROSSI NOME: MARIO, CF RSSMRA80A01H501U",
+        "nato a Roma il 01/01/1980, residente in Roma",
+        "COSTI TOTALI: 1.234,56",
+        "DURATA: 120 MESI",
+        "Il finanziamento viene rimborsato mediante cessione delle quote della retribuzione.",
+    ]),
+    "conteggio": "\n".join([
+        "CONTEGGIO ESTINTIVO",
+        "RATE SCADUTE: 48 MESI",
+        "DATA ELABORAZIONE CONTEGGIO ESTINTIVO 15/03/2024",
+        "Il presente conteggio è valido fino alla data indicata.",
+    ]),
+}
+TESTI_FINTI[None] = TESTI_FINTI["contratto"]
+
+CARATTERI_PER_TOKEN = 4
+
+
+def backend_finto(latenza_ms: int = 200, ms_per_token: float = 0.0, secondi_caricamento: float = 0.0,
+                  file_testo: str = None) -> BackendOCR:
+    """Backend deterministico: restituisce sempre lo stesso testo dopo una latenza simulata.
+
+    La latenza di una chiamata è latenza_ms per immagine più ms_per_token per ogni
+    passo di generazione della riga più lunga, come in una generate su un batch.
+    Il testo è quello di file_testo o, se assente, un testo con i campi del tipo di
+    documento, così la cascata si completa. Non richiede modelli né GPU.
+    """
+    def carica(model_config=None):
+        time.sleep(secondi_caricamento)
+        if file_testo:
+            with open(file_testo, encoding="utf-8") as f:
+                testo = f.read()
+            return {file_type: testo for file_type in TESTI_FINTI}
+        return dict(TESTI_FINTI)
+
+    def elabora(testi, immagini, limiti=None, file_type=None, modalita="testo"):
+        limiti = limiti if isinstance(limiti, (list, tuple)) else [limiti] * len(immagini)
+        risultati = []
+        for limite in limiti:
+            testo = testi.get(file_type, testi[None])
+            campi = None
+            if modalita == "json":
+                campi = estrai_campi(file_type or "contratto", testo)
+                testo = json.dumps(campi, ensure_ascii=False)
+            token = math.ceil(len(testo) / CARATTERI_PER_TOKEN) + 1
+            motivo = "eos"
+            if limite and token > limite:
+                testo, token, motivo = testo[:limite * CARATTERI_PER_TOKEN], limite, "limite"
+            risultato = {"text": testo, "tokens": token, "max_new_tokens": limite, "stop": motivo}
+            if campi is not None:
+                risultato["campi"] = campi
+            risultati.append(risultato)
+        with metriche.fase("finto", modalita=modalita):
+            passi = max(risultato["tokens"] for risultato in risultati) if risultati else 0
+            time.sleep((latenza_ms * len(immagini) + ms_per_token * passi) / 1000)
+        for risultato in risultati:
+            statistiche_token.registra(risultato["tokens"], risultato["max_new_tokens"] or risultato["tokens"],
+                                       risultato["stop"])
+        metriche.incrementa("ocr_generated_tokens_total", sum(risultato["tokens"] for risultato in risultati))
+        metriche.incrementa("ocr_pages_total", len(risultati))
+        return risultati
+
+    return BackendOCR(
+        "finto", carica, elabora,
+        capacita=(TESTO, JSON, BATCH, LAYOUT),
+        costo={"secondi_pagina_cpu": latenza_ms / 1000, "secondi_pagina_gpu": latenza_ms / 1000, "memoria_mb": 0}
+    )
@@ -0,0 +1,148 @@
+import asyncio
+from collections import Counter
+
+
+class MicroBatcherOCR:
+    """Raccoglie le pagine di richieste OCR concorrenti in micro-batch.
+
+    Ogni richiesta mette una pagina in coda e attende il proprio risultato. Il
+    ciclo di raccolta prende la prima pagina in attesa, aspetta che il modello
+    abbia uno slot libero e aggiunge le pagine arrivate nel frattempo, fino a
+    max_batch_size pagine o max_wait_ms millisecondi. Il batch viene elaborato
+    con una sola forward pass e ogni risultato torna alla richiesta che lo attende.
+    Ogni pagina mantiene il proprio limite di token; le pagine con criteri di
+    arresto diversi (tipo di documento) finiscono in batch separati.
+    """
+
+    def __init__(self, esegui, enabled: bool, max_batch_size: int, max_wait_ms: int, slots: int = 1, limite_batch=None):
+        # esegui(immagini, limiti, file_type) è una coroutine che restituisce un risultato per immagine
+        self.esegui = esegui
+        self.enabled = enabled
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.slots = max(1, slots)
+        # Limite dinamico (es. in base alla memoria libera) oltre a max_batch_size
+        self.limite_batch = limite_batch
+        self._loop = None
+        self._coda = None
+        self._slot = None
+        self._ciclo_task = None
+        self._istogramma = Counter()
+        self._pagine = 0
+        self._errori = 0
+
+    def _avvia(self):
+        """Crea coda e ciclo di raccolta nell'event loop corrente"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._ciclo_task is not None and not self._ciclo_task.done():
+            return
+        self._loop = loop
+        self._coda = asyncio.Queue()
+        self._slot = asyncio.Semaphore(self.slots)
+        self._ciclo_task = loop.create_task(self._ciclo())
+
+    async def ocr(self, image, max_new_tokens: int, file_type: str = None) -> dict:
+        """Mette in coda una pagina e ne restituisce il risultato"""
+        if not self.enabled:
+            self._registra(1)
+            return (await self.esegui([image], [max_new_tokens], file_type))[0]
+        self._avvia()
+        future = self._loop.create_future()
+        self._coda.put_nowait((image, max_new_tokens, file_type, future))
+        return await future
+
+    async def ocr_pagine(self, images, max_new_tokens, file_type: str = None) -> list:
+        """Mette in coda più pagine insieme: possono condividere il batch con altre richieste.
+
+        max_new_tokens è un limite unico o una lista con un limite per pagina.
+        """
+        limiti = max_new_tokens if isinstance(max_new_tokens, (list, tuple)) else [max_new_tokens] * len(images)
+        return list(await asyncio.gather(*(
+            self.ocr(image, limite, file_type) for image, limite in zip(images, limiti)
+        )))
+
+    def _dimensione_massima(self) -> int:
+        if self.limite_batch is None:
+            return self.max_batch_size
+        return max(1, min(self.max_batch_size, self.limite_batch(self.max_batch_size)))
+
+    async def _ciclo(self):
+        while True:
+            batch = [await self._coda.get()]
+            # Mentre il modello è occupato le richieste si accumulano in coda
+            await self._slot.acquire()
+            try:
+                dimensione = self._dimensione_massima()
+                while len(batch) < dimensione and not self._coda.empty():
+                    batch.append(self._coda.get_nowait())
+                scadenza = self._loop.time() + self.max_wait
+                while len(batch) < dimensione:
+                    attesa = scadenza - self._loop.time()
+                    if attesa <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._coda.get(), attesa))
+                    except asyncio.TimeoutError:
+                        break
+            except BaseException:
+                self._slot.release()
+                for *_, future in batch:
+                    if not future.done():
+                        future.cancel()
+                raise
+
+            # Le richieste annullate (client disconnesso) non occupano il batch
+            batch = [voce for voce in batch if not voce[3].done()]
+            gruppi = {}
+            for voce in batch:
+                gruppi.setdefault(voce[2], []).append(voce)
+            if not gruppi:
+                self._slot.release()
+                continue
+            self._loop.create_task(self._elabora(list(gruppi.items())))
+
+    async def _elabora(self, gruppi):
+        """Elabora i gruppi del batch e consegna i risultati (rilascia lo slot alla fine)"""
+        try:
+            for file_type, voci in gruppi:
+                self._registra(len(voci))
+                try:
+                    risultati = await self.esegui(
+                        [image for image, *_ in voci], [limite for _, limite, *_ in voci], file_type
+                    )
+                except Exception as e:
+                    self._errori += 1
+                    for *_, future in voci:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (*_, future), risultato in zip(voci, risultati):
+                    if not future.done():
+                        future.set_result(risultato)
+        finally:
+            self._slot.release()
+
+    def _registra(self, dimensione: int):
+        self._istogramma[dimensione] += 1
+        self._pagine += dimensione
+
+    def stats(self) -> dict:
+        """Istogramma delle dimensioni dei batch eseguiti"""
+        batch = sum(self._istogramma.values())
+        return {
+            "enabled": self.enabled,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": round(self.max_wait * 1000),
+            "queued": self._coda.qsize() if self._coda is not None else 0,
+            "batches": batch,
+            "pages": self._pagine,
+            "failed_batches": self._errori,
+            "avg_batch_size": round(self._pagine / batch, 2) if batch else 0,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self._istogramma.items())},
+        }
+
+    def chiudi(self):
+        """Ferma il ciclo di raccolta"""
+        if self._ciclo_task is not None:
+            self._ciclo_task.cancel()
+            self._ciclo_task = None
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline delle fasi della pipeline su un corpus sintetico (benchmarks/corpus.py).
+
+Per ogni documento del corpus (pagine diverse, con e senza strato di testo)
+cronometra separatamente:
+- testo_pdf: apertura del PDF ed estrazione dello strato di testo di tutte le pagine
+- convert_pdf_to_images: rendering di tutte le pagine alla risoluzione indicata
+- regex: extract_contract_data_from_results / extract_statement_data_from_results
+  sul testo completo del documento (quello che restituirebbe l'OCR)
+- cascata: _estrai_dati_contratto / _estrai_dati_conteggio senza modelli caricati
+- ocr_stub: ocr_batch_nanonets con un modello finto che "genera" il testo della pagina
+  un token (carattere) alla volta: misura tutto ciò che circonda il modello (chat
+  template, criterio di arresto, decodifica, statistiche), non l'inferenza; con
+  OCR_FIELD_STOP la generazione si ferma ai campi richiesti e quelli facoltativi
+  (es. data_chiusura) possono mancare
+e per ogni coppia esegui_calcoli e crea_pdf_diffida.
+
+Ogni fase è ripetuta: il JSON riporta minimo, mediana e media per chiamata, più
+l'accuratezza dei campi estratti. Con --confronta si stampano le differenze
+rispetto a un'esecuzione precedente.
+
+Uso: python benchmarks/bench_pipeline.py [--pagine 1,5,20] [--ripetizioni 3] [--dpi 300]
+                                         [--ms-per-token 0] [--output bench_pipeline.json]
+                                         [--confronta precedente.json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Nessun file della coda lavori nella cartella corrente, nessuna cache tra le ripetizioni
+_cartella_lavori = tempfile.mkdtemp(prefix="bench_pipeline_")
+os.environ.setdefault("JOBS_DB", os.path.join(_cartella_lavori, "lavori.sqlite3"))
+os.environ.setdefault("JOBS_DIR", os.path.join(_cartella_lavori, "file"))
+os.environ.setdefault("CACHE_ENABLED", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import torch
+
+from corpus import genera_corpus
+
+PAD, EOS, PROMPT = 0, 1, 2
+RISOLUZIONE_OCR = 72  # il modello finto non guarda i pixel: basta un'immagine piccola
+
+
+class TokenizerStub:
+    """Un token per carattere: decode restituisce il testo senza padding e fine sequenza"""
+
+    pad_token_id = PAD
+    eos_token_id = EOS
+
+    def decode(self, ids, skip_special_tokens=True, **kwargs):
+        return "".join(chr(i) for i in ids.tolist() if i > PROMPT)
+
+
+class Ingressi(dict):
+    """Come il BatchFeature del processor: si espande in generate e si sposta sul dispositivo"""
+
+    def to(self, device):
+        return self
+
+    @property
+    def input_ids(self):
+        return self["input_ids"]
+
+
+class ProcessorStub:
+    """Processor finto: il testo da "generare" per ogni immagine è in image.info["testo_ocr"]"""
+
+    def __init__(self, lunghezza_prompt: int = 64):
+        self.tokenizer = TokenizerStub()
+        self.lunghezza_prompt = lunghezza_prompt
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        return messages[-1]["content"][-1]["text"]
+
+    def __call__(self, text, images, padding=True, return_tensors="pt"):
+        return Ingressi(
+            input_ids=torch.full((len(images), self.lunghezza_prompt), PROMPT),
+            testi=[immagine.info.get("testo_ocr", "") for immagine in images],
+        )
+
+    def batch_decode(self, ids, skip_special_tokens=True, clean_up_tokenization_spaces=True):
+        return [self.tokenizer.decode(riga) for riga in ids]
+
+
+class ModelloStub:
+    """generate finto: un passo per token con il criterio di arresto vero, più una latenza simulata"""
+
+    device = torch.device("cpu")
+
+    def __init__(self, secondi_per_token: float = 0.0):
+        self.secondi_per_token = secondi_per_token
+
+    def generate(self, input_ids, testi, max_new_tokens, stopping_criteria=None, **kwargs):
+        righe, lunghezza = input_ids.shape
+        bersaglio = torch.full((righe, max_new_tokens), PAD)
+        fine = []
+        for riga, testo in enumerate(testi):
+            ids = ([ord(carattere) for carattere in testo] + [EOS])[:max_new_tokens]
+            bersaglio[riga, :len(ids)] = torch.tensor(ids)
+            fine.append(len(ids))
+        output = torch.cat([input_ids, bersaglio], dim=1)
+        passo = 0
+        while passo < max(fine):
+            passo += 1
+            if self.secondi_per_token:
+                time.sleep(self.secondi_per_token)
+            if stopping_criteria is not None:
+                fermi = stopping_criteria(output[:, :lunghezza + passo], None)
+                fine = [min(f, passo) if bool(fermo) else f for f, fermo in zip(fine, fermi)]
+        for riga, f in enumerate(fine):
+            output[riga, lunghezza + f:] = PAD
+        return output[:, :lunghezza + passo]
+
+
+def cronometra(funzione, ripetizioni: int, minimo_s: float = 0.02) -> dict:
+    """Tempo per chiamata: le funzioni brevi vengono ripetute in ciclo fino a minimo_s per campione"""
+    inizio = time.perf_counter()
+    risultato = funzione()
+    durata = time.perf_counter() - inizio
+    ciclo = max(1, int(minimo_s / durata)) if durata > 0 else 1000
+    campioni = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        for _ in range(ciclo):
+            funzione()
+        campioni.append((time.perf_counter() - inizio) / ciclo)
+    return {
+        "min_ms": round(min(campioni) * 1000, 4),
+        "mediana_ms": round(statistics.median(campioni) * 1000, 4),
+        "media_ms": round(statistics.mean(campioni) * 1000, 4),
+        "chiamate": ciclo * ripetizioni,
+    }, risultato
+
+
+def accuratezza(estratti: dict, attesi: dict) -> float:
+    """Frazione dei campi attesi estratti con il valore giusto"""
+    return round(sum(estratti.get(campo) == valore for campo, valore in attesi.items()) / len(attesi), 3)
+
+
+def immagini_ocr(documento, testi):
+    """Pagine a bassa risoluzione con il testo che il modello finto deve restituire"""
+    immagini = []
+    for indice, testo in enumerate(testi):
+        immagine = documento.immagine_pagina(indice, resolution=RISOLUZIONE_OCR)
+        immagine.info["testo_ocr"] = testo
+        immagini.append(immagine)
+    return immagini
+
+
+def misura_documento(index, dati, parametri, modello, processor) -> list:
+    from document import DocumentoPDF
+
+    file_type = dati["file_type"]
+    estrai_regex = (index.extract_contract_data_from_results if file_type == "contratto"
+                    else index.extract_statement_data_from_results)
+    estrai_cascata = index._estrai_dati_contratto if file_type == "contratto" else index._estrai_dati_conteggio
+    testo_completo = "\n".join(dati["testi"])
+    risultati = []
+
+    def testo_pdf():
+        with DocumentoPDF(dati["contenuto"]) as documento:
+            return "".join(documento.testo_pagina(i) for i in range(documento.num_pagine))
+
+    def converti():
+        with DocumentoPDF(dati["contenuto"]) as documento:
+            for _ in index.convert_pdf_to_images(documento, None, resolution=parametri.dpi):
+                pass
+
+    def cascata():
+        with DocumentoPDF(dati["contenuto"]) as documento:
+            return estrai_cascata(documento)
+
+    fasi = [
+        ("testo_pdf", testo_pdf, None),
+        ("convert_pdf_to_images", converti, None),
+        ("regex", lambda: estrai_regex({"text": testo_completo}, {}), dati["attesi"]),
+        ("cascata", cascata, dati["attesi"] if dati["strato_testo"] else None),
+    ]
+    for fase, funzione, attesi in fasi:
+        tempi, risultato = cronometra(funzione, parametri.ripetizioni)
+        voce = {"fase": fase, **tempi}
+        if attesi is not None:
+            voce["accuratezza"] = accuratezza(risultato, attesi)
+        risultati.append(voce)
+
+    with DocumentoPDF(dati["contenuto"]) as documento:
+        immagini = immagini_ocr(documento, dati["testi"])
+
+    def ocr_stub():
+        testi = []
+        for inizio in range(0, len(immagini), parametri.batch):
+            testi.extend(r["text"] for r in index.ocr_batch_nanonets(
+                modello, processor, immagini[inizio:inizio + parametri.batch], 4096, file_type
+            ))
+        return testi
+
+    tempi, testi = cronometra(ocr_stub, parametri.ripetizioni)
+    risultati.append({"fase": "ocr_stub", **tempi, "token": sum(len(testo) + 1 for testo in testi),
+                      "accuratezza": accuratezza(index.estrai_campi(file_type, "\n".join(testi)), dati["attesi"])})
+    return risultati
+
+
+def misura_coppia(index, coppia, parametri) -> list:
+    dati_contratto, dati_conteggio = coppia["contratto"]["attesi"], coppia["conteggio"]["attesi"]
+    risultati = []
+    tempi, calcoli = cronometra(lambda: index.esegui_calcoli(dati_contratto, dati_conteggio), parametri.ripetizioni)
+    risultati.append({"fase": "esegui_calcoli", **tempi})
+    tempi, pdf = cronometra(lambda: index.crea_pdf_diffida(dati_contratto, dati_conteggio, calcoli), parametri.ripetizioni)
+    risultati.append({"fase": "crea_pdf_diffida", **tempi, "bytes": len(pdf)})
+    return risultati
+
+
+def commit_corrente():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def confronta(risultati: dict, percorso: str):
+    """Stampa la mediana di ogni fase rispetto all'esecuzione salvata in percorso"""
+    with open(percorso, encoding="utf-8") as f:
+        precedente = {(r["documento"], r["fase"]): r for r in json.load(f)["risultati"]}
+    print(f"\n📈 Confronto con {percorso}")
+    print(f"{'documento':<32} {'fase':<22} {'prima ms':>10} {'ora ms':>10} {'variazione':>11}")
+    for r in risultati["risultati"]:
+        vecchio = precedente.get((r["documento"], r["fase"]))
+        if vecchio is None:
+            continue
+        variazione = (r["mediana_ms"] / vecchio["mediana_ms"] - 1) * 100 if vecchio["mediana_ms"] else 0
+        print(f"{r['documento']:<32} {r['fase']:<22} {vecchio['mediana_ms']:>10.2f} {r['mediana_ms']:>10.2f} "
+              f"{variazione:>+10.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline delle fasi della pipeline")
+    parser.add_argument("--pagine", default="1,5,20", help="pagine dei documenti del corpus, es. 1,5,20")
+    parser.add_argument("--ripetizioni", type=int, default=3)
+    parser.add_argument("--dpi", type=int, default=300, help="risoluzione di convert_pdf_to_images")
+    parser.add_argument("--batch", type=int, default=4, help="pagine per batch del modello finto")
+    parser.add_argument("--ms-per-token", type=float, default=0.0, help="latenza simulata del modello finto")
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--confronta", help="JSON di un'esecuzione precedente")
+    parametri = parser.parse_args()
+
+    import index
+
+    inizio = time.perf_counter()
+    corpus = genera_corpus([int(p) for p in parametri.pagine.split(",")])
+    secondi_corpus = time.perf_counter() - inizio
+    modello, processor = ModelloStub(parametri.ms_per_token / 1000), ProcessorStub()
+
+    print(f"📊 Benchmark pipeline: {len(corpus)} coppie, {parametri.ripetizioni} ripetizioni, {parametri.dpi} dpi")
+    print(f"{'documento':<32} {'fase':<22} {'mediana ms':>11} {'min ms':>9} {'accuratezza':>12}")
+    risultati = []
+    for coppia in corpus:
+        misure = []
+        for ruolo in ("contratto", "conteggio"):
+            dati = coppia[ruolo]
+            documento = f"{coppia['id']}/{ruolo}"
+            for voce in misura_documento(index, dati, parametri, modello, processor):
+                misure.append({"documento": documento, "file_type": ruolo, "pagine": dati["pagine"],
+                               "strato_testo": dati["strato_testo"], **voce})
+        for voce in misura_coppia(index, coppia, parametri):
+            misure.append({"documento": coppia["id"], "pagine": coppia["contratto"]["pagine"],
+                           "strato_testo": coppia["contratto"]["strato_testo"], **voce})
+        for r in misure:
+            print(f"{r['documento']:<32} {r['fase']:<22} {r['mediana_ms']:>11.3f} {r['min_ms']:>9.3f} "
+                  f"{r.get('accuratezza', ''):>12}")
+        risultati.extend(misure)
+
+    output = {
+        "meta": {
+            "data": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": commit_corrente(),
+            "python": platform.python_version(),
+            "piattaforma": platform.platform(),
+            "cpu": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "parametri": vars(parametri),
+            "corpus_s": round(secondi_corpus, 2),
+        },
+        "risultati": risultati,
+    }
+    with open(parametri.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Risultati salvati in {parametri.output}")
+    if parametri.confronta:
+        confronta(output, parametri.confronta)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark dei profili di inferenza di Nanonets-OCR-s su una pagina fissa.
+
+Ogni profilo viene misurato in un processo separato (i thread inter-op si
+possono impostare una sola volta e la memoria non si mescola tra profili):
+tempo di caricamento, memoria residente dei pesi, RSS del processo, picco
+RSS e latenza della prima e delle successive generazioni. Un profilo seguito
+da "+compile" abilita anche torch.compile.
+
+La pagina è quella indicata (prima pagina del PDF) oppure una pagina
+sintetica generata con fpdf, renderizzata a 150 dpi.
+
+Uso: python benchmarks/bench_profili.py [profili] [ripetizioni] [max_new_tokens] [pdf]
+     es. python benchmarks/bench_profili.py cpu,cpu_bf16,cpu_int8,cpu+compile 3 64
+"""
+
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RISOLUZIONE = 150
+
+
+def pagina_sintetica(percorso):
+    """PDF di una pagina con testo e tabella simili a un contratto"""
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Helvetica", size=11)
+    righe = [
+        "CONTRATTO DI FINANZIAMENTO CONTRO CESSIONE DEL QUINTO",
+        "COGNOME: ROSSI NOME: MARIO",
+        "CF RSSMRA80A01H501U",
+        "nato a Roma il 01/01/1980",
+        "DURATA: 120 MESI",
+        "COSTI TOTALI: 1.234,56 EUR",
+    ]
+    for riga in righe:
+        pdf.cell(0, 8, riga, new_x="LMARGIN", new_y="NEXT")
+    for n in range(1, 13):
+        pdf.cell(60, 7, f"Rata {n}", border=1)
+        pdf.cell(60, 7, "320,00", border=1, new_x="LMARGIN", new_y="NEXT")
+    pdf.output(percorso)
+
+
+def misura(profilo, ripetizioni, max_new_tokens, pdf_path):
+    """Eseguito nel processo figlio: carica il modello con il profilo e cronometra la pagina"""
+    import psutil
+    from config import Config
+    from document import DocumentoPDF
+    from registry import dimensione_residente
+    import index
+
+    nome, _, opzione = profilo.partition("+")
+    model_config = Config.get_model_config(nome)
+    model_config["compile"] = model_config["compile"] or opzione == "compile"
+
+    with DocumentoPDF(pdf_path) as documento:
+        pagina = documento.immagine_pagina(0, resolution=RISOLUZIONE)
+
+    processo = psutil.Process()
+    rss_iniziale = processo.memory_info().rss
+    inizio = time.perf_counter()
+    model, processor = index.load_nanonets_model(model_config)
+    caricamento = time.perf_counter() - inizio
+    rss_modello = processo.memory_info().rss
+
+    latenze = []
+    for _ in range(ripetizioni + 1):
+        inizio = time.perf_counter()
+        index.ocr_batch_nanonets(model, processor, [pagina], max_new_tokens)
+        latenze.append(time.perf_counter() - inizio)
+
+    return {
+        "profilo": profilo,
+        "caricamento_s": round(caricamento, 2),
+        "pesi_mb": round(dimensione_residente((model, processor)) / 1024 / 1024),
+        "rss_modello_mb": round((rss_modello - rss_iniziale) / 1024 / 1024),
+        "picco_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        "prima_s": round(latenze[0], 2),
+        "mediana_s": round(statistics.median(latenze[1:]), 2),
+    }
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--figlio":
+        risultato = misura(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5])
+        print("RISULTATO " + json.dumps(risultato))
+        return
+
+    profili = (sys.argv[1] if len(sys.argv) > 1 else "cpu,cpu_bf16,cpu_int8").split(",")
+    ripetizioni = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    max_new_tokens = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+
+    with tempfile.TemporaryDirectory() as cartella:
+        pdf_path = sys.argv[4] if len(sys.argv) > 4 else os.path.join(cartella, "pagina.pdf")
+        if len(sys.argv) <= 4:
+            pagina_sintetica(pdf_path)
+
+        print(f"📊 Benchmark profili di inferenza: {ripetizioni} ripetizioni, max_new_tokens={max_new_tokens}, {RISOLUZIONE} dpi")
+        print(f"{'profilo':<14} {'load s':>7} {'pesi MB':>8} {'RSS MB':>7} {'picco MB':>9} {'prima s':>8} {'mediana s':>10}")
+        for profilo in profili:
+            processo = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--figlio", profilo, str(ripetizioni), str(max_new_tokens), pdf_path],
+                capture_output=True, text=True
+            )
+            righe = [r for r in processo.stdout.splitlines() if r.startswith("RISULTATO ")]
+            if processo.returncode != 0 or not righe:
+                errore = (processo.stderr.strip().splitlines() or ["errore sconosciuto"])[-1]
+                print(f"{profilo:<14} ❌ {errore}")
+                continue
+            r = json.loads(righe[-1][len("RISULTATO "):])
+            print(f"{profilo:<14} {r['caricamento_s']:>7.1f} {r['pesi_mb']:>8} {r['rss_modello_mb']:>7} "
+                  f"{r['picco_rss_mb']:>9} {r['prima_s']:>8.2f} {r['mediana_s']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
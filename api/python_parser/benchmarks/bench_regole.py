@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del motore di regole su output OCR lunghi.
+
+Confronta lo scanner compilato (rules.ScannerCampi, una passata) con il
+vecchio approccio: per ogni campo, un re.search case-insensitive per pattern
+finché uno corrisponde (fino a ~20 scansioni complete del testo). Lo scenario
+"parziale" simula un output OCR in cui mancano alcuni campi, il caso in cui il
+vecchio approccio scandisce il testo con tutti i pattern.
+
+Uso: python benchmarks/bench_regole.py [pagine] [ripetizioni]
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules import REGOLE, estrai_campi
+
+PAROLE = ("il finanziamento è rimborsato mediante cessione delle quote della retribuzione, "
+          "secondo le condizioni economiche riportate nel documento informativo allegato. "
+          "tasso annuo nominale 7,25% oneri commissioni 1.250,00 spese di istruttoria art. 125 "
+          "polizza n. 4471 rata mensile <td>320,00</td> <page_number>3</page_number>").split()
+
+CAMPI_CONTRATTO = [
+    "COGNOME: ROSSI NOME: MARIO",
+    "CF RSSMRA80A01H501U",
+    "nato a Roma il 01/01/1980",
+    "CT € 1.234,56 COSTI TOTALI",
+    "DURATA: 120 MESI",
+]
+
+# Output OCR senza etichette per nome e nascita: resta solo il codice fiscale
+CAMPI_CONTRATTO_PARZIALI = [
+    "Sig. Mario Rossi CF RSSMRA80A01H501U",
+    "TOTALE COSTI: 1.234,56",
+    "120 MESI DI DURATA",
+]
+
+CAMPI_CONTEGGIO = [
+    "RATE SCADUTE: 48 MESI",
+    "DATA ELABORAZIONE CONTEGGIO ESTINTIVO 15/03/2024",
+]
+
+CAMPI_CONTEGGIO_PARZIALI = [
+    "36 MESI SCADUTI",
+]
+
+
+def genera_testo(pagine, campi, posizione):
+    """Testo OCR sintetico (~3 KB per pagina) con i campi all'inizio, a metà o alla fine"""
+    rng = random.Random(42)
+    blocchi = [" ".join(rng.choice(PAROLE) for _ in range(450)) for _ in range(pagine)]
+    indice = {"inizio": 0, "meta": pagine // 2, "fine": pagine - 1}[posizione]
+    blocchi[indice] += "\n" + "\n".join(campi) + "\n"
+    return "\n".join(blocchi)
+
+
+def estrai_legacy(file_type, text):
+    """Approccio precedente: un re.search per pattern, campo per campo"""
+    dati = {}
+    for regola in sorted(REGOLE[file_type], key=lambda r: r.priorita):
+        if all(campo in dati for campo in regola.campi):
+            continue
+        match = re.search(regola.pattern, text, re.IGNORECASE)
+        if match is None:
+            continue
+        try:
+            valori = regola.valori(match)
+        except (ValueError, TypeError):
+            continue
+        for campo, valore in zip(regola.campi, valori):
+            dati.setdefault(campo, valore)
+    return dati
+
+
+def cronometra(funzione, ripetizioni):
+    migliore = float("inf")
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        funzione()
+        migliore = min(migliore, time.perf_counter() - inizio)
+    return migliore
+
+
+def main():
+    pagine = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    ripetizioni = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print(f"📊 Benchmark regole: {pagine} pagine, migliore di {ripetizioni} ripetizioni")
+    print(f"{'documento':<10} {'campi':<9} {'posizione':<9} {'KB':>5} {'legacy ms':>10} {'scanner ms':>11} {'speedup':>8}")
+    scenari = (
+        ("contratto", "completi", CAMPI_CONTRATTO),
+        ("contratto", "parziali", CAMPI_CONTRATTO_PARZIALI),
+        ("conteggio", "completi", CAMPI_CONTEGGIO),
+        ("conteggio", "parziali", CAMPI_CONTEGGIO_PARZIALI),
+    )
+    for file_type, scenario, campi in scenari:
+        for posizione in ("inizio", "meta", "fine"):
+            text = genera_testo(pagine, campi, posizione)
+            risultato, atteso = estrai_campi(file_type, text), estrai_legacy(file_type, text)
+            if risultato != atteso:
+                print(f"⚠️  risultati diversi: scanner={risultato} legacy={atteso}")
+            legacy = cronometra(lambda: estrai_legacy(file_type, text), ripetizioni)
+            scanner = cronometra(lambda: estrai_campi(file_type, text), ripetizioni)
+            print(f"{file_type:<10} {scenario:<9} {posizione:<9} {len(text) / 1024:>5.0f} "
+                  f"{legacy * 1000:>10.2f} {scanner * 1000:>11.2f} {legacy / scanner:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Corpus sintetico di contratti e conteggi estintivi in PDF, generati con fpdf.
+
+Ogni documento ha un numero di pagine a scelta, testo di riempimento e, in una
+pagina, i campi scritti con uno dei layout che le regole di rules.py riconoscono.
+Senza strato di testo le pagine vengono rasterizzate e reinserite come immagini,
+come in una scansione. Per ogni documento il corpus conserva il testo di ogni
+pagina (quello che un OCR perfetto restituirebbe) e i campi attesi.
+
+Uso: python benchmarks/corpus.py <cartella> [pagine] [strato_testo]
+     es. python benchmarks/corpus.py /tmp/corpus 1,5,20 si,no
+"""
+
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fpdf import FPDF
+
+RISOLUZIONE_SCANSIONE = 150
+RIGHE_PER_PAGINA = 30
+
+# Parole senza numeri né parole chiave delle regole: il riempimento non produce falsi positivi
+PAROLE = ("il finanziamento viene rimborsato mediante cessione delle quote della retribuzione "
+          "secondo le condizioni economiche riportate nel documento informativo allegato alla "
+          "presente proposta che il richiedente dichiara di aver ricevuto e compreso in ogni sua "
+          "parte ai sensi della normativa vigente in materia di trasparenza bancaria").split()
+
+# (righe con i campi, campi che le regole devono estrarre)
+LAYOUT_CONTRATTO = (
+    (
+        ["COGNOME: ROSSI NOME: MARIO, CF RSSMRA80A01H501U",
+         "nato a Roma il 01/01/1980, residente in Roma",
+         "COSTI TOTALI: 1.234,56",
+         "DURATA: 120 MESI"],
+        {"cognome": "ROSSI", "nome": "MARIO", "codice_fiscale": "RSSMRA80A01H501U", "data_nascita": "01/01/1980",
+         "luogo_nascita": "Roma", "costi_totali": 1234.56, "durata_mesi": 120, "numero_rate": 120},
+    ),
+    (
+        ["TITOLARE: BIANCHI LUCA - C.F. BNCLCU75B02F205X",
+         "data nascita 02/02/1975, luogo nascita MILANO, provincia MI",
+         "TOTALE COSTI 2.100,00",
+         "DURATA TOTALE: 84 MESI"],
+        {"cognome": "BIANCHI", "nome": "LUCA", "codice_fiscale": "BNCLCU75B02F205X", "data_nascita": "02/02/1975",
+         "luogo_nascita": "MILANO", "costi_totali": 2100.0, "durata_mesi": 84, "numero_rate": 84},
+    ),
+    (
+        ["Sig. VERDI ANNA CF VRDNNA90C43L219K",
+         "nato a Torino il 03/03/1990, residente in Torino",
+         "96 MESI DI DURATA",
+         "COSTI: 980,40"],
+        {"cognome": "VERDI", "nome": "ANNA", "codice_fiscale": "VRDNNA90C43L219K", "data_nascita": "03/03/1990",
+         "luogo_nascita": "Torino", "costi_totali": 980.4, "durata_mesi": 96, "numero_rate": 96},
+    ),
+)
+
+LAYOUT_CONTEGGIO = (
+    (
+        ["RATE SCADUTE: 48 MESI",
+         "DATA ELABORAZIONE CONTEGGIO ESTINTIVO 15/03/2024"],
+        {"rate_scadute": 48, "data_chiusura": "15/03/2024"},
+    ),
+    (
+        ["36 RATE SCADUTE",
+         "DATA CHIUSURA: 10/10/2023"],
+        {"rate_scadute": 36, "data_chiusura": "10/10/2023"},
+    ),
+    (
+        ["SCADUTE: 60 RATE",
+         "ELABORATO IL 01/02/2025"],
+        {"rate_scadute": 60, "data_chiusura": "01/02/2025"},
+    ),
+)
+
+LAYOUT = {"contratto": LAYOUT_CONTRATTO, "conteggio": LAYOUT_CONTEGGIO}
+
+
+def testi_pagine(file_type: str, pagine: int, variante: int, rng) -> tuple:
+    """Testo di ogni pagina e campi attesi: i campi stanno nella prima pagina o nell'ultima, a seconda della variante"""
+    righe_campi, attesi = LAYOUT[file_type][variante % len(LAYOUT[file_type])]
+    pagina_campi = 0 if variante % 2 == 0 else pagine - 1
+    testi = []
+    for pagina in range(pagine):
+        righe = [" ".join(rng.choice(PAROLE) for _ in range(12)) for _ in range(RIGHE_PER_PAGINA)]
+        if pagina == pagina_campi:
+            righe[4:4] = righe_campi
+        testi.append(righe)
+    return testi, attesi
+
+
+def pdf_testo(testi) -> FPDF:
+    """PDF con lo strato di testo: una riga per cell, come un documento generato"""
+    pdf = FPDF()
+    pdf.set_font("helvetica", size=10)
+    for righe in testi:
+        pdf.add_page()
+        for riga in righe:
+            pdf.cell(0, 7, riga, new_x="LMARGIN", new_y="NEXT")
+    return pdf
+
+
+def pdf_scansione(contenuto: bytes) -> FPDF:
+    """Rasterizza le pagine e le reinserisce come immagini: nessuno strato di testo"""
+    from document import DocumentoPDF
+    pdf = FPDF()
+    with DocumentoPDF(contenuto) as documento:
+        for indice in range(documento.num_pagine):
+            immagine = documento.immagine_pagina(indice, resolution=RISOLUZIONE_SCANSIONE).convert("L")
+            pdf.add_page()
+            pdf.image(immagine, x=0, y=0, w=pdf.w, h=pdf.h)
+    return pdf
+
+
+def genera_documento(file_type: str, pagine: int, strato_testo: bool, variante: int = 0, seme: int = 42) -> dict:
+    """Un documento del corpus: contenuto PDF, testo di ogni pagina e campi attesi"""
+    rng = random.Random(f"{seme}-{file_type}-{pagine}-{variante}")
+    testi, attesi = testi_pagine(file_type, pagine, variante, rng)
+    contenuto = bytes(pdf_testo(testi).output())
+    if not strato_testo:
+        contenuto = bytes(pdf_scansione(contenuto).output())
+    return {
+        "file_type": file_type,
+        "pagine": pagine,
+        "strato_testo": strato_testo,
+        "variante": variante,
+        "contenuto": contenuto,
+        "testi": ["\n".join(righe) for righe in testi],
+        "attesi": attesi,
+    }
+
+
+def genera_corpus(pagine=(1, 5, 20), strati=(True, False), seme: int = 42) -> list:
+    """Coppie contratto/conteggio per ogni combinazione di pagine e strato di testo, con layout a rotazione"""
+    coppie = []
+    for n, (numero_pagine, strato_testo) in enumerate((p, s) for p in pagine for s in strati):
+        coppie.append({
+            "id": f"p{numero_pagine:03d}_{'testo' if strato_testo else 'scansione'}",
+            "contratto": genera_documento("contratto", numero_pagine, strato_testo, n, seme),
+            "conteggio": genera_documento("conteggio", numero_pagine, strato_testo, n, seme),
+        })
+    return coppie
+
+
+def salva_corpus(coppie, cartella: str) -> str:
+    """Scrive i PDF come <id>_contratto.pdf / <id>_conteggio.pdf (la convenzione di /estrai-dati/bulk/)
+    e un manifest.json con i campi attesi"""
+    os.makedirs(cartella, exist_ok=True)
+    manifest = []
+    for coppia in coppie:
+        voce = {"id": coppia["id"]}
+        for ruolo in ("contratto", "conteggio"):
+            nome = f"{coppia['id']}_{ruolo}.pdf"
+            with open(os.path.join(cartella, nome), "wb") as f:
+                f.write(coppia[ruolo]["contenuto"])
+            voce[ruolo] = nome
+            voce[f"attesi_{ruolo}"] = coppia[ruolo]["attesi"]
+        manifest.append(voce)
+    percorso = os.path.join(cartella, "manifest.json")
+    with open(percorso, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return percorso
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: python benchmarks/corpus.py <cartella> [pagine] [strato_testo]")
+        sys.exit(1)
+    pagine = [int(p) for p in (sys.argv[2] if len(sys.argv) > 2 else "1,5,20").split(",")]
+    strati = [s == "si" for s in (sys.argv[3] if len(sys.argv) > 3 else "si,no").split(",")]
+    coppie = genera_corpus(pagine, strati)
+    percorso = salva_corpus(coppie, sys.argv[1])
+    dimensione = sum(len(c[r]["contenuto"]) for c in coppie for r in ("contratto", "conteggio"))
+    print(f"📁 Corpus: {len(coppie)} coppie, {dimensione / 1024:.0f} KB in {sys.argv[1]} (manifest: {percorso})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import csv
+import io
+import json
+import posixpath
+import re
+import zipfile
+from uploads import UploadRifiutato, salva_stream
+
+RUOLI = ("contratto", "conteggio")
+MANIFEST = ("manifest.json", "manifest.csv")
+MAX_MANIFEST_BYTES = 1024 * 1024  # byte decompressi del manifest nell'archivio
+
+# <id>_contratto.pdf, <id>-conteggio.pdf, contratto_<id>.pdf (separatori _ - . spazio)
+NOME_COPPIA = re.compile(
+    r"^(?:(?P<ruolo_prima>contratto|conteggio)[\s_.-]+(?P<id_dopo>.+)|(?P<id_prima>.+?)[\s_.-]+(?P<ruolo_dopo>contratto|conteggio))$",
+    re.IGNORECASE
+)
+
+
+def ruolo_file(nome: str):
+    """(id, ruolo) dedotti dal nome del file, o None se il nome non segue la convenzione.
+
+    Un file chiamato solo contratto.pdf o conteggio.pdf prende come id la cartella che lo contiene.
+    """
+    cartella, base = posixpath.split(nome)
+    radice, suffix = posixpath.splitext(base)
+    if suffix.lower() != ".pdf":
+        return None
+    if radice.lower() in RUOLI:
+        return (cartella, radice.lower()) if cartella else None
+    match = NOME_COPPIA.match(radice)
+    if match is None:
+        return None
+    identificativo = match.group("id_dopo") or match.group("id_prima")
+    ruolo = (match.group("ruolo_prima") or match.group("ruolo_dopo")).lower()
+    return posixpath.join(cartella, identificativo) if cartella else identificativo, ruolo
+
+
+def leggi_manifest(testo: str) -> list:
+    """Righe del manifest: JSON [{"id", "contratto", "conteggio"}] oppure CSV con le stesse colonne"""
+    testo = testo.strip()
+    if testo.startswith("["):
+        righe = json.loads(testo)
+    else:
+        righe = list(csv.DictReader(io.StringIO(testo)))
+    for n, riga in enumerate(righe, 1):
+        if not isinstance(riga, dict) or not all(riga.get(campo) for campo in RUOLI):
+            raise ValueError(f"Riga {n} del manifest senza contratto o conteggio")
+    return [
+        {"id": str(riga.get("id") or n), "contratto": riga["contratto"], "conteggio": riga["conteggio"]}
+        for n, riga in enumerate(righe, 1)
+    ]
+
+
+def abbina_coppie(nomi, manifest: list = None):
+    """Abbina i file in coppie contratto/conteggio: dal manifest o dalla convenzione sui nomi.
+
+    Restituisce (coppie, scartati): le coppie {"id", "contratto", "conteggio"} e
+    gli id o i file che non è stato possibile abbinare, con il motivo.
+    """
+    nomi = [nome for nome in nomi if not ignorato(nome)]
+    disponibili = set(nomi)
+    coppie, scartati = [], []
+
+    if manifest is not None:
+        for riga in manifest:
+            mancanti = [riga[ruolo] for ruolo in RUOLI if riga[ruolo] not in disponibili]
+            if mancanti:
+                scartati.append({"id": riga["id"], "errore": f"File non trovati: {', '.join(mancanti)}"})
+            else:
+                coppie.append(riga)
+        return coppie, scartati
+
+    gruppi = {}
+    for nome in nomi:
+        riconosciuto = ruolo_file(nome)
+        if riconosciuto is None:
+            scartati.append({"file": nome, "errore": "Nome non riconosciuto: usa <id>_contratto.pdf e <id>_conteggio.pdf"})
+            continue
+        identificativo, ruolo = riconosciuto
+        gruppo = gruppi.setdefault(identificativo, {})
+        if ruolo in gruppo:
+            scartati.append({"id": identificativo, "errore": f"Più file {ruolo}: {gruppo[ruolo]}, {nome}"})
+            continue
+        gruppo[ruolo] = nome
+
+    for identificativo, gruppo in gruppi.items():
+        mancanti = [ruolo for ruolo in RUOLI if ruolo not in gruppo]
+        if mancanti:
+            scartati.append({"id": identificativo, "errore": f"Manca il file {' e '.join(mancanti)}"})
+        else:
+            coppie.append({"id": identificativo, **gruppo})
+    return coppie, scartati
+
+
+def ignorato(nome: str) -> bool:
+    """Cartelle, file nascosti, metadati macOS e manifest non sono documenti"""
+    base = posixpath.basename(nome)
+    return (nome.endswith("/") or base.startswith(".") or nome.startswith("__MACOSX/")
+            or base.lower() in MANIFEST)
+
+
+def contenuto_archivio(percorso: str):
+    """Nomi dei file nell'archivio ZIP e testo del manifest, se presente alla radice.
+
+    Il manifest viene letto a blocchi fino a MAX_MANIFEST_BYTES decompressi: oltre
+    l'archivio viene rifiutato (413), qualunque sia la dimensione dichiarata.
+    """
+    with zipfile.ZipFile(percorso) as archivio:
+        nomi = [info.filename for info in archivio.infolist() if not info.is_dir()]
+        manifest = None
+        for nome in MANIFEST:
+            if nome in nomi:
+                with archivio.open(nome) as membro:
+                    contenuto = membro.read(MAX_MANIFEST_BYTES + 1)
+                if len(contenuto) > MAX_MANIFEST_BYTES:
+                    raise UploadRifiutato(f"{nome} supera {MAX_MANIFEST_BYTES // 1024} KB", 413)
+                try:
+                    manifest = contenuto.decode("utf-8-sig")
+                except UnicodeDecodeError:
+                    raise zipfile.BadZipFile(f"{nome} non è un testo UTF-8")
+                break
+    return nomi, manifest
+
+
+def estrai_membro(percorso: str, nome: str, max_bytes: int) -> str:
+    """Estrae un PDF dall'archivio in un file temporaneo, con gli stessi controlli degli upload.
+
+    La dimensione viene verificata sui byte decompressi, non solo su quella
+    dichiarata nell'archivio.
+    """
+    with zipfile.ZipFile(percorso) as archivio, archivio.open(nome) as membro:
+        return salva_stream(membro, nome, {".pdf"}, max_bytes)
@@ -0,0 +1,167 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from config import Config
+from logs import get_logger
+
+log = get_logger("cache")
+
+
+def sha256_file(file, chunk_size: int = 1024 * 1024) -> str:
+    """Calcola lo SHA-256 di un file (percorso, bytes o stream) senza caricarlo tutto in memoria"""
+    if isinstance(file, (bytes, bytearray)):
+        return hashlib.sha256(file).hexdigest()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            return sha256_file(f, chunk_size)
+
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def chiave_cache(namespace: str, sha_contenuto: str, **parametri) -> str:
+    """Chiave indirizzata al contenuto: hash del file più i parametri che influenzano il risultato"""
+    materiale = json.dumps(
+        {"namespace": namespace, "sha256": sha_contenuto, "parametri": parametri},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(materiale.encode("utf-8")).hexdigest()
+
+
+class CacheRisultati:
+    """Cache a due livelli per risultati OCR ed estrazione.
+
+    - memoria: LRU con numero massimo di elementi
+    - disco: un file JSON per chiave, con eviction dei meno usati oltre la dimensione massima
+    I valori devono essere serializzabili in JSON.
+    """
+
+    def __init__(self, enabled: bool, memory_items: int, disk_dir: str, disk_max_mb: int):
+        self.enabled = enabled
+        self.memory_items = memory_items
+        self.disk_dir = disk_dir if disk_max_mb > 0 else None
+        self.disk_max_bytes = disk_max_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()
+        self._disco = OrderedDict()  # chiave -> dimensione, dal meno al più recente
+        self._disco_bytes = 0
+        self._stats = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "stores": 0, "evictions_disk": 0}
+        if self.enabled and self.disk_dir:
+            self._scan_disco()
+
+    def _percorso(self, chiave: str) -> str:
+        return os.path.join(self.disk_dir, chiave[:2], f"{chiave}.json")
+
+    def _scan_disco(self):
+        """Ricostruisce l'indice del livello su disco (ordinato per ultimo accesso)"""
+        voci = []
+        for radice, _, files in os.walk(self.disk_dir):
+            for nome in files:
+                if nome.endswith(".json"):
+                    percorso = os.path.join(radice, nome)
+                    try:
+                        stat = os.stat(percorso)
+                    except OSError:
+                        continue
+                    voci.append((stat.st_mtime, nome[:-5], stat.st_size))
+        for _, chiave, dimensione in sorted(voci):
+            self._disco[chiave] = dimensione
+            self._disco_bytes += dimensione
+
+    def _memorizza(self, chiave, valore):
+        self._memoria[chiave] = valore
+        self._memoria.move_to_end(chiave)
+        while len(self._memoria) > self.memory_items:
+            self._memoria.popitem(last=False)
+
+    def get(self, chiave: str):
+        """Restituisce il valore in cache oppure None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if chiave in self._memoria:
+                self._memoria.move_to_end(chiave)
+                self._stats["hits_memory"] += 1
+                # Copia: i chiamanti possono modificare i dizionari restituiti
+                return copy.deepcopy(self._memoria[chiave])
+
+            if self.disk_dir and chiave in self._disco:
+                percorso = self._percorso(chiave)
+                try:
+                    with open(percorso, "r", encoding="utf-8") as f:
+                        valore = json.load(f)
+                    os.utime(percorso)
+                except (OSError, ValueError):
+                    self._disco_bytes -= self._disco.pop(chiave)
+                else:
+                    self._disco.move_to_end(chiave)
+                    self._memorizza(chiave, valore)
+                    self._stats["hits_disk"] += 1
+                    return copy.deepcopy(valore)
+
+            self._stats["misses"] += 1
+            return None
+
+    def set(self, chiave: str, valore):
+        """Salva il valore in memoria e su disco"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._memorizza(chiave, copy.deepcopy(valore))
+            self._stats["stores"] += 1
+            if not self.disk_dir:
+                return
+
+            percorso = self._percorso(chiave)
+            try:
+                os.makedirs(os.path.dirname(percorso), exist_ok=True)
+                tmp_path = percorso + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(valore, f, ensure_ascii=False)
+                os.replace(tmp_path, percorso)
+                dimensione = os.path.getsize(percorso)
+            except OSError as e:
+                log.error("Errore scrittura cache su disco: %s", e)
+                return
+
+            self._disco_bytes += dimensione - self._disco.pop(chiave, 0)
+            self._disco[chiave] = dimensione
+            while self._disco_bytes > self.disk_max_bytes and len(self._disco) > 1:
+                vecchia, dim_vecchia = self._disco.popitem(last=False)
+                self._disco_bytes -= dim_vecchia
+                self._stats["evictions_disk"] += 1
+                try:
+                    os.remove(self._percorso(vecchia))
+                except OSError:
+                    pass
+
+    def get_or_compute(self, chiave: str, funzione, *args, cacheabile=None, **kwargs):
+        """Restituisce il valore in cache o lo calcola; i risultati vuoti, o scartati da
+        cacheabile(valore) (es. parziali per un errore transitorio), non vengono salvati"""
+        valore = self.get(chiave)
+        if valore is not None:
+            return valore
+        valore = funzione(*args, **kwargs)
+        if valore and (cacheabile is None or cacheabile(valore)):
+            self.set(chiave, valore)
+        return valore
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                **self._stats,
+                "memory_items": len(self._memoria),
+                "disk_items": len(self._disco),
+                "disk_bytes": self._disco_bytes
+            }
+
+
+risultati_cache = CacheRisultati(**Config.get_cache_config())
@@ -0,0 +1,143 @@
+import threading
+import time
+from executor import ExecutorBusyError
+from logs import get_logger
+from metrics import metriche
+
+log = get_logger("cascade")
+
+# Campi necessari ai calcoli: finché ne manca uno si passa al livello successivo
+CAMPI_RICHIESTI = {
+    "contratto": ("nome", "codice_fiscale", "costi_totali", "durata_mesi"),
+    "conteggio": ("rate_scadute",),
+}
+
+
+def valorizzato(valore) -> bool:
+    return valore not in (None, "", 0, 0.0)
+
+
+def campi_mancanti(dati: dict, file_type: str) -> list:
+    """Campi richiesti per il tipo di documento non ancora valorizzati"""
+    return [campo for campo in CAMPI_RICHIESTI[file_type] if not valorizzato(dati.get(campo))]
+
+
+class ErroreCascata(Exception):
+    """Uno o più livelli sono falliti e i successivi non hanno completato i campi richiesti"""
+
+    def __init__(self, file_type: str, errori: dict):
+        self.errori = errori
+        super().__init__(f"Estrazione {file_type} incompleta, livelli in errore: "
+                         + "; ".join(f"{nome}: {errore}" for nome, errore in errori.items()))
+
+
+class Livello:
+    """Un livello della cascata.
+
+    estrai(documento, file_type, dati) restituisce (campi, pagine_elaborate):
+    i campi trovati e quante pagine ha dovuto esaminare. disponibile(file_type) dice
+    se il livello può essere usato ora per quel tipo di documento (es. modello caricato).
+    """
+
+    def __init__(self, nome: str, estrai, disponibile=None):
+        self.nome = nome
+        self.estrai = estrai
+        self.disponibile = disponibile or (lambda file_type=None: True)
+
+
+class CascataEstrazione:
+    """Estrae i campi provando i livelli in ordine di costo.
+
+    Ogni livello valorizza solo i campi ancora vuoti; la cascata si ferma
+    appena tutti i campi richiesti sono presenti. Il dizionario restituito
+    contiene in "fonti" il livello che ha valorizzato ogni campo e in
+    "errori" i livelli falliti. Se un livello fallisce e i successivi non
+    completano i campi solleva ErroreCascata; ExecutorBusyError (pool dei
+    modelli saturo) viene propagata subito, così la richiesta risponde 503
+    invece di restituire campi vuoti. Le statistiche aggregate mostrano quanti documenti si sono fermati a ogni
+    livello e quanto tempo è stato speso nei livelli costosi.
+    """
+
+    def __init__(self, livelli):
+        self.livelli = livelli
+        self._lock = threading.Lock()
+        self._stats = {
+            livello.nome: {"runs": 0, "resolved": 0, "fields": 0, "pages": 0, "seconds": 0.0, "errors": 0}
+            for livello in livelli
+        }
+        self._documenti = 0
+        self._incompleti = 0
+
+    def livelli_disponibili(self, file_type: str = None) -> list:
+        return [livello.nome for livello in self.livelli if livello.disponibile(file_type)]
+
+    def estrai(self, documento, file_type: str, dati: dict) -> dict:
+        dati = dict(dati)
+        fonti = {}
+        errori = {}
+        prima_eccezione = None
+        for livello in self.livelli:
+            if not campi_mancanti(dati, file_type):
+                break
+            if not livello.disponibile(file_type):
+                continue
+
+            inizio = time.perf_counter()
+            try:
+                campi, pagine = livello.estrai(documento, file_type, dati)
+                errore = False
+            except ExecutorBusyError:
+                with self._lock:
+                    self._stats[livello.nome]["errors"] += 1
+                raise
+            except Exception as e:
+                log.error("Errore livello %s: %s", livello.nome, e)
+                campi, pagine, errore = {}, 0, True
+                errori[livello.nome] = str(e)
+                prima_eccezione = prima_eccezione or e
+            secondi = time.perf_counter() - inizio
+
+            nuovi = [
+                campo for campo, valore in campi.items()
+                if valorizzato(valore) and not valorizzato(dati.get(campo))
+            ]
+            for campo in nuovi:
+                dati[campo] = campi[campo]
+                fonti[campo] = livello.nome
+            completo = not campi_mancanti(dati, file_type)
+            log.debug("Livello %s: %d campi da %d pagine in %.2fs", livello.nome, len(nuovi), pagine, secondi,
+                      extra={"livello": livello.nome, "file_type": file_type, "secondi": round(secondi, 3)})
+            metriche.osserva("stage_seconds", secondi, stage=f"cascata_{livello.nome}")
+
+            with self._lock:
+                stats = self._stats[livello.nome]
+                stats["runs"] += 1
+                stats["fields"] += len(nuovi)
+                stats["pages"] += pagine
+                stats["seconds"] += secondi
+                stats["errors"] += errore
+                stats["resolved"] += completo
+
+        incompleto = bool(campi_mancanti(dati, file_type))
+        with self._lock:
+            self._documenti += 1
+            self._incompleti += incompleto
+
+        if errori and incompleto:
+            raise ErroreCascata(file_type, errori) from prima_eccezione
+        dati["fonti"] = fonti
+        if errori:
+            dati["errori"] = errori
+        return dati
+
+    def stats(self) -> dict:
+        """Documenti risolti, pagine e tempo speso per livello"""
+        with self._lock:
+            return {
+                "documents": self._documenti,
+                "incomplete": self._incompleti,
+                "tiers": {
+                    nome: {**stats, "seconds": round(stats["seconds"], 2)}
+                    for nome, stats in self._stats.items()
+                },
+            }
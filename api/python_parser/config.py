@@ -17,20 +17,142 @@ class Config:
     MODEL_PATH = os.getenv("MODEL_PATH", "nanonets/Nanonets-OCR-s")
     DEVICE = os.getenv("DEVICE", "auto")
     
+    # Profili di inferenza: "auto" usa flash attention su GPU se disponibile, SDPA altrimenti
+    INFERENCE_PROFILES = {
+        "auto": {"device": "auto", "attn_implementation": "auto", "dtype": "auto"},
+        "gpu": {"device": "auto", "attn_implementation": "flash_attention_2", "dtype": "auto"},
+        "cpu": {"device": "cpu", "attn_implementation": "sdpa", "dtype": "float32"},
+        "cpu_bf16": {"device": "cpu", "attn_implementation": "sdpa", "dtype": "bfloat16"},
+        "cpu_int8": {"device": "cpu", "attn_implementation": "sdpa", "dtype": "int8"},
+    }
+    INFERENCE_PROFILE = os.getenv("INFERENCE_PROFILE", "auto")
+    # Sovrascrivono il profilo se impostate (attention: flash_attention_2, sdpa, eager;
+    # dtype: auto, float32, bfloat16, float16, int8 = quantizzazione dinamica dei Linear)
+    ATTN_IMPLEMENTATION = os.getenv("ATTN_IMPLEMENTATION")
+    MODEL_DTYPE = os.getenv("MODEL_DTYPE")
+    TORCH_COMPILE = os.getenv("TORCH_COMPILE", "false").lower() == "true"
+    TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))  # intra-op, 0 = default di torch
+    TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "0"))  # inter-op, 0 = default di torch
+    
     # Configurazione server
     HOST = os.getenv("HOST", "0.0.0.0")
     PORT = int(os.getenv("PORT", "7860"))
     
     # Configurazione file
-    MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "100"))  # MB
+    MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "100"))  # MB, per file
+    MAX_REQUEST_SIZE = int(os.getenv("MAX_REQUEST_SIZE", str(2 * MAX_FILE_SIZE + 1)))  # MB, intera richiesta
+    MAX_BULK_SIZE = int(os.getenv("MAX_BULK_SIZE", "2048"))  # MB, archivio o richiesta dell'estrazione massiva
     ALLOWED_EXTENSIONS = {".pdf", ".png", ".jpg", ".jpeg"}
     
+    # Ordine di visita delle pagine per tipo di documento
+    # (1 = prima, -1 = ultima, "a-b" = intervallo, * = pagine restanti)
+    PAGE_ORDER = {
+        # I costi stanno di solito nel SECCI in apertura del contratto
+        "contratto": os.getenv("PAGE_ORDER_CONTRATTO", "1-4,*"),
+        # Rate scadute e data di elaborazione stanno in prima o ultima pagina
+        "conteggio": os.getenv("PAGE_ORDER_CONTEGGIO", "1,-1,*"),
+    }
+    
+    # Backend dei due ruoli: "layout" (livello pdf_extract_kit della cascata) e "ocr" (endpoint OCR e
+    # livello nanonets); i valori sono pdf_extract_kit, nanonets o finto, anche per tipo di documento
+    LAYOUT_BACKEND = os.getenv("LAYOUT_BACKEND", "pdf_extract_kit")
+    OCR_BACKEND = os.getenv("OCR_BACKEND", "nanonets")
+    BACKENDS = {
+        "layout": {
+            "contratto": os.getenv("LAYOUT_BACKEND_CONTRATTO", LAYOUT_BACKEND),
+            "conteggio": os.getenv("LAYOUT_BACKEND_CONTEGGIO", LAYOUT_BACKEND),
+        },
+        "ocr": {
+            "contratto": os.getenv("OCR_BACKEND_CONTRATTO", OCR_BACKEND),
+            "conteggio": os.getenv("OCR_BACKEND_CONTEGGIO", OCR_BACKEND),
+        },
+    }
+    # Backend finto, per test di carico e concorrenza senza scaricare i modelli
+    FAKE_OCR_LATENCY_MS = int(os.getenv("FAKE_OCR_LATENCY_MS", "200"))  # per immagine
+    FAKE_OCR_MS_PER_TOKEN = float(os.getenv("FAKE_OCR_MS_PER_TOKEN", "0"))  # per passo di generazione del batch
+    FAKE_OCR_LOAD_SECONDS = float(os.getenv("FAKE_OCR_LOAD_SECONDS", "0"))
+    FAKE_OCR_TEXT = os.getenv("FAKE_OCR_TEXT", "")  # file con il testo restituito; vuoto = testo con i campi del tipo di documento
+    
+    # Caricamento modelli all'avvio
+    PRELOAD_NANONETS = os.getenv("PRELOAD_NANONETS", "true").lower() == "true"
+    WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+    
+    # Registro modelli: memoria massima e scaricamento dei modelli inattivi
+    MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))  # 0 = illimitato
+    MODEL_IDLE_TIMEOUT = int(os.getenv("MODEL_IDLE_TIMEOUT", "0"))  # secondi, 0 = mai
+    
+    # Configurazione batch OCR Nanonets
+    OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "0"))  # 0 = automatico in base alla memoria
+    OCR_MAX_BATCH_SIZE = int(os.getenv("OCR_MAX_BATCH_SIZE", "8"))
+    OCR_MEMORY_PER_PAGE_MB = int(os.getenv("OCR_MEMORY_PER_PAGE_MB", "1500"))  # stima per pagina a 300 dpi
+    
+    # Limiti di generazione adattivi, stimati dalla densità della pagina
+    OCR_ADAPTIVE_TOKENS = os.getenv("OCR_ADAPTIVE_TOKENS", "true").lower() == "true"
+    OCR_MIN_NEW_TOKENS = int(os.getenv("OCR_MIN_NEW_TOKENS", "128"))
+    OCR_TOKENS_PER_CHAR = float(os.getenv("OCR_TOKENS_PER_CHAR", "0.5"))  # pagine con strato di testo
+    OCR_TOKENS_PER_INK_MPX = int(os.getenv("OCR_TOKENS_PER_INK_MPX", "2000"))  # scansioni: token per megapixel di inchiostro
+    OCR_TOKEN_MARGIN = float(os.getenv("OCR_TOKEN_MARGIN", "1.5"))
+    # Arresto della generazione quando le regole hanno trovato tutti i campi richiesti
+    OCR_FIELD_STOP = os.getenv("OCR_FIELD_STOP", "true").lower() == "true"
+    OCR_FIELD_STOP_EVERY = int(os.getenv("OCR_FIELD_STOP_EVERY", "32"))  # token tra un controllo e l'altro
+    # Modalità di estrazione del livello Nanonets: "testo" (trascrizione + regole) o "json" (campi con decodifica vincolata)
+    OCR_EXTRACTION_MODE = os.getenv("OCR_EXTRACTION_MODE", "testo").lower()
+    
+    # Micro-batching: pagine di richieste concorrenti elaborate nella stessa forward pass
+    OCR_MICROBATCH_ENABLED = os.getenv("OCR_MICROBATCH_ENABLED", "true").lower() == "true"
+    OCR_MICROBATCH_MAX_SIZE = int(os.getenv("OCR_MICROBATCH_MAX_SIZE", str(OCR_MAX_BATCH_SIZE)))
+    OCR_MICROBATCH_MAX_WAIT_MS = int(os.getenv("OCR_MICROBATCH_MAX_WAIT_MS", "20"))
+    
+    # Cascata di estrazione: livelli in ordine di costo (testo del PDF, PDF-Extract-Kit, Nanonets)
+    CASCADE_TIERS = [t.strip() for t in os.getenv("CASCADE_TIERS", "testo,pdf_extract_kit,nanonets").split(",") if t.strip()]
+    TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "30"))  # caratteri per considerare la pagina nativa
+    # Se false, i modelli esaminano solo le pagine senza strato di testo (scansioni)
+    CASCADE_ESCALATE_TEXT_PAGES = os.getenv("CASCADE_ESCALATE_TEXT_PAGES", "true").lower() == "true"
+    CASCADE_OCR_MAX_NEW_TOKENS = int(os.getenv("CASCADE_OCR_MAX_NEW_TOKENS", "4096"))
+    
+    # OCR per regioni: al modello vanno solo le fasce attorno alle parole chiave dei campi
+    OCR_ROI_CASCADE = os.getenv("OCR_ROI_CASCADE", "true").lower() == "true"  # usato dal livello Nanonets
+    OCR_ROI_MAX_NEW_TOKENS = int(os.getenv("OCR_ROI_MAX_NEW_TOKENS", "512"))  # per ritaglio
+    OCR_ROI_LINES_BELOW = int(os.getenv("OCR_ROI_LINES_BELOW", "2"))  # righe sotto la parola chiave incluse nel ritaglio
+    OCR_ROI_MAX_REGIONS = int(os.getenv("OCR_ROI_MAX_REGIONS", "8"))  # per pagina
+    
+    # Configurazione cache dei risultati (memoria LRU + disco)
+    CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+    CACHE_MEMORY_ITEMS = int(os.getenv("CACHE_MEMORY_ITEMS", "256"))
+    CACHE_DIR = os.getenv("CACHE_DIR", "./cache")
+    CACHE_DISK_MB = int(os.getenv("CACHE_DISK_MB", "500"))  # 0 = solo memoria
+    
+    # Lavori asincroni: coda persistente su SQLite, file in attesa e risultati conservati fino alla scadenza
+    JOBS_DB = os.getenv("JOBS_DB", "./jobs/lavori.sqlite3")
+    JOBS_DIR = os.getenv("JOBS_DIR", "./jobs/file")
+    JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))  # lavori elaborati insieme
+    JOBS_TTL = int(os.getenv("JOBS_TTL", "86400"))  # secondi di conservazione dei risultati
+    JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", "100"))  # lavori in attesa, 0 = illimitato
+    JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))  # avvii di un lavoro interrotto da riavvii
+    JOBS_MAX_WAIT = int(os.getenv("JOBS_MAX_WAIT", "60"))  # secondi massimi di long-poll
+    
     # Configurazione timeout
     OCR_TIMEOUT = int(os.getenv("OCR_TIMEOUT", "300"))  # secondi
     
+    # Configurazione esecuzione (pool separati per lavoro CPU e modelli)
+    CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+    MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "1"))
+    PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", "0"))  # 0 = disabilitato
+    MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "32"))  # richieste in attesa per pool, 0 = illimitato
+    BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", str(CPU_WORKERS)))  # coppie elaborate insieme dall'estrazione massiva
+    # Se i pool sono saturi una coppia dell'estrazione massiva riprova invece di fallire subito
+    BULK_BUSY_RETRIES = int(os.getenv("BULK_BUSY_RETRIES", "20"))
+    BULK_BUSY_RETRY_DELAY_MS = int(os.getenv("BULK_BUSY_RETRY_DELAY_MS", "500"))
+    LETTERS_MAX_BULK = int(os.getenv("LETTERS_MAX_BULK", "10000"))  # diffide per richiesta di /genera-diffida/bulk/
+
     # Debug mode
     DEBUG = os.getenv("DEBUG", "false").lower() == "true"
     
+    # Osservabilità: metriche Prometheus su /metrics e log strutturati
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "testo").lower()  # testo o json
+    
     @classmethod
     def get_cors_origins(cls) -> list:
         """Restituisce le origini CORS configurate"""
@@ -42,10 +164,127 @@ class Config:
         return any(filename.lower().endswith(ext) for ext in cls.ALLOWED_EXTENSIONS)
     
     @classmethod
-    def get_model_config(cls) -> dict:
-        """Restituisce la configurazione del modello"""
+    def get_upload_config(cls) -> dict:
+        """Restituisce i limiti di dimensione degli upload in byte"""
+        return {
+            "max_file_bytes": cls.MAX_FILE_SIZE * 1024 * 1024,
+            "max_request_bytes": cls.MAX_REQUEST_SIZE * 1024 * 1024,
+            "max_bulk_bytes": cls.MAX_BULK_SIZE * 1024 * 1024
+        }
+    
+    @classmethod
+    def get_page_order(cls, file_type: str) -> str:
+        """Restituisce l'ordine di visita delle pagine per il tipo di documento"""
+        return cls.PAGE_ORDER.get(file_type, "*")
+    
+    @classmethod
+    def get_model_config(cls, profile: Optional[str] = None) -> dict:
+        """Restituisce la configurazione del modello con il profilo di inferenza indicato (o quello configurato)"""
+        profile = profile or cls.INFERENCE_PROFILE
+        if profile not in cls.INFERENCE_PROFILES:
+            raise ValueError(f"Profilo di inferenza sconosciuto: {profile}")
+        preset = cls.INFERENCE_PROFILES[profile]
         return {
             "model_path": cls.MODEL_PATH,
-            "device": cls.DEVICE,
-            "timeout": cls.OCR_TIMEOUT
-        } 
\ No newline at end of file
+            "device": cls.DEVICE if cls.DEVICE != "auto" else preset["device"],
+            "timeout": cls.OCR_TIMEOUT,
+            "profile": profile,
+            "attn_implementation": cls.ATTN_IMPLEMENTATION or preset["attn_implementation"],
+            "dtype": cls.MODEL_DTYPE or preset["dtype"],
+            "compile": cls.TORCH_COMPILE,
+            "intra_op_threads": cls.TORCH_THREADS,
+            "inter_op_threads": cls.TORCH_INTEROP_THREADS
+        }
+
+    @classmethod
+    def get_executor_config(cls) -> dict:
+        """Restituisce la configurazione dei pool di esecuzione"""
+        return {
+            "cpu_workers": cls.CPU_WORKERS,
+            "model_workers": cls.MODEL_WORKERS,
+            "process_workers": cls.PROCESS_WORKERS,
+            "max_queue_size": cls.MAX_QUEUE_SIZE
+        }
+    
+    @classmethod
+    def get_registry_config(cls) -> dict:
+        """Restituisce la configurazione del registro dei modelli"""
+        return {
+            "memory_budget_mb": cls.MODEL_MEMORY_BUDGET_MB,
+            "idle_timeout": cls.MODEL_IDLE_TIMEOUT,
+            "warmup": cls.WARMUP_ENABLED
+        }
+    
+    @classmethod
+    def get_generation_config(cls) -> dict:
+        """Restituisce i parametri della stima adattiva dei token da generare"""
+        return {
+            "minimo": cls.OCR_MIN_NEW_TOKENS,
+            "token_per_carattere": cls.OCR_TOKENS_PER_CHAR,
+            "token_per_mpx_inchiostro": cls.OCR_TOKENS_PER_INK_MPX,
+            "margine": cls.OCR_TOKEN_MARGIN
+        }
+    
+    @classmethod
+    def get_backend(cls, ruolo: str, file_type: Optional[str] = None) -> str:
+        """Restituisce il backend del ruolo ("layout" o "ocr") per il tipo di documento, o quello predefinito"""
+        predefinito = cls.LAYOUT_BACKEND if ruolo == "layout" else cls.OCR_BACKEND
+        return cls.BACKENDS[ruolo].get(file_type, predefinito)
+    
+    @classmethod
+    def get_fake_backend_config(cls) -> dict:
+        """Restituisce latenze e testo del backend finto"""
+        return {
+            "latenza_ms": cls.FAKE_OCR_LATENCY_MS,
+            "ms_per_token": cls.FAKE_OCR_MS_PER_TOKEN,
+            "secondi_caricamento": cls.FAKE_OCR_LOAD_SECONDS,
+            "file_testo": cls.FAKE_OCR_TEXT or None
+        }
+    
+    @classmethod
+    def get_batching_config(cls) -> dict:
+        """Restituisce la configurazione del micro-batching OCR"""
+        return {
+            "enabled": cls.OCR_MICROBATCH_ENABLED,
+            "max_batch_size": cls.OCR_MICROBATCH_MAX_SIZE,
+            "max_wait_ms": cls.OCR_MICROBATCH_MAX_WAIT_MS,
+            "slots": cls.MODEL_WORKERS
+        }
+    
+    @classmethod
+    def get_roi_config(cls) -> dict:
+        """Restituisce la configurazione dei ritagli per l'OCR per regioni"""
+        return {
+            "righe_sotto": cls.OCR_ROI_LINES_BELOW,
+            "max_regioni": cls.OCR_ROI_MAX_REGIONS
+        }
+    
+    @classmethod
+    def get_jobs_config(cls) -> dict:
+        """Restituisce la configurazione della coda dei lavori asincroni"""
+        return {
+            "db_path": cls.JOBS_DB,
+            "dir_file": cls.JOBS_DIR,
+            "workers": cls.JOBS_WORKERS,
+            "ttl": cls.JOBS_TTL,
+            "max_in_coda": cls.JOBS_MAX_QUEUED,
+            "max_tentativi": cls.JOBS_MAX_ATTEMPTS
+        }
+    
+    @classmethod
+    def get_log_config(cls) -> dict:
+        """Restituisce livello e formato dei log"""
+        return {
+            "livello": cls.LOG_LEVEL,
+            "formato": cls.LOG_FORMAT
+        }
+    
+    @classmethod
+    def get_cache_config(cls) -> dict:
+        """Restituisce la configurazione della cache dei risultati"""
+        return {
+            "enabled": cls.CACHE_ENABLED,
+            "memory_items": cls.CACHE_MEMORY_ITEMS,
+            "disk_dir": cls.CACHE_DIR,
+            "disk_max_mb": cls.CACHE_DISK_MB
+        }
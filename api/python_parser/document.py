@@ -0,0 +1,179 @@
+import io
+import mmap
+import os
+import pathlib
+import re
+from contextlib import contextmanager
+import pdfplumber
+from pdfplumber.display import DEFAULT_RESOLUTION, get_page_image
+from metrics import metriche
+
+
+class DocumentoPDF:
+    """PDF caricato aperto una sola volta e condiviso tra le fasi di estrazione.
+
+    Il testo delle pagine viene estratto solo quando richiesto e conservato in
+    cache, così PDF-Extract-Kit, il fallback regex e Nanonets-OCR-s non
+    riaprono né rileggono lo stesso upload. Le immagini invece non vengono
+    conservate: si renderizzano una pagina alla volta e si liberano dopo l'uso.
+
+    I file su disco vengono mappati in memoria: le pagine lette stanno nella
+    page cache del sistema e non nella memoria del processo, quindi la RSS
+    non cresce con la dimensione del PDF.
+    """
+
+    def __init__(self, source):
+        self._file = None
+        self._mappa = None
+        if isinstance(source, (str, os.PathLike)):
+            self._file = open(source, "rb")
+            try:
+                self._mappa = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                # pdfminer legge dalla mappa; il rendering (pypdfium2) apre il file dal percorso
+                self._pdf = pdfplumber.PDF(self._mappa, stream_is_external=True, path=pathlib.Path(source))
+            except Exception:
+                self._chiudi_file()
+                raise
+        else:
+            if isinstance(source, (bytes, bytearray)):
+                source = io.BytesIO(source)
+            elif hasattr(source, "seek"):
+                # Lo stream potrebbe essere già stato letto da un'altra fase
+                source.seek(0)
+            self._pdf = pdfplumber.open(source)
+        self._testi = {}
+
+    @property
+    def num_pagine(self) -> int:
+        return len(self._pdf.pages)
+
+    def pagina(self, indice: int):
+        """Restituisce la pagina pdfplumber (indice da 0)"""
+        return self._pdf.pages[indice]
+
+    def testo_pagina(self, indice: int) -> str:
+        """Testo della pagina, estratto alla prima richiesta"""
+        if indice not in self._testi:
+            pagina = self.pagina(indice)
+            self._testi[indice] = pagina.extract_text() or ""
+            # Libera gli oggetti di layout: il testo resta in cache
+            pagina.close()
+        return self._testi[indice]
+
+    def parole_pagina(self, indice: int):
+        """Parole con riquadro della pagina, larghezza e altezza in punti (non conservate in cache)"""
+        pagina = self.pagina(indice)
+        parole = pagina.extract_words()
+        dimensioni = (pagina.width, pagina.height)
+        pagina.close()
+        return (parole, *dimensioni)
+
+    def ha_testo(self, indice: int, min_caratteri: int = 30) -> bool:
+        """La pagina ha uno strato di testo utilizzabile (PDF nativo, non scansione)"""
+        testo = self.testo_pagina(indice)
+        return len(testo) - testo.count(" ") - testo.count("\n") >= min_caratteri
+
+    def testo_completo(self) -> str:
+        """Testo concatenato di tutte le pagine"""
+        return "".join(self.testo_pagina(i) for i in range(self.num_pagine))
+
+    def immagine_pagina(self, indice: int, resolution: int = None):
+        """Renderizza la pagina come immagine PIL RGB (non conservata in cache).
+
+        Usa direttamente il rasterizzatore di pdfplumber: to_image creerebbe anche
+        una copia annotabile della pagina, inutile per l'OCR.
+        """
+        pagina = self.pagina(indice)
+        with metriche.fase("rendering"):
+            if pagina.bbox != pagina.cropbox:
+                return pagina.to_image(resolution=resolution).original
+            return get_page_image(
+                stream=self._pdf.stream, path=self._pdf.path, page_ix=indice,
+                resolution=resolution or DEFAULT_RESOLUTION, password=self._pdf.password
+            )
+
+    def rasterizza_pagine(self, ordine=None, resolution: int = None):
+        """Generatore di (indice, immagine) che renderizza una pagina solo quando viene richiesta.
+
+        L'ordine è una specifica come "1-4,*" oppure una lista di indici.
+        Interrompere l'iterazione evita il rendering delle pagine restanti.
+        """
+        indici = ordine if isinstance(ordine, (list, tuple)) else ordine_pagine(ordine, self.num_pagine)
+        for indice in indici:
+            immagine = self.immagine_pagina(indice, resolution=resolution)
+            yield indice, immagine
+            del immagine
+
+    def _chiudi_file(self):
+        if self._mappa is not None:
+            self._mappa.close()
+            self._mappa = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self._testi.clear()
+        self._pdf.close()
+        self._chiudi_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def ordine_pagine(spec: str, num_pagine: int, rigoroso: bool = False) -> list:
+    """Converte una specifica come "1-3,-1,*" in una lista di indici di pagina (da 0).
+
+    I numeri partono da 1, quelli negativi contano dalla fine, "a-b" è un
+    intervallo e "*" aggiunge le pagine non ancora elencate. Le pagine
+    ripetute vengono ignorate; senza "*" le pagine non elencate non vengono
+    visitate. Voci vuote o non numeriche e la pagina 0 sollevano ValueError;
+    le pagine inesistenti vengono ignorate (l'ordine configurato vale per
+    documenti di qualunque lunghezza) o, con rigoroso=True, sollevano ValueError.
+    """
+    if not spec:
+        return list(range(num_pagine))
+
+    def indice(numero):
+        numero = int(numero)
+        if numero == 0:
+            raise ValueError("le pagine partono da 1 (o da -1 per l'ultima)")
+        posizione = numero - 1 if numero > 0 else num_pagine + numero
+        if rigoroso and not 0 <= posizione < num_pagine:
+            raise ValueError(f"pagina {numero} inesistente, il documento ha {num_pagine} pagine")
+        return posizione
+
+    ordine = []
+    visitate = set()
+    for token in (t.strip() for t in spec.split(",")):
+        if not token:
+            raise ValueError(f"voce vuota in '{spec}'")
+        intervallo = re.fullmatch(r"(-?\d+)-(-?\d+)", token)
+        if token == "*":
+            candidati = range(num_pagine)
+        elif intervallo:
+            candidati = range(indice(intervallo.group(1)), indice(intervallo.group(2)) + 1)
+            if rigoroso and not candidati:
+                raise ValueError(f"intervallo vuoto '{token}'")
+        elif re.fullmatch(r"-?\d+", token):
+            candidati = [indice(token)]
+        else:
+            raise ValueError(f"voce non valida '{token}'")
+        for i in candidati:
+            if 0 <= i < num_pagine and i not in visitate:
+                visitate.add(i)
+                ordine.append(i)
+    return ordine
+
+
+@contextmanager
+def apri_documento(source):
+    """Riusa un DocumentoPDF esistente oppure ne apre uno nuovo e lo chiude all'uscita"""
+    if isinstance(source, DocumentoPDF):
+        yield source
+        return
+    with DocumentoPDF(source) as documento:
+        yield documento
@@ -0,0 +1,155 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import Config
+
+
+class ExecutorBusyError(Exception):
+    """Sollevata quando la coda di un pool ha raggiunto il limite configurato"""
+
+
+class ExecutionLayer:
+    """Esegue il lavoro bloccante (parsing PDF, inferenza modelli) fuori dall'event loop.
+
+    Mantiene pool separati con limiti indipendenti:
+    - "cpu": thread per pdfplumber, regex e generazione PDF
+    - "model": thread per le chiamate ai modelli (torch rilascia il GIL)
+    - "process": processi per funzioni CPU-bound serializzabili (opzionale)
+    """
+
+    POOLS = ("cpu", "model", "process")
+
+    def __init__(self, cpu_workers: int, model_workers: int, process_workers: int, max_queue_size: int):
+        self.workers = {
+            "cpu": max(1, cpu_workers),
+            "model": max(1, model_workers),
+            "process": max(0, process_workers),
+        }
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._stats = {
+            name: {"queued": 0, "in_flight": 0, "completed": 0, "failed": 0, "rejected": 0}
+            for name in self.POOLS
+        }
+        self._executors = {}
+
+    def _get_executor(self, pool: str):
+        """Crea il pool alla prima richiesta"""
+        with self._lock:
+            executor = self._executors.get(pool)
+            if executor is None:
+                if pool == "process":
+                    executor = ProcessPoolExecutor(max_workers=self.workers["process"])
+                else:
+                    executor = ThreadPoolExecutor(
+                        max_workers=self.workers[pool],
+                        thread_name_prefix=f"{pool}-worker"
+                    )
+                self._executors[pool] = executor
+            return executor
+
+    def _enqueue(self, pool: str):
+        with self._lock:
+            stats = self._stats[pool]
+            if self.max_queue_size > 0 and stats["queued"] >= self.max_queue_size:
+                stats["rejected"] += 1
+                raise ExecutorBusyError(f"Coda '{pool}' piena ({stats['queued']} richieste in attesa)")
+            stats["queued"] += 1
+
+    def _start(self, pool: str):
+        with self._lock:
+            self._stats[pool]["queued"] -= 1
+            self._stats[pool]["in_flight"] += 1
+
+    def _finish(self, pool: str, failed: bool):
+        with self._lock:
+            self._stats[pool]["in_flight"] -= 1
+            self._stats[pool]["failed" if failed else "completed"] += 1
+
+    def _tracked(self, pool, func, *args, **kwargs):
+        """Wrapper eseguito nel thread worker: aggiorna i contatori"""
+        self._start(pool)
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._finish(pool, failed)
+
+    async def run(self, pool: str, func, *args, **kwargs):
+        """Esegue func(*args, **kwargs) nel pool indicato e ne attende il risultato"""
+        if pool not in self.POOLS:
+            raise ValueError(f"Pool sconosciuto: {pool}")
+        if pool == "process" and self.workers["process"] == 0:
+            # Pool di processi disabilitato: ripiega sui thread CPU
+            pool = "cpu"
+
+        self._enqueue(pool)
+        loop = asyncio.get_running_loop()
+
+        if pool == "process":
+            # Le funzioni passate ai processi devono essere serializzabili:
+            # i contatori vengono aggiornati dal processo principale, quindi
+            # in_flight include anche i task in attesa di un processo libero
+            self._start(pool)
+            failed = True
+            try:
+                result = await loop.run_in_executor(
+                    self._get_executor(pool), functools.partial(func, *args, **kwargs)
+                )
+                failed = False
+                return result
+            finally:
+                self._finish(pool, failed)
+
+        return await loop.run_in_executor(
+            self._get_executor(pool), functools.partial(self._tracked, pool, func, *args, **kwargs)
+        )
+
+    def run_sync(self, pool: str, func, *args, **kwargs):
+        """Esegue func nel pool indicato da un thread worker e ne attende il risultato.
+
+        Serve al lavoro che gira già in un pool (es. "cpu") e deve passare per
+        un altro (es. "model") rispettandone limiti e contatori. Non usare per
+        attendere lo stesso pool in cui si è in esecuzione.
+        """
+        if pool not in ("cpu", "model"):
+            raise ValueError(f"Pool non supportato in modalità sincrona: {pool}")
+        self._enqueue(pool)
+        try:
+            future = self._get_executor(pool).submit(self._tracked, pool, func, *args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self._stats[pool]["queued"] -= 1
+            raise
+        return future.result()
+
+    async def run_cpu(self, func, *args, **kwargs):
+        return await self.run("cpu", func, *args, **kwargs)
+
+    async def run_model(self, func, *args, **kwargs):
+        return await self.run("model", func, *args, **kwargs)
+
+    async def run_process(self, func, *args, **kwargs):
+        return await self.run("process", func, *args, **kwargs)
+
+    def stats(self) -> dict:
+        """Restituisce profondità delle code e richieste in corso per ogni pool"""
+        with self._lock:
+            return {
+                name: {"workers": self.workers[name], **dict(self._stats[name])}
+                for name in self.POOLS
+            }
+
+    def shutdown(self, wait: bool = True):
+        """Chiude tutti i pool creati"""
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors = {}
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
+
+execution_layer = ExecutionLayer(**Config.get_executor_config())
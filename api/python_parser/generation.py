@@ -0,0 +1,108 @@
+import threading
+from collections import Counter, deque
+import numpy as np
+import torch
+from transformers import StoppingCriteria
+from cascade import campi_mancanti
+from rules import estrai_campi
+
+
+def stima_max_new_tokens(image, testo: str = None, massimo: int = 4096, minimo: int = 128,
+                         token_per_carattere: float = 0.5, token_per_mpx_inchiostro: int = 2000,
+                         margine: float = 1.5) -> int:
+    """Stima quanti token servono per trascrivere la pagina.
+
+    Se la pagina ha uno strato di testo si parte dal numero di caratteri,
+    altrimenti dalla quantità di "inchiostro" (pixel scuri) dell'immagine,
+    misurata su una copia ridotta. Il margine copre markup HTML e LaTeX.
+    """
+    if testo and testo.strip():
+        stima = len(testo) * token_per_carattere
+    else:
+        ridotta = image.convert("L")
+        ridotta.thumbnail((256, 256))
+        inchiostro = float((np.asarray(ridotta) < 200).mean())
+        stima = inchiostro * image.width * image.height / 1_000_000 * token_per_mpx_inchiostro
+    return int(max(minimo, min(massimo, stima * margine)))
+
+
+class CriterioArresto(StoppingCriteria):
+    """Ferma ogni riga del batch al proprio limite di token e, se è indicato il tipo
+    di documento, appena le regole trovano tutti i campi richiesti nell'output parziale.
+
+    Il controllo dei campi decodifica l'output ogni `ogni` token e considera solo
+    le righe già concluse, per non accettare un valore troncato (es. "1.2" di "1.234,56").
+    Restituisce un booleano per riga: serve lo StoppingCriteriaList per sequenza di
+    transformers >= 4.39 (le versioni precedenti non accettano batch con più righe).
+    """
+
+    def __init__(self, tokenizer, lunghezza_prompt: int, limiti, file_type: str = None, ogni: int = 32):
+        self.tokenizer = tokenizer
+        self.lunghezza_prompt = lunghezza_prompt
+        self.limiti = list(limiti)
+        self.file_type = file_type
+        self.ogni = max(1, ogni)
+        self.fermati_per_campi = set()
+        self._fine = {tokenizer.pad_token_id, tokenizer.eos_token_id} - {None}
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generati = input_ids.shape[1] - self.lunghezza_prompt
+        fermi = torch.tensor([generati >= limite for limite in self.limiti], device=input_ids.device)
+        if self.file_type is None or generati == 0 or generati % self.ogni:
+            return fermi
+
+        for riga in range(input_ids.shape[0]):
+            # Righe già concluse (EOS o padding) o già fermate non vanno ricontrollate
+            if fermi[riga] or riga in self.fermati_per_campi or int(input_ids[riga, -1]) in self._fine:
+                continue
+            testo = self.tokenizer.decode(input_ids[riga, self.lunghezza_prompt:], skip_special_tokens=True)
+            testo = testo[:testo.rfind("\n") + 1]
+            if testo and not campi_mancanti(estrai_campi(self.file_type, testo), self.file_type):
+                self.fermati_per_campi.add(riga)
+        for riga in self.fermati_per_campi:
+            fermi[riga] = True
+        return fermi
+
+    def motivo(self, riga: int, token: int) -> str:
+        """Perché la generazione della riga è terminata: campi, limite o eos"""
+        if riga in self.fermati_per_campi:
+            return "campi"
+        if token >= self.limiti[riga]:
+            return "limite"
+        return "eos"
+
+
+class StatisticheToken:
+    """Token generati per pagina, per calibrare i limiti adattivi"""
+
+    def __init__(self, campioni: int = 1000):
+        self._lock = threading.Lock()
+        self._token = deque(maxlen=campioni)
+        self._utilizzo = deque(maxlen=campioni)  # token generati / limite
+        self._motivi = Counter()
+        self._pagine = 0
+        self._totale = 0
+
+    def registra(self, token: int, limite: int, motivo: str):
+        with self._lock:
+            self._token.append(token)
+            self._utilizzo.append(token / limite if limite else 0)
+            self._motivi[motivo] += 1
+            self._pagine += 1
+            self._totale += token
+
+    def stats(self) -> dict:
+        with self._lock:
+            token = np.array(self._token) if self._token else np.zeros(1)
+            return {
+                "pages": self._pagine,
+                "tokens_total": self._totale,
+                "tokens_p50": int(np.percentile(token, 50)),
+                "tokens_p95": int(np.percentile(token, 95)),
+                "tokens_max": int(token.max()),
+                "budget_used_avg": round(float(np.mean(self._utilizzo)), 3) if self._utilizzo else 0,
+                "stop_reasons": dict(self._motivi),
+            }
+
+
+statistiche_token = StatisticheToken()
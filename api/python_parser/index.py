@@ -1,20 +1,41 @@
-import io
-import re
 import os
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import Response
+import asyncio
+import time
+import zipfile
+from typing import List
+from fastapi import Body, FastAPI, File, Form, UploadFile, HTTPException
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-import pdfplumber
-from fpdf import FPDF
 import json
 from huggingface_hub import snapshot_download
 import torch
-from transformers import AutoProcessor, AutoModel, AutoTokenizer, AutoModelForImageTextToText
+from transformers import AutoProcessor, AutoModel, AutoModelForImageTextToText, StoppingCriteriaList, LogitsProcessorList
 from PIL import Image
-import cv2
 import numpy as np
-from tempfile import NamedTemporaryFile
+import psutil
 from config import Config
+from executor import execution_layer, ExecutorBusyError
+from document import DocumentoPDF, apri_documento, ordine_pagine
+from cache import risultati_cache, chiave_cache, sha256_file
+from rules import estrai_campi, VERSIONE_REGOLE
+from registry import registro_modelli
+from backends import BackendOCR, backend_finto, TESTO, JSON, BATCH, ARRESTO_CAMPI, LAYOUT
+from batching import MicroBatcherOCR
+from cascade import CascataEstrazione, ErroreCascata, Livello, campi_mancanti
+from roi import immagini_roi, ritaglia_contenuto
+from generation import CriterioArresto, stima_max_new_tokens, statistiche_token
+from schema import VincoloJSON, converti_json, prompt_json
+from uploads import LimiteRichiesta, UploadRifiutato, salva_upload, rimuovi
+from bulk import abbina_coppie, contenuto_archivio, estrai_membro, leggi_manifest
+from jobs import CodaLavori, CodaLavoriPiena
+from refunds import METODI, rimborsi_portafoglio, scrivi_csv
+from letters import archivio_zip, modello_diffida, nome_file_lettera, rendi_lotto, unisci_pdf, valori_diffida
+from inference import configura_thread, risolvi_attention, dtype_pesi, ottimizza, contesto_inferenza, descrivi
+from logs import configura_log, get_logger
+from metrics import MetricheRichieste, metriche
+
+configura_log(**Config.get_log_config())
+log = get_logger("api")
 
 app = FastAPI(
     title="PDF Parser API con Nanonets-OCR-s", 
@@ -30,153 +51,302 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Le richieste oltre il limite vengono respinte prima di leggere il corpo
+app.add_middleware(
+    LimiteRichiesta,
+    max_bytes=Config.get_upload_config()["max_request_bytes"],
+    limiti_percorso={"/estrai-dati/bulk/": Config.get_upload_config()["max_bulk_bytes"]}
+)
+# Più esterno di tutti: misura anche le richieste respinte dal limite
+app.add_middleware(MetricheRichieste, metriche=metriche)
 
-# Variabili globali per il modello
-model = None
-processor = None
-
-# === Nanonets-OCR-s ===
-nanonets_model = None
-nanonets_processor = None
+# === Modelli ===
+# I backend (PDF-Extract-Kit, Nanonets-OCR-s o quello finto) vengono caricati, condivisi e scaricati dal registro
 
-async def load_pdf_extract_model():
-    """Carica il modello PDF-Extract-Kit"""
-    global model, processor
+def load_pdf_extract_model(model_config=None):
+    """Carica il modello PDF-Extract-Kit con il profilo di inferenza configurato"""
+    model_config = model_config or Config.get_model_config()
+    configura_thread(model_config)
     
-    if model is None:
-        try:
-            print("Caricamento modello PDF-Extract-Kit...")
-            
-            # Scarica il modello se non esiste
-            model_path = "./pdf_extract_model"
-            if not os.path.exists(model_path):
-                print("Download del modello PDF-Extract-Kit...")
-                snapshot_download(
-                    repo_id='opendatalab/pdf-extract-kit-1.0', 
-                    local_dir=model_path, 
-                    max_workers=20
-                )
-            
-            # Carica il modello e il processor
-            model = AutoModel.from_pretrained(model_path)
-            processor = AutoProcessor.from_pretrained(model_path)
-            
-            print("Modello PDF-Extract-Kit caricato con successo!")
-            
-        except Exception as e:
-            print(f"Errore caricamento modello: {e}")
-            # Fallback al metodo tradizionale
-            model = None
-            processor = None
-
-def load_nanonets_model():
-    global nanonets_model, nanonets_processor
-    if nanonets_model is None or nanonets_processor is None:
-        model_config = Config.get_model_config()
-        model_path = model_config["model_path"]
-        device = model_config["device"]
-        
-        print(f"Caricamento modello Nanonets-OCR-s da: {model_path}")
-        print(f"Device configurato: {device}")
-        
-        nanonets_model = AutoModelForImageTextToText.from_pretrained(
-            model_path, 
-            torch_dtype="auto", 
-            device_map=device, 
-            attn_implementation="flash_attention_2"
+    # Scarica il modello se non esiste
+    model_path = "./pdf_extract_model"
+    if not os.path.exists(model_path):
+        log.info("Download del modello PDF-Extract-Kit...")
+        registro_modelli.imposta_stato("pdf_extract_kit", "download")
+        snapshot_download(
+            repo_id='opendatalab/pdf-extract-kit-1.0', 
+            local_dir=model_path, 
+            max_workers=20
         )
-        nanonets_model.eval()
-        nanonets_processor = AutoProcessor.from_pretrained(model_path)
-        
-        print("Modello Nanonets-OCR-s caricato con successo!")
-
-def ocr_page_with_nanonets_s(image_path, max_new_tokens=4096):
-    load_nanonets_model()
-    prompt = ("Extract the text from the above document as if you were reading it naturally. "
-              "Return the tables in html format. Return the equations in LaTeX representation. "
-              "If there is an image in the document and image caption is not present, add a small description of the image inside the <img></img> tag; "
-              "otherwise, add the image caption inside <img></img>. Watermarks should be wrapped in brackets. "
-              "Ex: <watermark>OFFICIAL COPY</watermark>. Page numbers should be wrapped in brackets. "
-              "Ex: <page_number>14</page_number> or <page_number>9/22</page_number>. Prefer using ☐ and ☑ for check boxes.")
-    image = Image.open(image_path)
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": [
-            {"type": "image", "image": f"file://{image_path}"},
-            {"type": "text", "text": prompt},
-        ]},
-    ]
-    text = nanonets_processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = nanonets_processor(text=[text], images=[image], padding=True, return_tensors="pt")
+    
+    # Carica il modello e il processor
+    registro_modelli.imposta_stato("pdf_extract_kit", "caricamento")
+    # I pesi restano in float32: bf16 viene applicato con autocast durante l'inferenza
+    model = ottimizza(AutoModel.from_pretrained(model_path), model_config)
+    processor = AutoProcessor.from_pretrained(model_path)
+    
+    log.info("Modello PDF-Extract-Kit caricato con successo!")
+    return model, processor
+
+def load_nanonets_model(model_config=None):
+    """Carica Nanonets-OCR-s con il profilo di inferenza configurato"""
+    registro_modelli.imposta_stato("nanonets", "caricamento")
+    model_config = model_config or Config.get_model_config()
+    model_path = model_config["model_path"]
+    device = model_config["device"]
+    configura_thread(model_config)
+    
+    log.info("Caricamento modello Nanonets-OCR-s da: %s", model_path)
+    log.info("Inferenza: %s", descrivi(model_config))
+    
+    nanonets_model = AutoModelForImageTextToText.from_pretrained(
+        model_path, 
+        torch_dtype=dtype_pesi(model_config), 
+        device_map=device, 
+        attn_implementation=risolvi_attention(model_config)
+    )
+    nanonets_model = ottimizza(nanonets_model, model_config)
+    nanonets_processor = AutoProcessor.from_pretrained(model_path)
+    # Padding a sinistra: nei batch la generazione parte dalla fine di ogni prompt
+    nanonets_processor.tokenizer.padding_side = "left"
+    
+    log.info("Modello Nanonets-OCR-s caricato con successo!")
+    return nanonets_model, nanonets_processor
+
+def warmup_pdf_extract_model(risorse):
+    """Inferenza di prova su una pagina bianca per inizializzare kernel e allocatori"""
+    model, processor = risorse
+    inputs = processor(images=Image.new("RGB", (612, 792), "white"), return_tensors="pt")
+    with torch.no_grad(), contesto_inferenza(Config.get_model_config()):
+        model(**inputs)
+
+def warmup_nanonets_model(risorse):
+    """Genera un token su una pagina bianca per inizializzare kernel e allocatori"""
+    nanonets_model, nanonets_processor = risorse
+    ocr_batch_nanonets(nanonets_model, nanonets_processor, [Image.new("RGB", (640, 640), "white")], max_new_tokens=1)
+
+def elabora_pdf_extract_kit(risorse, immagini, limiti=None, file_type=None, modalita="testo"):
+    """Una inferenza di PDF-Extract-Kit per immagine: i risultati contengono il testo strutturato"""
+    model, processor = risorse
+    return [inferenza_pdf_extract_kit(model, processor, immagine) for immagine in immagini]
+
+def elabora_nanonets(risorse, immagini, limiti, file_type=None, modalita="testo"):
+    """Le immagini in una sola generate di Nanonets-OCR-s"""
+    nanonets_model, nanonets_processor = risorse
+    return ocr_batch_nanonets(nanonets_model, nanonets_processor, immagini, limiti, file_type, modalita)
+
+# Costi indicativi (secondi per pagina a 300 dpi, memoria dei pesi), riportati su /health
+BACKENDS = {
+    "pdf_extract_kit": BackendOCR(
+        "pdf_extract_kit", load_pdf_extract_model, elabora_pdf_extract_kit, warmup_pdf_extract_model,
+        capacita=(LAYOUT,), costo={"secondi_pagina_cpu": 2.0, "secondi_pagina_gpu": 0.2, "memoria_mb": 1500}
+    ),
+    "nanonets": BackendOCR(
+        "nanonets", load_nanonets_model, elabora_nanonets, warmup_nanonets_model,
+        capacita=(TESTO, JSON, BATCH, ARRESTO_CAMPI),
+        costo={"secondi_pagina_cpu": 60.0, "secondi_pagina_gpu": 3.0, "memoria_mb": 8000}
+    ),
+    "finto": backend_finto(**Config.get_fake_backend_config()),
+}
+
+def backend(ruolo, file_type=None):
+    """Backend configurato per il ruolo ("layout" o "ocr") e il tipo di documento"""
+    return BACKENDS[Config.get_backend(ruolo, file_type)]
+
+def nomi_backend(ruolo):
+    """Backend usati nel ruolo, per qualunque tipo di documento"""
+    return sorted({Config.get_backend(ruolo), *Config.BACKENDS[ruolo].values()})
+
+for ruolo, richiesta in (("layout", LAYOUT), ("ocr", TESTO)):
+    for nome in nomi_backend(ruolo):
+        if nome not in BACKENDS:
+            raise ValueError(f"Backend non supportato per il ruolo {ruolo}: {nome}")
+        if not BACKENDS[nome].supporta(richiesta):
+            raise ValueError(f"Il backend {nome} non può svolgere il ruolo {ruolo}")
+
+# Un PAGE_ORDER_* malformato blocca l'avvio invece di far fallire ogni estrazione
+for file_type in Config.PAGE_ORDER:
+    ordine_pagine(Config.get_page_order(file_type), 1)
+
+# I backend di layout si caricano all'avvio, quelli OCR solo se PRELOAD_NANONETS
+for nome, voce in BACKENDS.items():
+    if nome in nomi_backend("layout") or (Config.PRELOAD_NANONETS and nome in nomi_backend("ocr")):
+        stato = "in_attesa"
+    else:
+        stato = "su_richiesta"
+    registro_modelli.registra(nome, voce.carica, voce.warmup, stato=stato)
+
+def pdf_extract_kit_disponibile(file_type=None):
+    """Il backend di layout è stato caricato almeno una volta e non è in errore.
+
+    Prima del caricamento iniziale e dopo un errore l'estrazione usa il testo del PDF;
+    se è stato scaricato per inattività viene ricaricato alla prima richiesta.
+    """
+    return registro_modelli.stato(backend("layout", file_type).nome) in ("warmup", "pronto", "scaricato")
+
+NANONETS_PROMPT = ("Extract the text from the above document as if you were reading it naturally. "
+                   "Return the tables in html format. Return the equations in LaTeX representation. "
+                   "If there is an image in the document and image caption is not present, add a small description of the image inside the <img></img> tag; "
+                   "otherwise, add the image caption inside <img></img>. Watermarks should be wrapped in brackets. "
+                   "Ex: <watermark>OFFICIAL COPY</watermark>. Page numbers should be wrapped in brackets. "
+                   "Ex: <page_number>14</page_number> or <page_number>9/22</page_number>. Prefer using ☐ and ☑ for check boxes.")
+
+# Prompt già passati dal chat template: sono identici per ogni pagina
+nanonets_chat_text = {}
+
+def get_nanonets_chat_text(nanonets_processor, prompt=NANONETS_PROMPT):
+    """Applica il chat template una sola volta per prompt e riusa il risultato"""
+    if prompt not in nanonets_chat_text:
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": [
+                {"type": "image"},
+                {"type": "text", "text": prompt},
+            ]},
+        ]
+        nanonets_chat_text[prompt] = nanonets_processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return nanonets_chat_text[prompt]
+
+def scegli_batch_size(num_immagini):
+    """Sceglie quante pagine mettere in un batch in base alla memoria disponibile"""
+    if Config.OCR_BATCH_SIZE > 0:
+        return max(1, min(Config.OCR_BATCH_SIZE, num_immagini))
+    
+    risorse = registro_modelli.corrente(Config.get_backend("ocr"))
+    device = getattr(risorse[0], "device", None) if isinstance(risorse, tuple) else None
+    if torch.cuda.is_available() and device is not None and device.type == "cuda":
+        memoria_libera, _ = torch.cuda.mem_get_info(device)
+    else:
+        memoria_libera = psutil.virtual_memory().available
+    
+    per_pagina = Config.OCR_MEMORY_PER_PAGE_MB * 1024 * 1024
+    batch_size = int(memoria_libera // per_pagina)
+    return max(1, min(batch_size, Config.OCR_MAX_BATCH_SIZE, num_immagini))
+
+def immagine_rgb(image):
+    """Immagine PIL RGB da un'immagine PIL o da un array RGB (altezza, larghezza, 3), senza copie se è già RGB"""
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image.astype(np.uint8, copy=False), "RGB")
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+def ocr_batch_nanonets(nanonets_model, nanonets_processor, images, max_new_tokens, file_type=None, modalita="testo"):
+    """Una sola generate su un batch imbottito a sinistra: un risultato per immagine.
+
+    Le immagini (PIL o array RGB) passano direttamente al processor, senza file intermedi.
+    max_new_tokens è un limite unico o uno per immagine; con file_type ogni riga si
+    ferma appena le regole del tipo di documento trovano tutti i campi richiesti.
+    Ogni risultato contiene testo, token generati, limite e motivo di arresto.
+
+    Con modalita="json" il modello compila l'oggetto JSON dello schema del tipo di
+    documento, con decodifica vincolata: il limite è quello dello schema e il
+    risultato contiene anche i campi convertiti ("campi"), senza passare dalle regole.
+    """
+    json_mode = modalita == "json"
+    text = get_nanonets_chat_text(nanonets_processor, prompt_json(file_type) if json_mode else NANONETS_PROMPT)
+    batch = [immagine_rgb(image) for image in images]
+    inputs = nanonets_processor(text=[text] * len(batch), images=batch, padding=True, return_tensors="pt")
     inputs = inputs.to(nanonets_model.device)
-    output_ids = nanonets_model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
-    generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, output_ids)]
-    output_text = nanonets_processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-    return output_text[0]
+    # Con il padding a sinistra tutti i prompt terminano alla stessa colonna
+    lunghezza_prompt = inputs.input_ids.shape[1]
+    if json_mode:
+        vincolo = VincoloJSON(nanonets_processor.tokenizer, lunghezza_prompt, file_type)
+        processori = LogitsProcessorList([vincolo])
+        limiti = [vincolo.massimo_token] * len(images)
+    else:
+        processori = None
+        limiti = max_new_tokens if isinstance(max_new_tokens, (list, tuple)) else [max_new_tokens] * len(images)
+    criterio = CriterioArresto(
+        nanonets_processor.tokenizer, lunghezza_prompt, limiti,
+        file_type if Config.OCR_FIELD_STOP and not json_mode else None, Config.OCR_FIELD_STOP_EVERY
+    )
+    inizio = time.perf_counter()
+    with torch.no_grad(), metriche.fase("nanonets", modalita=modalita):
+        output_ids = nanonets_model.generate(
+            **inputs, max_new_tokens=max(limiti), do_sample=False,
+            stopping_criteria=StoppingCriteriaList([criterio]), logits_processor=processori
+        )
+    secondi = time.perf_counter() - inizio
+    generated_ids = output_ids[:, lunghezza_prompt:]
+    testi = nanonets_processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+    
+    pad = nanonets_processor.tokenizer.pad_token_id
+    risultati = []
+    for riga, testo in enumerate(testi):
+        token = int((generated_ids[riga] != pad).sum()) if pad is not None else generated_ids.shape[1]
+        motivo = criterio.motivo(riga, token)
+        statistiche_token.registra(token, limiti[riga], motivo)
+        risultato = {"text": testo, "tokens": token, "max_new_tokens": limiti[riga], "stop": motivo}
+        if json_mode:
+            risultato["campi"] = converti_json(testo, file_type)
+        risultati.append(risultato)
+    generati = sum(risultato["tokens"] for risultato in risultati)
+    metriche.incrementa("ocr_generated_tokens_total", generati)
+    metriche.incrementa("ocr_pages_total", len(risultati))
+    if secondi > 0:
+        metriche.osserva("ocr_tokens_per_second", generati / secondi)
+    return risultati
 
-def extract_data_with_pdf_extract_kit(pdf_file, file_type="contratto"):
-    """Estrae dati usando PDF-Extract-Kit"""
-    try:
-        if model is None or processor is None:
-            print("Modello non disponibile, uso fallback")
-            return None
-            
-        # Converti PDF in immagini
-        images = convert_pdf_to_images(pdf_file)
-        
-        extracted_data = {
-            "nome": "",
-            "cognome": "",
-            "codice_fiscale": "",
-            "data_nascita": "",
-            "luogo_nascita": "",
-            "costi_totali": 0.0,
-            "numero_rate": 0,
-            "durata_mesi": 0,
-            "rate_scadute": 0,
-            "data_chiusura": ""
-        }
-        
-        for i, image in enumerate(images):
-            print(f"Processando pagina {i+1} con PDF-Extract-Kit...")
-            
-            # Preprocessa l'immagine
-            inputs = processor(images=image, return_tensors="pt")
-            
-            # Esegui l'inferenza
-            with torch.no_grad():
-                outputs = model(**inputs)
-            
-            # Estrai i risultati
-            results = processor.decode(outputs)
-            
-            # Analizza i risultati per estrarre i dati
-            extracted_data = parse_pdf_extract_results(results, extracted_data, file_type)
-            
-            # Se abbiamo trovato tutti i dati necessari, fermiamoci
-            if all([extracted_data["nome"], extracted_data["codice_fiscale"], extracted_data["costi_totali"] > 0]):
-                break
-        
-        return extracted_data
-        
-    except Exception as e:
-        print(f"Errore PDF-Extract-Kit: {e}")
-        return None
+def ocr_pagine(images, max_new_tokens=4096, batch_size=None, file_type=None, modalita="testo"):
+    """Esegue OCR su più pagine con il backend OCR del tipo di documento, a batch:
+    un risultato (testo e token) per pagina, nello stesso ordine"""
+    if not images:
+        return []
+    
+    backend_ocr = backend("ocr", file_type)
+    limiti = max_new_tokens if isinstance(max_new_tokens, (list, tuple)) else [max_new_tokens] * len(images)
+    with registro_modelli.acquisisci(backend_ocr.nome) as risorse:
+        batch_size = batch_size or scegli_batch_size(len(images))
+        if not backend_ocr.supporta(BATCH):
+            batch_size = 1
+        risultati = []
+        for inizio in range(0, len(images), batch_size):
+            risultati.extend(backend_ocr.elabora(
+                risorse, images[inizio:inizio + batch_size], limiti[inizio:inizio + batch_size], file_type, modalita
+            ))
+        return risultati
+
+def ocr_pages_with_nanonets_s(images, max_new_tokens=4096, batch_size=None):
+    """Esegue OCR su più pagine con batch imbottiti: restituisce un testo per pagina, nello stesso ordine"""
+    return [risultato["text"] for risultato in ocr_pagine(images, max_new_tokens, batch_size)]
+
+def ocr_page_with_nanonets_s(image, max_new_tokens=4096):
+    """OCR di una pagina: immagine PIL, array RGB o percorso di un file immagine"""
+    if isinstance(image, (str, os.PathLike)):
+        image = apri_immagine(image)
+    return ocr_pages_with_nanonets_s([image], max_new_tokens=max_new_tokens, batch_size=1)[0]
+
+def limite_token(image, testo=None, massimo=4096):
+    """Limite di generazione per la pagina: stimato dalla densità se OCR_ADAPTIVE_TOKENS, altrimenti il massimo"""
+    if not Config.OCR_ADAPTIVE_TOKENS:
+        return massimo
+    return stima_max_new_tokens(image, testo, massimo=massimo, **Config.get_generation_config())
+
+def parametri_generazione():
+    """Parametri che cambiano il testo generato, da includere nelle chiavi di cache OCR"""
+    return {
+        "adattivo": Config.OCR_ADAPTIVE_TOKENS and Config.get_generation_config(),
+        "arresto_campi": Config.OCR_FIELD_STOP,
+    }
+
+async def esegui_batch_ocr(images, limiti, file_type):
+    """Esegue un micro-batch nel pool dei modelli con una sola forward pass"""
+    return await execution_layer.run_model(
+        ocr_pagine, images, max_new_tokens=limiti, batch_size=len(images), file_type=file_type
+    )
+
+# Scheduler davanti a Nanonets: raccoglie le pagine delle richieste concorrenti
+ocr_scheduler = MicroBatcherOCR(esegui_batch_ocr, limite_batch=scegli_batch_size, **Config.get_batching_config())
 
-def convert_pdf_to_images(pdf_file):
-    """Converte PDF in immagini"""
+def convert_pdf_to_images(documento, ordine=None, resolution=None):
+    """Converte PDF in immagini, una pagina alla volta.
+
+    Generatore di (indice_pagina, immagine): ogni pagina viene renderizzata solo
+    quando il consumatore la richiede e rilasciata al passo successivo.
+    """
     try:
-        images = []
-        with pdfplumber.open(pdf_file) as pdf:
-            for page in pdf.pages:
-                # Converti pagina in immagine
-                img = page.to_image()
-                pil_image = img.original
-                images.append(pil_image)
-        return images
+        yield from documento.rasterizza_pagine(ordine, resolution=resolution)
     except Exception as e:
-        print(f"Errore conversione PDF: {e}")
-        return []
+        log.error("Errore conversione PDF: %s", e)
 
 def parse_pdf_extract_results(results, extracted_data, file_type):
     """Analizza i risultati di PDF-Extract-Kit"""
@@ -194,177 +364,152 @@ def parse_pdf_extract_results(results, extracted_data, file_type):
         return extracted_data
         
     except Exception as e:
-        print(f"Errore parsing risultati: {e}")
+        log.error("Errore parsing risultati: %s", e)
         return extracted_data
 
 def extract_contract_data_from_results(results, data):
     """Estrae dati dal contratto usando i risultati di PDF-Extract-Kit"""
     try:
-        # Analizza il testo estratto per trovare i pattern
         text = results.get("text", "")
-        print(f"🔍 Testo estratto da PDF-Extract-Kit (primi 1000 char): {text[:1000]}")
-        
-        # Nome e cognome - pattern più flessibili
-        nome_patterns = [
-            r"COGNOME\s*:?\s*([A-Za-zÀ-ÖØ-öø-ÿ\s']+?)\s+NOME\s*:?\s*([A-Za-zÀ-ÖØ-öø-ÿ\s']+)",
-            r"TITOLARE\s*:?\s*([A-Za-zÀ-ÖØ-öø-ÿ\s']+?)\s+([A-Za-zÀ-ÖØ-öø-ÿ\s']+)",
-            r"CLIENTE\s*:?\s*([A-Za-zÀ-ÖØ-öø-ÿ\s']+?)\s+([A-Za-zÀ-ÖØ-öø-ÿ\s']+)",
-            r"([A-Za-zÀ-ÖØ-öø-ÿ\s']+?)\s+([A-Za-zÀ-ÖØ-öø-ÿ\s']+?)\s+CF\s*:?\s*[A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z]"
-        ]
-        
-        for pattern in nome_patterns:
-            nome_match = re.search(pattern, text, re.IGNORECASE)
-            if nome_match:
-                data["cognome"] = nome_match.group(1).strip()
-                data["nome"] = nome_match.group(2).strip()
-                print(f"✅ Nome estratto: {data['cognome']} {data['nome']}")
-                break
-        
-        # Codice fiscale - pattern più flessibile
-        cf_patterns = [
-            r"([A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z])",
-            r"CF\s*:?\s*([A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z])",
-            r"C\.?F\.?\s*:?\s*([A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z])"
-        ]
-        
-        for pattern in cf_patterns:
-            cf_match = re.search(pattern, text, re.IGNORECASE)
-            if cf_match:
-                data["codice_fiscale"] = cf_match.group(1).upper()
-                print(f"✅ Codice fiscale estratto: {data['codice_fiscale']}")
-                break
-        
-        # Data di nascita - pattern più specifici
-        data_patterns = [
-            r"nato\s*a\s*[^,]*\s*il\s*(\d{1,2}\/\d{1,2}\/\d{4})",
-            r"data\s*nascita\s*:?\s*(\d{1,2}\/\d{1,2}\/\d{4})",
-            r"nato\s*il\s*(\d{1,2}\/\d{1,2}\/\d{4})"
-        ]
-        
-        for pattern in data_patterns:
-            data_match = re.search(pattern, text, re.IGNORECASE)
-            if data_match:
-                data["data_nascita"] = data_match.group(1)
-                print(f"✅ Data nascita estratta: {data['data_nascita']}")
-                break
-        
-        # Luogo di nascita
-        luogo_patterns = [
-            r"nato\s*a\s*([^,]*?)\s*il",
-            r"luogo\s*nascita\s*:?\s*([A-Za-zÀ-ÖØ-öø-ÿ\s']+)"
-        ]
-        
-        for pattern in luogo_patterns:
-            luogo_match = re.search(pattern, text, re.IGNORECASE)
-            if luogo_match:
-                data["luogo_nascita"] = luogo_match.group(1).strip()
-                print(f"✅ Luogo nascita estratto: {data['luogo_nascita']}")
-                break
-        
-        # Costi totali - pattern più flessibili
-        costi_patterns = [
-            r"CT\s+€\s*([\d.,]+)\s+COSTI TOTALI",
-            r"COSTI TOTALI\s*:?\s*€?\s*([\d.,]+)",
-            r"TOTALE COSTI\s*:?\s*€?\s*([\d.,]+)",
-            r"([\d.,]+)\s*€\s*COSTI TOTALI",
-            r"COSTI\s*:?\s*€?\s*([\d.,]+)"
-        ]
-        
-        for pattern in costi_patterns:
-            costi_match = re.search(pattern, text, re.IGNORECASE)
-            if costi_match:
-                try:
-                    costi_str = costi_match.group(1).replace('.', '').replace(',', '.')
-                    data["costi_totali"] = float(costi_str)
-                    print(f"✅ Costi totali estratti: {data['costi_totali']} €")
-                    break
-                except ValueError:
-                    continue
-        
-        # Durata - pattern più flessibili
-        durata_patterns = [
-            r"DURATA\s*:?\s*(\d+)\s*MESI",
-            r"(\d+)\s*MESI\s*DI\s*DURATA",
-            r"DURATA\s*TOTALE\s*:?\s*(\d+)\s*MESI"
-        ]
-        
-        for pattern in durata_patterns:
-            durata_match = re.search(pattern, text, re.IGNORECASE)
-            if durata_match:
-                data["durata_mesi"] = int(durata_match.group(1))
-                data["numero_rate"] = int(durata_match.group(1))
-                print(f"✅ Durata estratta: {data['durata_mesi']} mesi")
-                break
-        
+        campi = estrai_campi("contratto", text)
+        data.update(campi)
+        log.debug("Campi estratti dal contratto: %s", sorted(campi))
         return data
         
     except Exception as e:
-        print(f"❌ Errore estrazione dati contratto: {e}")
+        log.error("Errore estrazione dati contratto: %s", e)
         return data
 
 def extract_statement_data_from_results(results, data):
     """Estrae dati dal conteggio usando i risultati di PDF-Extract-Kit"""
     try:
         text = results.get("text", "")
-        print(f"🔍 Testo estratto dal conteggio (primi 1000 char): {text[:1000]}")
-        
-        # Rate scadute - pattern più flessibili
-        rate_patterns = [
-            r"RATE\s*SCADUTE[^\d\n]*:?\s*\(?(\d{1,3})\s*MESI?",
-            r"(\d{1,3})\s*RATE\s*SCADUTE",
-            r"SCADUTE\s*:?\s*(\d{1,3})\s*RATE",
-            r"RATE\s*PAGATE\s*:?\s*(\d{1,3})",
-            r"(\d{1,3})\s*MESI?\s*SCADUTI"
-        ]
-        
-        for pattern in rate_patterns:
-            rate_match = re.search(pattern, text, re.IGNORECASE)
-            if rate_match:
-                data["rate_scadute"] = int(rate_match.group(1))
-                print(f"✅ Rate scadute estratte: {data['rate_scadute']}")
-                break
-        
-        # Data chiusura - pattern più flessibili
-        data_patterns = [
-            r"DATA\s*ELABORAZIONE\s*CONTEGGIO\s*ESTINTIVO\s*([\d\/]+)",
-            r"DATA\s*CHIUSURA\s*:?\s*([\d\/]+)",
-            r"ELABORATO\s*IL\s*([\d\/]+)",
-            r"DATA\s*:?\s*([\d\/]+)\s*CONTEGGIO"
-        ]
-        
-        for pattern in data_patterns:
-            data_match = re.search(pattern, text, re.IGNORECASE)
-            if data_match:
-                data["data_chiusura"] = data_match.group(1)
-                print(f"✅ Data chiusura estratta: {data['data_chiusura']}")
-                break
-        
+        campi = estrai_campi("conteggio", text)
+        data.update(campi)
+        log.debug("Campi estratti dal conteggio: %s", sorted(campi))
         return data
         
     except Exception as e:
-        print(f"❌ Errore estrazione dati conteggio: {e}")
+        log.error("Errore estrazione dati conteggio: %s", e)
         return data
 
+def pagine_da_escalare(documento, file_type):
+    """Pagine da passare ai modelli: prima quelle senza strato di testo, nell'ordine configurato"""
+    ordine = ordine_pagine(Config.get_page_order(file_type), documento.num_pagine)
+    scansioni = [i for i in ordine if not documento.ha_testo(i, Config.TEXT_LAYER_MIN_CHARS)]
+    if not Config.CASCADE_ESCALATE_TEXT_PAGES:
+        return scansioni
+    return scansioni + [i for i in ordine if i not in scansioni]
+
+def livello_testo(documento, file_type, dati):
+    """Regex sul testo incorporato delle pagine native: quasi gratuito"""
+    indici = [i for i in range(documento.num_pagine) if documento.ha_testo(i, Config.TEXT_LAYER_MIN_CHARS)]
+    testo = "".join(documento.testo_pagina(i) for i in indici)
+    log.debug("Testo %s (primi 500 char): %s", file_type, testo[:500])
+    return estrai_campi(file_type, testo), len(indici)
+
+def livello_pdf_extract_kit(documento, file_type, dati):
+    """Backend di layout (PDF-Extract-Kit) sulle pagine da escalare, fino a completare i campi richiesti"""
+    extracted_data = {}
+    pagine = 0
+    backend_layout = backend("layout", file_type)
+    with registro_modelli.acquisisci(backend_layout.nome) as risorse:
+        # Le pagine vengono renderizzate una alla volta
+        images = convert_pdf_to_images(documento, pagine_da_escalare(documento, file_type))
+        for i, image in images:
+            log.debug("Processando pagina %d con PDF-Extract-Kit...", i + 1)
+            pagine += 1
+            
+            # Inferenza nel pool dei modelli, che ne limita la concorrenza
+            results = execution_layer.run_sync("model", backend_layout.elabora, risorse, [image], None, file_type)[0]
+            
+            # Analizza i risultati per estrarre i dati
+            extracted_data = parse_pdf_extract_results(results, extracted_data, file_type)
+            
+            # Se abbiamo trovato tutti i dati necessari, fermiamoci:
+            # le pagine restanti non vengono nemmeno renderizzate
+            if not campi_mancanti({**dati, **extracted_data}, file_type):
+                images.close()
+                break
+    return extracted_data, pagine
+
+def inferenza_pdf_extract_kit(model, processor, image):
+    """Una pagina con PDF-Extract-Kit"""
+    # Preprocessa l'immagine
+    inputs = processor(images=image, return_tensors="pt")
+    
+    # Esegui l'inferenza
+    with torch.no_grad(), contesto_inferenza(Config.get_model_config()), metriche.fase("pdf_extract_kit"):
+        outputs = model(**inputs)
+    
+    # Estrai i risultati
+    return processor.decode(outputs)
+
+def livello_nanonets(documento, file_type, dati):
+    """OCR Nanonets sulle pagine da escalare, una alla volta, fino a completare i campi richiesti.
+
+    Con OCR_ROI_CASCADE il modello riceve solo i ritagli attorno alle parole chiave dei campi;
+    con OCR_EXTRACTION_MODE=json restituisce direttamente i campi in JSON, senza regex.
+    """
+    # Se il backend non supporta il JSON il livello trascrive il testo e applica le regole
+    json_mode = Config.OCR_EXTRACTION_MODE == "json" and backend("ocr", file_type).supporta(JSON)
+    modalita = "json" if json_mode else "testo"
+    campi = {}
+    pagine = 0
+    for i in pagine_da_escalare(documento, file_type):
+        if Config.OCR_ROI_CASCADE:
+            immagini = immagini_roi(documento, i, file_type, 300, **Config.get_roi_config())
+            limiti = [limite_token(immagine, massimo=Config.OCR_ROI_MAX_NEW_TOKENS) for immagine in immagini]
+        else:
+            immagini = [documento.immagine_pagina(i, resolution=300)]
+            limiti = [limite_token(immagini[0], documento.testo_pagina(i), Config.CASCADE_OCR_MAX_NEW_TOKENS)]
+        if not immagini:
+            continue
+        log.debug("Processando pagina %d con Nanonets-OCR-s (%d immagini)...", i + 1, len(immagini))
+        pagine += 1
+        risultati = execution_layer.run_sync(
+            "model", ocr_pagine, immagini, max_new_tokens=limiti, batch_size=len(immagini),
+            file_type=file_type, modalita=modalita
+        )
+        if json_mode:
+            trovati = {}
+            for risultato in reversed(risultati):
+                trovati.update(risultato["campi"])
+        else:
+            trovati = estrai_campi(file_type, "\n".join(risultato["text"] for risultato in risultati))
+        # I campi trovati nelle pagine precedenti hanno la precedenza
+        campi = {**trovati, **campi}
+        if not campi_mancanti({**dati, **campi}, file_type):
+            break
+    return campi, pagine
+
+def nanonets_disponibile(file_type=None):
+    """Il backend OCR entra nella cascata solo se è già stato caricato (precaricato o usato da /ocr-nanonets/)"""
+    return registro_modelli.stato(backend("ocr", file_type).nome) in ("pronto", "scaricato")
+
+# Livelli in ordine di costo crescente; CASCADE_TIERS sceglie quali usare
+LIVELLI = {
+    "testo": Livello("testo", livello_testo),
+    "pdf_extract_kit": Livello("pdf_extract_kit", livello_pdf_extract_kit, pdf_extract_kit_disponibile),
+    "nanonets": Livello("nanonets", livello_nanonets, nanonets_disponibile),
+}
+cascata = CascataEstrazione([LIVELLI[nome] for nome in Config.CASCADE_TIERS])
+
 def estrai_dati_contratto(file):
     """Estrae i dati dal contratto PDF - versione migliorata"""
     try:
-        # Prima prova con PDF-Extract-Kit
-        print("Tentativo estrazione con PDF-Extract-Kit...")
-        extracted_data = extract_data_with_pdf_extract_kit(file, "contratto")
-        
-        if extracted_data and extracted_data["nome"]:
-            print("Dati estratti con PDF-Extract-Kit:", extracted_data)
-            return extracted_data
-        
-        # Fallback al metodo tradizionale
-        print("Fallback al metodo tradizionale...")
-        testo = ""
-        with pdfplumber.open(file) as pdf:
-            for page in pdf.pages:
-                testo += page.extract_text() or ""
-        
-        print(f"Testo contratto (primi 500 char): {testo[:500]}")
-        
+        with apri_documento(file) as documento:
+            return _estrai_dati_contratto(documento)
+    except (ExecutorBusyError, ErroreCascata):
+        # Pool saturo (503) o livelli falliti: non vanno scambiati per un documento senza campi
+        raise
+    except Exception as e:
+        log.error("Errore estrazione contratto: %s", e)
+        return {}
+
+def _estrai_dati_contratto(documento):
+    """Estrae i dati dal contratto usando un DocumentoPDF già aperto"""
+    try:
         dati = {
             "nome": "",
             "cognome": "",
@@ -375,82 +520,47 @@ def estrai_dati_contratto(file):
             "numero_rate": 0,
             "durata_mesi": 0
         }
+        metriche.osserva("document_pages", documento.num_pagine, file_type="contratto")
+        dati = cascata.estrai(documento, "contratto", dati)
         
-        # Estrazione nome e cognome
-        nome_match = re.search(r"COGNOME\s*:?\s*([A-Za-zÀ-ÖØ-öø-ÿ\s']+?)\s+NOME\s*:?\s*([A-Za-zÀ-ÖØ-öø-ÿ\s']+)", testo, re.IGNORECASE)
-        if nome_match:
-            dati["cognome"] = nome_match.group(1).strip()
-            dati["nome"] = nome_match.group(2).strip()
-        
-        # Codice Fiscale
-        cf_match = re.search(r"([A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z])", testo)
-        if cf_match:
-            dati["codice_fiscale"] = cf_match.group(1).upper()
-        
-        # Data di nascita
-        data_match = re.search(r"(\d{1,2}\/\d{1,2}\/\d{4})", testo)
-        if data_match:
-            dati["data_nascita"] = data_match.group(1)
-        
-        # Costi totali
-        costi_match = re.search(r"CT\s+€\s*([\d.,]+)\s+COSTI TOTALI", testo, re.IGNORECASE)
-        if costi_match:
-            dati["costi_totali"] = float(costi_match.group(1).replace('.', '').replace(',', '.'))
-        
-        # Durata
-        durata_match = re.search(r"DURATA:\s*(\d+)\s*MESI", testo, re.IGNORECASE)
-        if durata_match:
-            dati["durata_mesi"] = int(durata_match.group(1))
-            dati["numero_rate"] = int(durata_match.group(1))
-        
-        print(f"Dati estratti dal contratto: {dati}")
+        log.debug("Dati estratti dal contratto: %s", dati)
         return dati
         
+    except (ExecutorBusyError, ErroreCascata):
+        raise
     except Exception as e:
-        print(f"Errore estrazione contratto: {e}")
+        log.error("Errore estrazione contratto: %s", e)
         return {}
 
 def estrai_dati_conteggio(file):
     """Estrae i dati dal conteggio estintivo PDF - versione migliorata"""
     try:
-        # Prima prova con PDF-Extract-Kit
-        print("Tentativo estrazione con PDF-Extract-Kit...")
-        extracted_data = extract_data_with_pdf_extract_kit(file, "conteggio")
-        
-        if extracted_data and extracted_data["rate_scadute"] > 0:
-            print("Dati estratti con PDF-Extract-Kit:", extracted_data)
-            return extracted_data
-        
-        # Fallback al metodo tradizionale
-        print("Fallback al metodo tradizionale...")
-        testo = ""
-        with pdfplumber.open(file) as pdf:
-            for page in pdf.pages:
-                testo += page.extract_text() or ""
-        
-        print(f"Testo conteggio (primi 500 char): {testo[:500]}")
-        
+        with apri_documento(file) as documento:
+            return _estrai_dati_conteggio(documento)
+    except (ExecutorBusyError, ErroreCascata):
+        raise
+    except Exception as e:
+        log.error("Errore estrazione conteggio: %s", e)
+        return {}
+
+def _estrai_dati_conteggio(documento):
+    """Estrae i dati dal conteggio usando un DocumentoPDF già aperto"""
+    try:
         dati = {
             "rate_scadute": 0,
             "data_chiusura": "",
             "importo_versato": 0.0
         }
+        metriche.osserva("document_pages", documento.num_pagine, file_type="conteggio")
+        dati = cascata.estrai(documento, "conteggio", dati)
         
-        # Estrazione rate scadute
-        rate_match = re.search(r"RATE\s*SCADUTE[^\d\n]*:?\s*\(?(\d{1,3})\s*MESI?", testo, re.IGNORECASE)
-        if rate_match:
-            dati["rate_scadute"] = int(rate_match.group(1))
-        
-        # Estrazione data chiusura
-        data_match = re.search(r"DATA\s*ELABORAZIONE\s*CONTEGGIO\s*ESTINTIVO\s*([\d\/]+)", testo, re.IGNORECASE)
-        if data_match:
-            dati["data_chiusura"] = data_match.group(1)
-        
-        print(f"Dati estratti dal conteggio: {dati}")
+        log.debug("Dati estratti dal conteggio: %s", dati)
         return dati
         
+    except (ExecutorBusyError, ErroreCascata):
+        raise
     except Exception as e:
-        print(f"Errore estrazione conteggio: {e}")
+        log.error("Errore estrazione conteggio: %s", e)
         return {}
 
 def esegui_calcoli(dati_contratto, dati_conteggio):
@@ -476,71 +586,132 @@ def esegui_calcoli(dati_contratto, dati_conteggio):
             "costi_totali": costi_totali
         }
         
-        print(f"Calcoli eseguiti: {calcoli}")
+        log.debug("Calcoli eseguiti: %s", calcoli)
         return calcoli
         
     except Exception as e:
-        print(f"Errore calcoli: {e}")
+        log.error("Errore calcoli: %s", e)
         return {"rimborso": 0, "errore": str(e)}
 
+def rimborsi_da_file(percorso, metodo):
+    """Legge il CSV caricato e calcola i rimborsi del portafoglio (fuori dall'event loop)"""
+    with open(percorso, encoding="utf-8-sig") as f:
+        return rimborsi_portafoglio(f.read(), metodo)
+
 def crea_pdf_diffida(dati_contratto, dati_conteggio, calcoli):
-    """Crea il PDF della lettera di diffida"""
+    """Crea il PDF della lettera di diffida dal modello precompilato"""
     try:
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-        
-        # Header
-        nome_completo = f"{dati_contratto.get('cognome', '')} {dati_contratto.get('nome', '')}".strip()
-        if not nome_completo:
-            nome_completo = "Cliente"
-        
-        codice_fiscale = dati_contratto.get('codice_fiscale', 'Non disponibile')
-        data_nascita = dati_contratto.get('data_nascita', 'Non disponibile')
-        luogo_nascita = dati_contratto.get('luogo_nascita', 'Non disponibile')
-        data_chiusura = dati_conteggio.get('data_chiusura', '')
-        importo_rimborso = f"{calcoli.get('rimborso', 0):.2f}".replace('.', ',') + " €"
-        
-        # Contenuto lettera
-        pdf.cell(200, 10, txt=f"Oggetto: Lettera di diffida per il Sig. {nome_completo} e proposta di stipula di convenzione di negoziazione assistita ai sensi degli artt. 2 e 3 del Decreto Legge n. 132/2014", ln=True, align='L')
-        pdf.ln(5)
-        
-        pdf.cell(200, 10, txt=f"Spett.le ______________,", ln=True, align='L')
-        pdf.ln(5)
-        
-        pdf.multi_cell(0, 10, txt=f"scrivo la presente in nome e per conto del Sig. {nome_completo} (C.F. {codice_fiscale}), nato a {luogo_nascita} il {data_nascita}, per rappresentarVi quanto segue.", align='L')
-        pdf.ln(5)
-        
-        pdf.multi_cell(0, 10, txt="Alla luce delle verifiche effettuate sul rapporto contrattuale in oggetto - il quale invero è caratterizzato da una evidente genericità nella formulazione delle voci di costo applicate - è emerso che il Vostro istituto di credito ha illegittimamente trattenuto delle somme non dovute dal mio assistito e compiuto plurime violazioni della normativa di settore.", align='L')
-        pdf.ln(5)
-        
-        pdf.multi_cell(0, 10, txt=f"Difatti, avendo il mio assistito estinto anticipatamente il suindicato contratto di finanziamento quando ancora residuavano da versare {calcoli.get('rate_residue', 0)} rate delle {calcoli.get('durata_totale', 0)} convenute, lo stesso ha diritto, a norma dell'art. 125 sexies T.U.B., alla restituzione della corrispettiva quota delle commissioni, degli oneri, dei premi assicurativi sottoscritti a fronte del finanziamento e delle spese a lui imputate.", align='L')
-        pdf.ln(5)
-        
-        pdf.multi_cell(0, 10, txt=f"Nello specifico il mio assistito ha corrisposto complessivi {importo_rimborso} a titolo di commissioni, oneri, spese e polizze.", align='L')
-        pdf.ln(5)
-        
-        pdf.multi_cell(0, 10, txt=f"Di conseguenza - al netto dello storno di euro 0,00 applicato in sede estintiva, e fatta salva ogni maggior richiesta all'esito dell'analisi tecnico contabile - spetta la restituzione di complessivi {importo_rimborso} calcolati secondo il metodo pro rata temporis.", align='L')
-        pdf.ln(5)
-        
-        pdf.multi_cell(0, 10, txt="Inoltre il rapporto appare viziato anche sotto il profilo della trasparenza delle condizioni praticate e dei tassi applicati, integrando pertanto una condotta evidentemente contraria a buona fede e correttezza.", align='L')
-        pdf.ln(5)
-        
-        pdf.multi_cell(0, 10, txt=f"Pertanto Vi invito e diffido a restituire al mio assistito, entro e non oltre il termine di 15 giorni dal ricevimento della presente, la complessiva somma di {importo_rimborso} oltre interessi dal dì del dovuto sino al soddisfo e spese.", align='L')
-        pdf.ln(10)
-        
-        pdf.cell(200, 10, txt="Avv. Gabriele Scappaticci", ln=True, align='L')
-        
-        return pdf
-        
+        with metriche.fase("pdf_diffida"):
+            return modello_diffida.rendi(valori_diffida(dati_contratto, dati_conteggio, calcoli))
     except Exception as e:
-        print(f"Errore creazione PDF: {e}")
+        log.error("Errore creazione PDF: %s", e)
         raise HTTPException(status_code=500, detail=f"Errore creazione PDF: {e}")
 
+def estrai_con_cache(funzione, file_type, file):
+    """Esegue l'estrazione solo se lo stesso file non è già stato elaborato con la stessa configurazione"""
+    chiave = chiave_cache(
+        file_type,
+        sha256_file(file),
+        livelli=cascata.livelli_disponibili(file_type),
+        backend={ruolo: Config.get_backend(ruolo, file_type) for ruolo in ("layout", "ocr")},
+        modalita=Config.OCR_EXTRACTION_MODE,
+        page_order=Config.get_page_order(file_type),
+        regole=VERSIONE_REGOLE
+    )
+    # Solo risultati completi: un livello fallito o un campo mancante si riprova alla richiesta successiva
+    return risultati_cache.get_or_compute(
+        chiave, funzione, file,
+        cacheabile=lambda dati: not dati.get("errori") and not campi_mancanti(dati, file_type)
+    )
+
+def chiave_ocr(sha_contenuto, indice_pagina, resolution, max_new_tokens, backend=None, **parametri):
+    """Chiave di cache per il testo OCR di una pagina (backend OCR predefinito se non indicato)"""
+    return chiave_cache(
+        "ocr_nanonets",
+        sha_contenuto,
+        pagina=indice_pagina,
+        resolution=resolution,
+        backend=backend or Config.get_backend("ocr"),
+        model_path=Config.MODEL_PATH,
+        prompt=NANONETS_PROMPT,
+        max_new_tokens=max_new_tokens,
+        **parametri
+    )
+
+async def estrai_dati_documenti(file_contratto, file_conteggio):
+    """Estrae in parallelo i dati di contratto e conteggio fuori dall'event loop.
+
+    Gli upload vengono validati e salvati su file temporanei (eliminati alla fine);
+    la cascata gira nel pool CPU: solo le inferenze dei livelli con modelli passano dal pool dei modelli.
+    """
+    max_bytes = Config.get_upload_config()["max_file_bytes"]
+    percorsi = []
+    try:
+        for file in (file_contratto, file_conteggio):
+            percorsi.append(await salva_upload(file, {".pdf"}, max_bytes))
+        return await estrai_dati_percorsi(*percorsi)
+    finally:
+        rimuovi(*percorsi)
+
+async def estrai_dati_percorsi(percorso_contratto, percorso_conteggio):
+    """Estrae in parallelo i dati di contratto e conteggio da PDF già salvati su disco"""
+    return await asyncio.gather(
+        execution_layer.run_cpu(estrai_con_cache, estrai_dati_contratto, "contratto", percorso_contratto),
+        execution_layer.run_cpu(estrai_con_cache, estrai_dati_conteggio, "conteggio", percorso_conteggio)
+    )
+
+def prepara_modello(nome):
+    """Carica e riscalda un modello in un thread, senza propagare gli errori"""
+    try:
+        registro_modelli.carica(nome)
+    except Exception:
+        pass
+
+async def prepara_modelli():
+    """Prepara i backend in uso in background senza bloccare l'avvio del server"""
+    da_preparare = nomi_backend("layout")
+    if Config.PRELOAD_NANONETS:
+        da_preparare += [nome for nome in nomi_backend("ocr") if nome not in da_preparare]
+    for nome in da_preparare:
+        await asyncio.to_thread(prepara_modello, nome)
+
+async def scarica_modelli_inattivi():
+    """Controlla periodicamente i modelli inattivi e li scarica"""
+    while True:
+        await asyncio.sleep(min(60, Config.MODEL_IDLE_TIMEOUT))
+        scaricati = await asyncio.to_thread(registro_modelli.scarica_inattivi)
+        if scaricati:
+            log.info("Modelli scaricati per inattività: %s", scaricati)
+
+def modelli_pronti():
+    """I backend richiesti sono utilizzabili.
+
+    Un backend di layout in errore non blocca: l'estrazione ripiega sul testo del PDF.
+    I backend OCR contano solo se vengono precaricati. Un modello scaricato per
+    inattività resta utilizzabile: viene ricaricato alla prima richiesta.
+    """
+    if any(registro_modelli.stato(nome) not in ("pronto", "scaricato", "errore") for nome in nomi_backend("layout")):
+        return False
+    if Config.PRELOAD_NANONETS and any(
+        registro_modelli.stato(nome) not in ("pronto", "scaricato") for nome in nomi_backend("ocr")
+    ):
+        return False
+    return True
+
 @app.on_event("startup")
 async def startup_event():
-    """Carica il modello all'avvio"""
-    await load_pdf_extract_model()
+    """Avvia il caricamento dei modelli in background"""
+    app.state.preparazione_modelli = asyncio.create_task(prepara_modelli())
+    if Config.MODEL_IDLE_TIMEOUT > 0:
+        app.state.scaricamento_modelli = asyncio.create_task(scarica_modelli_inattivi())
+    await coda_lavori.avvia()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Chiude la coda dei lavori, lo scheduler OCR e i pool di esecuzione"""
+    coda_lavori.chiudi()
+    ocr_scheduler.chiudi()
+    execution_layer.shutdown(wait=False)
 
 @app.post("/genera-diffida/")
 async def genera_diffida(
@@ -549,29 +720,147 @@ async def genera_diffida(
 ):
     """Endpoint principale per generare la lettera di diffida"""
     try:
-        print(f"Ricevuti file: contratto={file_contratto.filename}, conteggio={file_conteggio.filename}")
+        log.info("Ricevuti file: contratto=%s, conteggio=%s", file_contratto.filename, file_conteggio.filename)
         
         # Estrazione dati
-        dati_contratto = estrai_dati_contratto(file_contratto.file)
-        dati_conteggio = estrai_dati_conteggio(file_conteggio.file)
-        
-        # Calcoli
-        calcoli = esegui_calcoli(dati_contratto, dati_conteggio)
+        dati_contratto, dati_conteggio = await estrai_dati_documenti(file_contratto, file_conteggio)
         
-        # Creazione PDF
-        pdf_output = crea_pdf_diffida(dati_contratto, dati_conteggio, calcoli)
+        # Calcoli e creazione PDF
+        pdf_bytes = await pdf_diffida(dati_contratto, dati_conteggio)
         
         # Restituzione file
         headers = {'Content-Disposition': 'attachment; filename="diffida_compilata.pdf"'}
         return Response(
-            pdf_output.output(dest='S').encode('latin-1'), 
+            pdf_bytes, 
             media_type='application/pdf', 
             headers=headers
         )
         
+    except UploadRifiutato as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ExecutorBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        log.error("Errore generazione diffida: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def pdf_diffida(dati_contratto, dati_conteggio):
+    """Calcoli e lettera di diffida in PDF (generata nel pool CPU)"""
+    calcoli = esegui_calcoli(dati_contratto, dati_conteggio)
+    return await execution_layer.run_cpu(crea_pdf_diffida, dati_contratto, dati_conteggio, calcoli)
+
+async def rendi_diffide(lista_valori, unico):
+    """Rende le diffide in lotti, uno per processo del pool (un solo lotto se il pool è disabilitato).
+
+    Con unico=true i PDF dei lotti vengono concatenati in un solo documento,
+    altrimenti si ottiene un PDF per lettera, nello stesso ordine.
+    """
+    lotti_massimi = max(1, Config.PROCESS_WORKERS)
+    dimensione = -(-len(lista_valori) // lotti_massimi)
+    lotti = [lista_valori[i:i + dimensione] for i in range(0, len(lista_valori), dimensione)]
+    with metriche.fase("pdf_diffide_bulk", formato="pdf" if unico else "zip"):
+        parti = await asyncio.gather(*(execution_layer.run_process(rendi_lotto, lotto, unico) for lotto in lotti))
+        if unico:
+            return await execution_layer.run_cpu(unisci_pdf, parti)
+    return [pdf for parte in parti for pdf in parte]
+
+@app.post("/genera-diffida/bulk/")
+async def genera_diffida_bulk(lettere: List[dict] = Body(..., embed=True), formato: str = "zip"):
+    """Genera molte diffide in una richiesta, da dati già estratti (es. le righe di /estrai-dati/bulk/).
+
+    Ogni lettera è {"id", "dati_contratto", "dati_conteggio"} con "calcoli" opzionali
+    (altrimenti ricalcolati). Restituisce un archivio ZIP con un PDF per lettera
+    o, con formato=pdf, un unico PDF con tutte le lettere.
+    """
+    if formato not in ("zip", "pdf"):
+        raise HTTPException(status_code=400, detail="Formato non supportato: usa 'zip' o 'pdf'")
+    if not lettere:
+        raise HTTPException(status_code=400, detail="Nessuna lettera da generare")
+    if len(lettere) > Config.LETTERS_MAX_BULK:
+        raise HTTPException(status_code=400, detail=f"Troppe lettere: al massimo {Config.LETTERS_MAX_BULK} per richiesta")
+    lista_valori = []
+    for n, lettera in enumerate(lettere, 1):
+        dati_contratto, dati_conteggio = lettera.get("dati_contratto"), lettera.get("dati_conteggio")
+        if not isinstance(dati_contratto, dict) or not isinstance(dati_conteggio, dict):
+            raise HTTPException(status_code=400, detail=f"Lettera {n}: mancano dati_contratto o dati_conteggio")
+        calcoli = lettera.get("calcoli") or esegui_calcoli(dati_contratto, dati_conteggio)
+        lista_valori.append(valori_diffida(dati_contratto, dati_conteggio, calcoli))
+    
+    try:
+        documenti = await rendi_diffide(lista_valori, formato == "pdf")
+        if formato == "pdf":
+            contenuto, media_type, nome = documenti, "application/pdf", "diffide.pdf"
+        else:
+            nomi = [nome_file_lettera(lettera.get("id"), n) for n, lettera in enumerate(lettere, 1)]
+            contenuto = await execution_layer.run_cpu(archivio_zip, nomi, documenti)
+            media_type, nome = "application/zip", "diffide.zip"
+    except ExecutorBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        print(f"Errore generazione diffida: {e}")
+        log.error("Errore generazione diffide: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
+    log.info("Diffide generate: %d (%s)", len(lettere), formato, extra={"lettere": len(lettere), "formato": formato})
+    return Response(contenuto, media_type=media_type,
+                    headers={'Content-Disposition': f'attachment; filename="{nome}"'})
+
+@app.post("/calcoli/rimborsi/")
+async def calcoli_rimborsi(file: UploadFile = File(...), metodo: str = "pro_rata", formato: str = "json"):
+    """Calcola i rimborsi di un portafoglio di pratiche da un CSV, con operazioni vettoriali.
+
+    Colonne: costi_totali, durata_mesi, rate_scadute; opzionali id, tan (TAN annuo in %)
+    e costi_upfront. metodo: pro_rata, curva_interessi o misto (up-front con la curva
+    degli interessi, il resto pro rata). Ogni riga ha lo stesso formato di esegui_calcoli;
+    la risposta riporta anche il totale di ogni metodo a confronto. Con formato=csv
+    restituisce un CSV con una riga per pratica.
+    """
+    if metodo not in METODI:
+        raise HTTPException(status_code=400, detail=f"Metodo non supportato: usa {', '.join(METODI)}")
+    if formato not in ("json", "csv"):
+        raise HTTPException(status_code=400, detail="Formato non supportato: usa 'json' o 'csv'")
+    tmp_path = None
+    try:
+        tmp_path = await salva_upload(file, {".csv"}, Config.get_upload_config()["max_file_bytes"])
+        risultato = await execution_layer.run_cpu(rimborsi_da_file, tmp_path, metodo)
+        if formato == "csv":
+            contenuto = await execution_layer.run_cpu(scrivi_csv, risultato["id"], risultato["righe"])
+            return Response(contenuto, media_type="text/csv",
+                            headers={'Content-Disposition': 'attachment; filename="rimborsi.csv"'})
+        return risultato
+    except UploadRifiutato as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"CSV non valido: {e}")
+    except ExecutorBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        log.error("Errore calcolo rimborsi: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        rimuovi(tmp_path)
+
+def risposta_estrazione(dati_contratto, dati_conteggio):
+    """Calcoli e dati formattati per il frontend: la risposta di /estrai-dati/"""
+    calcoli = esegui_calcoli(dati_contratto, dati_conteggio)
+    
+    # Formatta i dati per il frontend
+    dati_formattati = {
+        "nomeCliente": f"{dati_contratto.get('cognome', '')} {dati_contratto.get('nome', '')}".strip() or "Cliente",
+        "codiceFiscale": dati_contratto.get('codice_fiscale', 'Non disponibile'),
+        "dataNascita": dati_contratto.get('data_nascita', 'Non disponibile'),
+        "luogoNascita": dati_contratto.get('luogo_nascita', 'Non disponibile'),
+        "importoRimborso": f"{calcoli.get('rimborso', 0):.2f}".replace('.', ',') + " €",
+        "rateResidue": calcoli.get('rate_residue', 0),
+        "durataTotale": calcoli.get('durata_totale', 0),
+        "costiTotali": calcoli.get('costi_totali', 0)
+    }
+    
+    return {
+        "success": True,
+        "dati_contratto": dati_contratto,
+        "dati_conteggio": dati_conteggio,
+        "calcoli": calcoli,
+        "dati_formattati": dati_formattati
+    }
 
 @app.post("/estrai-dati/")
 async def estrai_dati(
@@ -580,36 +869,133 @@ async def estrai_dati(
 ):
     """Endpoint per estrarre solo i dati senza generare PDF"""
     try:
-        print(f"Estrazione dati da: contratto={file_contratto.filename}, conteggio={file_conteggio.filename}")
-        
-        dati_contratto = estrai_dati_contratto(file_contratto.file)
-        dati_conteggio = estrai_dati_conteggio(file_conteggio.file)
-        calcoli = esegui_calcoli(dati_contratto, dati_conteggio)
+        log.info("Estrazione dati da: contratto=%s, conteggio=%s", file_contratto.filename, file_conteggio.filename)
         
-        # Formatta i dati per il frontend
-        dati_formattati = {
-            "nomeCliente": f"{dati_contratto.get('cognome', '')} {dati_contratto.get('nome', '')}".strip() or "Cliente",
-            "codiceFiscale": dati_contratto.get('codice_fiscale', 'Non disponibile'),
-            "dataNascita": dati_contratto.get('data_nascita', 'Non disponibile'),
-            "luogoNascita": dati_contratto.get('luogo_nascita', 'Non disponibile'),
-            "importoRimborso": f"{calcoli.get('rimborso', 0):.2f}".replace('.', ',') + " €",
-            "rateResidue": calcoli.get('rate_residue', 0),
-            "durataTotale": calcoli.get('durata_totale', 0),
-            "costiTotali": calcoli.get('costi_totali', 0)
-        }
-        
-        return {
-            "success": True,
-            "dati_contratto": dati_contratto,
-            "dati_conteggio": dati_conteggio,
-            "calcoli": calcoli,
-            "dati_formattati": dati_formattati
-        }
+        dati_contratto, dati_conteggio = await estrai_dati_documenti(file_contratto, file_conteggio)
+        return risposta_estrazione(dati_contratto, dati_conteggio)
         
+    except UploadRifiutato as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ExecutorBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        print(f"Errore estrazione dati: {e}")
+        log.error("Errore estrazione dati: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def elabora_coppia(coppia, prepara, semaforo):
+    """Estrae i dati di una coppia contratto/conteggio con al più BULK_CONCURRENCY coppie in corso.
+
+    prepara(nome) restituisce il percorso del PDF e se va eliminato dopo l'uso. Se i pool
+    sono saturi (anche per altre richieste) la coppia riprova invece di fallire subito.
+    """
+    async with semaforo:
+        percorsi = []
+        try:
+            for ruolo in ("contratto", "conteggio"):
+                percorsi.append(await prepara(coppia[ruolo]))
+            for tentativo in range(Config.BULK_BUSY_RETRIES + 1):
+                try:
+                    dati_contratto, dati_conteggio = await estrai_dati_percorsi(percorsi[0][0], percorsi[1][0])
+                    break
+                except ExecutorBusyError:
+                    if tentativo == Config.BULK_BUSY_RETRIES:
+                        raise
+                    metriche.incrementa("bulk_busy_retries_total")
+                    log.debug("Pool saturi, coppia %s ritentata (%d)", coppia["id"], tentativo + 1,
+                              extra={"coppia": coppia["id"]})
+                    await asyncio.sleep(Config.BULK_BUSY_RETRY_DELAY_MS / 1000)
+            return {"id": coppia["id"], **risposta_estrazione(dati_contratto, dati_conteggio)}
+        except Exception as e:
+            log.error("Errore estrazione coppia %s: %s", coppia["id"], e)
+            return {"id": coppia["id"], "success": False, "errore": str(e)}
+        finally:
+            rimuovi(*(percorso for percorso, temporaneo in percorsi if temporaneo))
+
+async def stream_bulk(coppie, scartati, prepara, temporanei, concorrenza):
+    """Una riga NDJSON per coppia, nell'ordine in cui le estrazioni terminano"""
+    semaforo = asyncio.Semaphore(max(1, concorrenza))
+    tasks = [asyncio.ensure_future(elabora_coppia(coppia, prepara, semaforo)) for coppia in coppie]
+    riuscite = 0
+    try:
+        for scartato in scartati:
+            yield json.dumps({**scartato, "success": False}, ensure_ascii=False) + "\n"
+        for task in asyncio.as_completed(tasks):
+            risultato = await task
+            riuscite += risultato["success"]
+            yield json.dumps(risultato, ensure_ascii=False) + "\n"
+        yield json.dumps({"done": True, "coppie": len(coppie), "riuscite": riuscite,
+                          "errori": len(coppie) - riuscite, "scartati": len(scartati)}) + "\n"
+    finally:
+        # Client disconnesso: le coppie non ancora elaborate vengono annullate
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        rimuovi(*temporanei)
+
+@app.post("/estrai-dati/bulk/")
+async def estrai_dati_bulk(
+    archivio: UploadFile = File(None),
+    files: List[UploadFile] = File(None),
+    manifest: str = Form(None),
+    concorrenza: int = 0
+):
+    """Estrazione massiva: un archivio ZIP oppure più PDF in multipart, abbinati in coppie
+    contratto/conteggio dalla convenzione sui nomi (<id>_contratto.pdf, <id>_conteggio.pdf
+    o <id>/contratto.pdf) oppure da un manifest JSON/CSV con colonne id, contratto, conteggio
+    (campo manifest o manifest.json/manifest.csv nella radice dell'archivio).
+
+    Le coppie vengono elaborate in parallelo (al più BULK_CONCURRENCY, o concorrenza) e la
+    risposta è NDJSON: una riga per coppia con "id" e gli stessi campi di /estrai-dati/.
+    """
+    limiti = Config.get_upload_config()
+    temporanei = []
+    try:
+        if archivio is not None:
+            percorso_zip = await salva_upload(archivio, {".zip"}, limiti["max_bulk_bytes"])
+            temporanei.append(percorso_zip)
+            nomi, manifest_archivio = await execution_layer.run_cpu(contenuto_archivio, percorso_zip)
+            manifest = manifest or manifest_archivio
+            
+            async def prepara(nome):
+                return await execution_layer.run_cpu(estrai_membro, percorso_zip, nome, limiti["max_file_bytes"]), True
+        elif files:
+            salvati = {}
+            for file in files:
+                if file.filename in salvati:
+                    raise HTTPException(status_code=400, detail=f"File ripetuto: {file.filename}")
+                salvati[file.filename] = await salva_upload(file, {".pdf"}, limiti["max_file_bytes"])
+                temporanei.append(salvati[file.filename])
+            nomi = list(salvati)
+            
+            async def prepara(nome):
+                return salvati[nome], False
+        else:
+            raise HTTPException(status_code=400, detail="Invia un archivio ZIP (archivio) o i PDF (files)")
+        
+        try:
+            righe = leggi_manifest(manifest) if manifest else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Manifest non valido: {e}")
+        coppie, scartati = abbina_coppie(nomi, righe)
+        if not coppie:
+            raise HTTPException(status_code=400, detail={"errore": "Nessuna coppia contratto/conteggio", "scartati": scartati})
+        log.info("Estrazione massiva: %d coppie, %d scartati", len(coppie), len(scartati),
+                 extra={"coppie": len(coppie), "scartati": len(scartati)})
+    except BaseException as e:
+        rimuovi(*temporanei)
+        if isinstance(e, UploadRifiutato):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        if isinstance(e, ExecutorBusyError):
+            raise HTTPException(status_code=503, detail=str(e))
+        if isinstance(e, zipfile.BadZipFile):
+            raise HTTPException(status_code=400, detail=f"Archivio ZIP non valido: {e}")
+        raise
+    
+    return StreamingResponse(
+        stream_bulk(coppie, scartati, prepara, temporanei, concorrenza or Config.BULK_CONCURRENCY),
+        media_type="application/x-ndjson"
+    )
+
 @app.get("/")
 def home():
     """Endpoint di test"""
@@ -625,8 +1011,20 @@ def health():
         "status": "ok",
         "timestamp": str(datetime.datetime.now()),
         "version": "2.0.0",
-        "model_loaded": model is not None,
-        "nanonets_loaded": nanonets_model is not None,
+        "model_loaded": registro_modelli.caricato(Config.get_backend("layout")),
+        "nanonets_loaded": registro_modelli.caricato(Config.get_backend("ocr")),
+        "models": registro_modelli.stats(),
+        "backends": {
+            "layout": Config.BACKENDS["layout"],
+            "ocr": Config.BACKENDS["ocr"],
+            "disponibili": {nome: voce.descrivi() for nome, voce in BACKENDS.items()},
+        },
+        "executor": execution_layer.stats(),
+        "cache": risultati_cache.stats(),
+        "ocr_batching": ocr_scheduler.stats(),
+        "ocr_tokens": statistiche_token.stats(),
+        "cascade": cascata.stats(),
+        "jobs": coda_lavori.stats(),
         "system": {
             "python_version": platform.python_version(),
             "platform": platform.platform()
@@ -634,6 +1032,7 @@ def health():
         "config": {
             "model_path": Config.get_model_config()["model_path"],
             "device": Config.get_model_config()["device"],
+            "inference_profile": Config.get_model_config()["profile"],
             "max_file_size": f"{Config.MAX_FILE_SIZE} MB",
             "ocr_timeout": f"{Config.OCR_TIMEOUT} seconds"
         }
@@ -641,31 +1040,379 @@ def health():
     
     return health_info
 
+@app.get("/ready")
+def ready():
+    """Readiness check: 200 solo quando i modelli sono caricati e riscaldati"""
+    pronto = modelli_pronti()
+    return JSONResponse(
+        status_code=200 if pronto else 503,
+        content={"ready": pronto, "models": registro_modelli.stats()["modelli"]}
+    )
+
+@app.get("/metrics")
+def metrics():
+    """Metriche in formato testo Prometheus: durate delle fasi e delle richieste, token, pagine, modelli"""
+    if not metriche.enabled:
+        raise HTTPException(status_code=404, detail="Metriche disabilitate (METRICS_ENABLED=false)")
+    return Response(metriche.esporta(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def render_prima_pagina(pdf_path):
+    """Renderizza la prima pagina del PDF a 300 dpi: immagine in memoria e testo incorporato"""
+    with DocumentoPDF(pdf_path) as documento:
+        return documento.immagine_pagina(0, resolution=300), documento.testo_pagina(0)
+
+def apri_immagine(img_path):
+    """Legge e decodifica l'immagine caricata (fuori dall'event loop)"""
+    with Image.open(img_path) as image:
+        image.load()
+        return immagine_rgb(image)
+
+def ritagli_pagina(documento, img_path, indice, file_type):
+    """Ritagli di una pagina (o dell'immagine caricata) da inviare al modello, con il limite di token di ciascuno"""
+    if documento is None:
+        ritagli = [ritaglia_contenuto(apri_immagine(img_path))]
+    else:
+        ritagli = immagini_roi(documento, indice, file_type, 300, **Config.get_roi_config())
+    return ritagli, [limite_token(ritaglio, massimo=Config.OCR_ROI_MAX_NEW_TOKENS) for ritaglio in ritagli]
+
+async def ocr_regioni(tmp_path, suffix, file_type):
+    """OCR dei soli ritagli attorno ai campi, pagina per pagina nell'ordine di visita del tipo di documento.
+
+    I ritagli di più pagine vengono inviati insieme (fino a riempire un micro-batch) e ci si
+    ferma appena i campi richiesti sono completi: le pagine restanti non vengono renderizzate.
+    """
+    documento = await execution_layer.run_cpu(DocumentoPDF, tmp_path) if suffix == ".pdf" else None
+    try:
+        ordine = ordine_pagine(Config.get_page_order(file_type), documento.num_pagine) if documento else [0]
+        regioni = []
+        onda = []
+        for n, indice in enumerate(ordine):
+            ritagli, limiti = await execution_layer.run_cpu(ritagli_pagina, documento, tmp_path, indice, file_type)
+            if ritagli:
+                onda.append((indice, ritagli, limiti))
+            if not onda or (sum(len(r) for _, r, _ in onda) < Config.OCR_MICROBATCH_MAX_SIZE and n < len(ordine) - 1):
+                continue
+            risultati = await asyncio.gather(*(
+                ocr_scheduler.ocr_pagine(r, max_new_tokens=l, file_type=file_type) for _, r, l in onda
+            ))
+            for (i, _, _), risultati_pagina in zip(onda, risultati):
+                regioni.extend({"pagina": i + 1, "regione": k + 1, **risultato} for k, risultato in enumerate(risultati_pagina))
+            onda = []
+            if not campi_mancanti(estrai_campi(file_type, "\n".join(r["text"] for r in regioni)), file_type):
+                break
+    finally:
+        if documento is not None:
+            await execution_layer.run_cpu(documento.close)
+    
+    text = "\n".join(regione["text"] for regione in regioni)
+    return {
+        "text": text,
+        "campi": estrai_campi(file_type, text),
+        "tokens": sum(regione["tokens"] for regione in regioni),
+        "regioni": regioni
+    }
+
+def verifica_parametri_ocr(roi, file_type, modalita):
+    """Valida i parametri di /ocr-nanonets/ (400 se non supportati)"""
+    if file_type not in ("contratto", "conteggio"):
+        raise HTTPException(status_code=400, detail="file_type non supportato: usa 'contratto' o 'conteggio'")
+    if modalita not in ("testo", "json"):
+        raise HTTPException(status_code=400, detail="Modalità non supportata: usa 'testo' o 'json'")
+    if roi and modalita == "json":
+        raise HTTPException(status_code=400, detail="roi=true è disponibile solo in modalità testo")
+    if modalita == "json" and not backend("ocr", file_type).supporta(JSON):
+        raise HTTPException(status_code=400, detail=f"Il backend {backend('ocr', file_type).nome} non supporta la modalità json")
+
+async def ocr_file(tmp_path, roi, file_type, modalita, fase=None):
+    """OCR di un file già salvato su disco, con la cache dei risultati.
+
+    fase(nome), se indicata, riceve l'avanzamento (rendering, ocr) per i lavori asincroni.
+    """
+    fase = fase or (lambda nome: None)
+    suffix = os.path.splitext(tmp_path)[-1]
+    sha_contenuto = await execution_layer.run_cpu(sha256_file, tmp_path)
+    if roi:
+        chiave = chiave_ocr(sha_contenuto, "roi", 300, Config.OCR_ROI_MAX_NEW_TOKENS,
+                            backend=Config.get_backend("ocr", file_type), file_type=file_type,
+                            regole=VERSIONE_REGOLE, **Config.get_roi_config(), **parametri_generazione())
+        result = risultati_cache.get(chiave)
+        if result is None:
+            fase("ocr")
+            result = await ocr_regioni(tmp_path, suffix, file_type)
+            risultati_cache.set(chiave, result)
+        return result
+    # Stesso file già elaborato: restituisci il testo in cache
+    if modalita == "json":
+        chiave = chiave_ocr(sha_contenuto, 0, 300, None, backend=Config.get_backend("ocr", file_type),
+                            modalita=modalita, file_type=file_type, prompt_json=prompt_json(file_type))
+    else:
+        chiave = chiave_ocr(sha_contenuto, 0, 300, 15000, **parametri_generazione())
+    result = risultati_cache.get(chiave)
+    if result is not None:
+        return result
+    # Se PDF, renderizza la prima pagina in memoria; altrimenti decodifica l'immagine caricata
+    fase("rendering")
+    if suffix == ".pdf":
+        image, testo_pagina = await execution_layer.run_cpu(render_prima_pagina, tmp_path)
+    else:
+        image, testo_pagina = await execution_layer.run_cpu(apri_immagine, tmp_path), None
+    # Esegui OCR: la pagina può condividere il batch con altre richieste concorrenti
+    fase("ocr")
+    if modalita == "json":
+        # Il limite di token è fissato dallo schema
+        result = (await execution_layer.run_model(
+            ocr_pagine, [image], max_new_tokens=None, batch_size=1, file_type=file_type, modalita=modalita
+        ))[0]
+    else:
+        limite = await execution_layer.run_cpu(limite_token, image, testo_pagina, 15000)
+        result = await ocr_scheduler.ocr(image, max_new_tokens=limite)
+    risultati_cache.set(chiave, result)
+    return result
+
 @app.post("/ocr-nanonets/")
-async def ocr_nanonets(file: UploadFile = File(...)):
-    """Esegue OCR avanzato con Nanonets-OCR-s su un'immagine o PDF (solo prima pagina)."""
+async def ocr_nanonets(file: UploadFile = File(...), roi: bool = False, file_type: str = "contratto",
+                       modalita: str = "testo"):
+    """Esegue OCR avanzato con Nanonets-OCR-s su un'immagine o PDF (solo prima pagina).
+
+    Con roi=true il modello riceve solo le fasce attorno alle parole chiave dei campi del
+    tipo di documento (tutte le pagine native, o la pagina senza margini per le scansioni)
+    e la risposta include i campi estratti.
+    Il limite di token è stimato dalla densità della pagina; la risposta riporta i token
+    generati, il limite e il motivo di arresto.
+    Con modalita=json il modello restituisce solo l'oggetto JSON con i campi del tipo di
+    documento (decodifica vincolata allo schema) e la risposta include i campi convertiti.
+    """
+    verifica_parametri_ocr(roi, file_type, modalita)
+    tmp_path = None
     try:
-        # Salva il file temporaneamente
-        suffix = os.path.splitext(file.filename)[-1].lower()
-        with NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
-        # Se PDF, estrai la prima pagina come immagine
+        # Salva il file temporaneamente, a blocchi e con i controlli di dimensione e tipo
+        tmp_path = await salva_upload(file, Config.ALLOWED_EXTENSIONS, Config.get_upload_config()["max_file_bytes"])
+        return await ocr_file(tmp_path, roi, file_type, modalita)
+    except UploadRifiutato as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ExecutorBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore OCR Nanonets: {e}")
+    finally:
+        # Il file caricato viene eliminato anche se l'OCR fallisce
+        rimuovi(tmp_path)
+
+def render_pagine(documento, indici, resolution=300):
+    """Renderizza un gruppo di pagine del documento, con il limite di token di ciascuna"""
+    immagini = [documento.immagine_pagina(i, resolution=resolution) for i in indici]
+    return immagini, [limite_token(immagine, documento.testo_pagina(i), 15000) for i, immagine in zip(indici, immagini)]
+
+def formatta_evento(evento, formato):
+    """Serializza un evento dello stream come riga NDJSON o messaggio SSE"""
+    payload = json.dumps(evento, ensure_ascii=False)
+    if formato == "sse":
+        tipo = "done" if evento.get("done") else ("error" if "errore" in evento else "page")
+        return f"event: {tipo}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+async def stream_ocr_pagine(tmp_path, documento, sha_contenuto, indici, formato):
+    """Genera un evento per pagina non appena il relativo batch è stato elaborato"""
+    async def render(gruppo):
+        if documento is None:
+            immagine = await execution_layer.run_cpu(apri_immagine, tmp_path)
+            return [immagine], [await execution_layer.run_cpu(limite_token, immagine, None, 15000)]
+        return await execution_layer.run_cpu(render_pagine, documento, gruppo)
+    
+    prossimo = None
+    try:
+        # Le pagine già in cache vengono inviate subito, le altre passano dal modello
+        parametri = parametri_generazione()
+        mancanti = []
+        for indice in indici:
+            risultato = risultati_cache.get(chiave_ocr(sha_contenuto, indice, 300, 15000, **parametri))
+            if risultato is None:
+                mancanti.append(indice)
+            else:
+                yield formatta_evento({"pagina": indice + 1, "totale": len(indici), **risultato}, formato)
+        
+        batch_size = scegli_batch_size(len(mancanti)) if mancanti else 1
+        gruppi = [mancanti[i:i + batch_size] for i in range(0, len(mancanti), batch_size)]
+        if gruppi:
+            prossimo = asyncio.ensure_future(render(gruppi[0]))
+        for n, gruppo in enumerate(gruppi):
+            immagini, limiti = await prossimo
+            # Renderizza il gruppo successivo mentre il modello elabora quello corrente
+            prossimo = asyncio.ensure_future(render(gruppi[n + 1])) if n + 1 < len(gruppi) else None
+            risultati = await ocr_scheduler.ocr_pagine(immagini, max_new_tokens=limiti)
+            for indice, risultato in zip(gruppo, risultati):
+                risultati_cache.set(chiave_ocr(sha_contenuto, indice, 300, 15000, **parametri), risultato)
+                yield formatta_evento({"pagina": indice + 1, "totale": len(indici), **risultato}, formato)
+        yield formatta_evento({"done": True, "pagine": len(indici)}, formato)
+    except Exception as e:
+        log.error("Errore OCR Nanonets multipagina: %s", e)
+        yield formatta_evento({"errore": str(e)}, formato)
+    finally:
+        # Attende l'eventuale rendering in corso prima di chiudere il documento
+        if prossimo is not None and not prossimo.done():
+            try:
+                await prossimo
+            except Exception:
+                pass
+        if documento is not None:
+            documento.close()
+        rimuovi(tmp_path)
+
+@app.post("/ocr-nanonets/stream/")
+async def ocr_nanonets_stream(file: UploadFile = File(...), pagine: str = "*", formato: str = "ndjson"):
+    """Esegue OCR con Nanonets-OCR-s su tutte le pagine (o l'intervallo richiesto, es. "1-5,-1")
+    e restituisce il testo di ogni pagina in streaming come NDJSON o server-sent events."""
+    if formato not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="Formato non supportato: usa 'ndjson' o 'sse'")
+    
+    try:
+        tmp_path = await salva_upload(file, Config.ALLOWED_EXTENSIONS, Config.get_upload_config()["max_file_bytes"])
+    except UploadRifiutato as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    suffix = os.path.splitext(tmp_path)[-1]
+    
+    documento = None
+    try:
+        sha_contenuto = await execution_layer.run_cpu(sha256_file, tmp_path)
         if suffix == ".pdf":
-            with pdfplumber.open(tmp_path) as pdf:
-                page = pdf.pages[0]
-                img = page.to_image(resolution=300)
-                pil_image = img.original
-                img_path = tmp_path + "_page1.jpg"
-                pil_image.save(img_path)
+            documento = await execution_layer.run_cpu(DocumentoPDF, tmp_path)
+            try:
+                indici = ordine_pagine(pagine, documento.num_pagine, rigoroso=True)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Pagine non valide '{pagine}': {e}")
         else:
-            img_path = tmp_path
-        # Esegui OCR
-        result = ocr_page_with_nanonets_s(img_path, max_new_tokens=15000)
-        # Pulisci file temporanei
-        os.remove(tmp_path)
-        if suffix == ".pdf":
-            os.remove(img_path)
-        return {"text": result}
+            indici = [0]
+        if not indici:
+            raise HTTPException(status_code=400, detail=f"Nessuna pagina valida in '{pagine}'")
+        metriche.osserva("document_pages", len(indici), file_type="ocr_stream")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore OCR Nanonets: {e}") 
\ No newline at end of file
+        if documento is not None:
+            documento.close()
+        rimuovi(tmp_path)
+        if isinstance(e, HTTPException):
+            raise
+        if isinstance(e, ExecutorBusyError):
+            raise HTTPException(status_code=503, detail=str(e))
+        raise HTTPException(status_code=500, detail=f"Errore OCR Nanonets: {e}")
+    
+    media_type = "text/event-stream" if formato == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        stream_ocr_pagine(tmp_path, documento, sha_contenuto, indici, formato),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# === Lavori asincroni ===
+# Le elaborazioni lunghe vengono accodate: il client riceve subito l'id e consulta stato e risultato
+
+coda_lavori = CodaLavori(**Config.get_jobs_config())
+
+async def lavoro_genera_diffida(file, parametri, fase):
+    fase("estrazione")
+    dati_contratto, dati_conteggio = await estrai_dati_percorsi(file["contratto"], file["conteggio"])
+    fase("pdf")
+    return await pdf_diffida(dati_contratto, dati_conteggio), "application/pdf", "diffida_compilata.pdf"
+
+async def lavoro_estrai_dati(file, parametri, fase):
+    fase("estrazione")
+    dati_contratto, dati_conteggio = await estrai_dati_percorsi(file["contratto"], file["conteggio"])
+    fase("calcoli")
+    return risposta_estrazione(dati_contratto, dati_conteggio)
+
+async def lavoro_ocr_nanonets(file, parametri, fase):
+    return await ocr_file(file["file"], fase=fase, **parametri)
+
+coda_lavori.registra("genera-diffida", lavoro_genera_diffida, fasi=("estrazione", "pdf"))
+coda_lavori.registra("estrai-dati", lavoro_estrai_dati, fasi=("estrazione", "calcoli"))
+coda_lavori.registra("ocr-nanonets", lavoro_ocr_nanonets, fasi=("rendering", "ocr"))
+
+# Le statistiche già esposte da /health vengono esportate anche su /metrics come gauge
+metriche.raccogli("models", registro_modelli.stats)
+metriche.raccogli("executor", execution_layer.stats)
+metriche.raccogli("cache", risultati_cache.stats)
+metriche.raccogli("ocr_batching", ocr_scheduler.stats)
+metriche.raccogli("ocr_tokens", statistiche_token.stats)
+metriche.raccogli("cascade", cascata.stats)
+metriche.raccogli("jobs", coda_lavori.stats)
+
+def risposta_lavoro(stato):
+    """Stato del lavoro con gli URL da consultare"""
+    return {
+        **stato,
+        "url_stato": f"/lavori/{stato['id']}",
+        "url_risultato": f"/lavori/{stato['id']}/risultato"
+    }
+
+async def accoda_lavoro(tipo, parametri, upload, estensioni):
+    """Salva gli upload (con gli stessi controlli degli endpoint sincroni) e accoda il lavoro"""
+    max_bytes = Config.get_upload_config()["max_file_bytes"]
+    percorsi = {}
+    try:
+        for nome, file in upload.items():
+            percorsi[nome] = await salva_upload(file, estensioni, max_bytes)
+        stato = await coda_lavori.accoda(tipo, parametri, percorsi)
+    except UploadRifiutato as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except CodaLavoriPiena as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    finally:
+        # Dopo l'accodamento i file sono già nella cartella del lavoro
+        rimuovi(*percorsi.values())
+    log.info("Lavoro %s accodato: %s", stato["id"], tipo, extra={"lavoro": stato["id"], "tipo": tipo})
+    return JSONResponse(status_code=202, content=risposta_lavoro(stato))
+
+@app.post("/lavori/genera-diffida/")
+async def lavori_genera_diffida(file_contratto: UploadFile = File(...), file_conteggio: UploadFile = File(...)):
+    """Accoda la generazione della diffida: risponde 202 con l'id del lavoro"""
+    return await accoda_lavoro(
+        "genera-diffida", {}, {"contratto": file_contratto, "conteggio": file_conteggio}, {".pdf"}
+    )
+
+@app.post("/lavori/estrai-dati/")
+async def lavori_estrai_dati(file_contratto: UploadFile = File(...), file_conteggio: UploadFile = File(...)):
+    """Accoda l'estrazione dei dati: il risultato è la risposta di /estrai-dati/"""
+    return await accoda_lavoro(
+        "estrai-dati", {}, {"contratto": file_contratto, "conteggio": file_conteggio}, {".pdf"}
+    )
+
+@app.post("/lavori/ocr-nanonets/")
+async def lavori_ocr_nanonets(file: UploadFile = File(...), roi: bool = False, file_type: str = "contratto",
+                              modalita: str = "testo"):
+    """Accoda l'OCR di /ocr-nanonets/, con gli stessi parametri"""
+    verifica_parametri_ocr(roi, file_type, modalita)
+    return await accoda_lavoro(
+        "ocr-nanonets", {"roi": roi, "file_type": file_type, "modalita": modalita}, {"file": file},
+        Config.ALLOWED_EXTENSIONS
+    )
+
+@app.get("/lavori/{id_lavoro}")
+async def stato_lavoro(id_lavoro: str, attesa: float = 0):
+    """Stato, fase e progresso del lavoro.
+
+    Con attesa=N (secondi, long-poll) la risposta arriva appena lo stato cambia
+    o il lavoro si conclude, al più dopo N secondi.
+    """
+    attesa = max(0.0, min(attesa, Config.JOBS_MAX_WAIT))
+    stato = await coda_lavori.attendi(id_lavoro, attesa) if attesa else await coda_lavori.leggi_stato(id_lavoro)
+    if stato is None:
+        raise HTTPException(status_code=404, detail="Lavoro inesistente o scaduto")
+    return risposta_lavoro(stato)
+
+@app.get("/lavori/{id_lavoro}/risultato")
+def risultato_lavoro(id_lavoro: str):
+    """Risultato del lavoro completato: PDF o JSON come l'endpoint sincrono.
+
+    Se il lavoro è ancora in corso risponde 202 con lo stato, se è fallito 409 con lo stato
+    e l'errore: la richiesta è riuscita, è il lavoro a non avere un risultato.
+    """
+    stato = coda_lavori.stato(id_lavoro)
+    if stato is None:
+        raise HTTPException(status_code=404, detail="Lavoro inesistente o scaduto")
+    if stato["stato"] == "errore":
+        return JSONResponse(status_code=409, content=risposta_lavoro(stato))
+    risultato = coda_lavori.risultato(id_lavoro)
+    if risultato is None:
+        return JSONResponse(status_code=202, content=risposta_lavoro(stato), headers={"Retry-After": "5"})
+    contenuto, media_type, nome_file = risultato
+    headers = {'Content-Disposition': f'attachment; filename="{nome_file}"'} if nome_file else None
+    return Response(contenuto, media_type=media_type, headers=headers)
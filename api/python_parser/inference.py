@@ -0,0 +1,84 @@
+import contextlib
+import importlib.util
+import torch
+from logs import get_logger
+
+log = get_logger("inference")
+
+DTYPE = {
+    "auto": "auto",
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    # int8: pesi caricati in float32 e poi quantizzati dinamicamente
+    "int8": torch.float32,
+}
+
+_interop_configurati = False
+
+
+def gpu_disponibile(model_config) -> bool:
+    return model_config["device"] != "cpu" and torch.cuda.is_available()
+
+
+def configura_thread(model_config):
+    """Applica il numero di thread intra-op e inter-op del profilo.
+
+    I thread inter-op si possono impostare una sola volta, prima del primo
+    lavoro parallelo: le richieste successive vengono ignorate con un avviso.
+    """
+    global _interop_configurati
+    if model_config["intra_op_threads"] > 0:
+        torch.set_num_threads(model_config["intra_op_threads"])
+    if model_config["inter_op_threads"] > 0 and not _interop_configurati:
+        try:
+            torch.set_num_interop_threads(model_config["inter_op_threads"])
+        except RuntimeError as e:
+            log.warning("Thread inter-op non modificabili: %s", e)
+        _interop_configurati = True
+
+
+def risolvi_attention(model_config) -> str:
+    """Flash attention solo su GPU con flash_attn installato, altrimenti SDPA"""
+    attn = model_config["attn_implementation"]
+    flash_disponibile = gpu_disponibile(model_config) and importlib.util.find_spec("flash_attn") is not None
+    if attn == "auto":
+        return "flash_attention_2" if flash_disponibile else "sdpa"
+    if attn == "flash_attention_2" and not flash_disponibile:
+        log.warning("flash_attention_2 non disponibile su questo nodo, uso sdpa")
+        return "sdpa"
+    return attn
+
+
+def dtype_pesi(model_config):
+    dtype = model_config["dtype"]
+    if dtype not in DTYPE:
+        raise ValueError(f"dtype non supportato: {dtype}")
+    return DTYPE[dtype]
+
+
+def ottimizza(model, model_config):
+    """Applica quantizzazione int8 e torch.compile secondo il profilo"""
+    model.eval()
+    if model_config["dtype"] == "int8":
+        if gpu_disponibile(model_config):
+            log.warning("Quantizzazione dinamica int8 disponibile solo su CPU, ignorata")
+        else:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if model_config["compile"]:
+        # Si compila solo forward: generate e gli altri metodi del modello restano disponibili
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+def contesto_inferenza(model_config):
+    """Autocast bf16 su CPU per i modelli caricati in float32 (es. PDF-Extract-Kit)"""
+    if model_config["dtype"] == "bfloat16" and not gpu_disponibile(model_config):
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def descrivi(model_config) -> str:
+    return (f"profilo={model_config['profile']} device={model_config['device']} "
+            f"attention={risolvi_attention(model_config)} dtype={model_config['dtype']} "
+            f"compile={model_config['compile']} thread={torch.get_num_threads()}/{torch.get_num_interop_threads()}")
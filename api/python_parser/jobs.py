@@ -0,0 +1,311 @@
+import asyncio
+import functools
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from executor import ExecutorBusyError
+from logs import get_logger
+
+log = get_logger("jobs")
+
+IN_CODA, IN_CORSO, COMPLETATO, ERRORE = "in_coda", "in_corso", "completato", "errore"
+TERMINALI = (COMPLETATO, ERRORE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lavori (
+    id TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,
+    stato TEXT NOT NULL,
+    fase TEXT,
+    progresso REAL NOT NULL DEFAULT 0,
+    parametri TEXT NOT NULL,
+    file TEXT NOT NULL,
+    risultato BLOB,
+    media_type TEXT,
+    nome_file TEXT,
+    errore TEXT,
+    tentativi INTEGER NOT NULL DEFAULT 0,
+    creato REAL NOT NULL,
+    aggiornato REAL NOT NULL,
+    scadenza REAL
+);
+CREATE INDEX IF NOT EXISTS lavori_stato ON lavori (stato, creato);
+"""
+
+CAMPI_STATO = ("id", "tipo", "stato", "fase", "progresso", "errore", "tentativi", "creato", "aggiornato", "scadenza")
+
+
+class CodaLavoriPiena(Exception):
+    """Sollevata quando i lavori in attesa hanno raggiunto il limite configurato"""
+
+
+class CodaLavori:
+    """Coda persistente dei lavori asincroni, su SQLite, con un pool di worker nell'event loop.
+
+    I file di ogni lavoro vengono spostati in una cartella dedicata e il lavoro
+    registrato nel database: dopo un riavvio i lavori in attesa ripartono e
+    quelli interrotti tornano in coda (fino a max_tentativi). Ogni gestore
+    dichiara le sue fasi, e il progresso è la frazione di fasi concluse.
+    I risultati restano disponibili per ttl secondi dalla conclusione.
+    Il lavoro pesante passa comunque dai pool di esecuzione: i worker limitano
+    solo quanti lavori avanzano insieme. Scritture su SQLite e spostamenti dei
+    file girano in un thread dedicato, fuori dall'event loop e nell'ordine in
+    cui vengono inviati (una fase non può sovrascrivere l'esito del lavoro).
+    Pensata per un solo processo.
+    """
+
+    def __init__(self, db_path: str, dir_file: str, workers: int, ttl: int, max_in_coda: int, max_tentativi: int):
+        self.dir_file = dir_file
+        self.workers = max(1, workers)
+        self.ttl = ttl
+        self.max_in_coda = max_in_coda
+        self.max_tentativi = max(1, max_tentativi)
+        self._gestori = {}
+        self._lock = threading.Lock()
+        os.makedirs(dir_file, exist_ok=True)
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lavori")
+        self._tasks = []
+        self._evento = None
+        self._stats = {"completed": 0, "failed": 0, "recovered": 0, "expired": 0}
+
+    def registra(self, tipo: str, gestore, fasi):
+        """gestore(file, parametri, fase) è una coroutine che restituisce un dict (JSON)
+        o una tupla (contenuto, media_type, nome_file); fase(nome) segnala l'avanzamento"""
+        self._gestori[tipo] = (gestore, tuple(fasi))
+
+    def _esegui(self, sql: str, parametri=()):
+        with self._lock:
+            return self._db.execute(sql, parametri).fetchall()
+
+    async def _in_thread(self, funzione, *args, **kwargs):
+        """Esegue funzione nel thread della coda, senza bloccare l'event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self._io, functools.partial(funzione, *args, **kwargs))
+
+    def _notifica(self):
+        """Sveglia i worker e le richieste in long-poll"""
+        if self._evento is not None:
+            self._evento.set()
+            self._evento = asyncio.Event()
+
+    # === Sottomissione e consultazione ===
+
+    async def accoda(self, tipo: str, parametri: dict, file: dict) -> dict:
+        """Registra un lavoro; file (nome -> percorso temporaneo) viene spostato nella cartella del lavoro"""
+        if tipo not in self._gestori:
+            raise ValueError(f"Tipo di lavoro sconosciuto: {tipo}")
+        stato = await self._in_thread(self._registra, tipo, parametri, file)
+        self._notifica()
+        return stato
+
+    def _registra(self, tipo: str, parametri: dict, file: dict) -> dict:
+        if self.max_in_coda > 0:
+            in_coda = self._esegui("SELECT COUNT(*) FROM lavori WHERE stato = ?", (IN_CODA,))[0][0]
+            if in_coda >= self.max_in_coda:
+                raise CodaLavoriPiena(f"Troppi lavori in attesa ({in_coda}): riprova più tardi")
+
+        id_lavoro = uuid.uuid4().hex
+        cartella = os.path.join(self.dir_file, id_lavoro)
+        os.makedirs(cartella)
+        spostati = {}
+        try:
+            for nome, percorso in file.items():
+                spostati[nome] = shutil.move(percorso, os.path.join(cartella, nome + os.path.splitext(percorso)[-1]))
+            adesso = time.time()
+            self._esegui(
+                "INSERT INTO lavori (id, tipo, stato, parametri, file, creato, aggiornato) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (id_lavoro, tipo, IN_CODA, json.dumps(parametri), json.dumps(spostati), adesso, adesso)
+            )
+        except BaseException:
+            shutil.rmtree(cartella, ignore_errors=True)
+            raise
+        return self.stato(id_lavoro)
+
+    def stato(self, id_lavoro: str):
+        """Stato, fase e progresso del lavoro (None se inesistente o scaduto)"""
+        righe = self._esegui(f"SELECT {', '.join(CAMPI_STATO)} FROM lavori WHERE id = ?", (id_lavoro,))
+        if not righe:
+            return None
+        stato = dict(righe[0])
+        if stato["stato"] == IN_CODA:
+            stato["posizione"] = self._esegui(
+                "SELECT COUNT(*) FROM lavori WHERE stato = ? AND creato <= ?", (IN_CODA, stato["creato"])
+            )[0][0]
+        return stato
+
+    def risultato(self, id_lavoro: str):
+        """(contenuto, media_type, nome_file) del lavoro completato, altrimenti None"""
+        righe = self._esegui(
+            "SELECT risultato, media_type, nome_file FROM lavori WHERE id = ? AND stato = ?", (id_lavoro, COMPLETATO)
+        )
+        return tuple(righe[0]) if righe else None
+
+    async def leggi_stato(self, id_lavoro: str):
+        """stato() in un thread: la lettura può attendere il lock durante il salvataggio di un risultato"""
+        return await asyncio.to_thread(self.stato, id_lavoro)
+
+    async def attendi(self, id_lavoro: str, secondi: float):
+        """Long-poll: restituisce lo stato appena cambia (o il lavoro si conclude), al più dopo secondi"""
+        stato = await self.leggi_stato(id_lavoro)
+        scadenza = time.monotonic() + secondi
+        while stato is not None and stato["stato"] not in TERMINALI and self._evento is not None:
+            rimanente = scadenza - time.monotonic()
+            if rimanente <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._evento.wait(), rimanente)
+            except asyncio.TimeoutError:
+                break
+            nuovo = await self.leggi_stato(id_lavoro)
+            if nuovo is None or nuovo["aggiornato"] != stato["aggiornato"]:
+                return nuovo
+        return stato
+
+    # === Esecuzione ===
+
+    def _prendi(self):
+        """Assegna al worker il lavoro in attesa più vecchio"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                riga = self._db.execute(
+                    "SELECT id, tipo, parametri, file, tentativi FROM lavori WHERE stato = ? ORDER BY creato LIMIT 1", (IN_CODA,)
+                ).fetchone()
+                if riga is not None:
+                    self._db.execute(
+                        "UPDATE lavori SET stato = ?, tentativi = tentativi + 1, aggiornato = ? WHERE id = ?",
+                        (IN_CORSO, time.time(), riga["id"])
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return riga
+
+    def _scrivi(self, id_lavoro: str, **campi):
+        campi["aggiornato"] = time.time()
+        self._esegui(
+            f"UPDATE lavori SET {', '.join(f'{campo} = ?' for campo in campi)} WHERE id = ?",
+            (*campi.values(), id_lavoro)
+        )
+
+    def _salva_esito(self, id_lavoro: str, **campi):
+        """Salva l'esito, fissa la scadenza ed elimina i file del lavoro"""
+        self._scrivi(id_lavoro, scadenza=time.time() + self.ttl, **campi)
+        shutil.rmtree(os.path.join(self.dir_file, id_lavoro), ignore_errors=True)
+
+    async def _aggiorna(self, id_lavoro: str, **campi):
+        await self._in_thread(self._scrivi, id_lavoro, **campi)
+        self._notifica()
+
+    async def _concludi(self, id_lavoro: str, **campi):
+        await self._in_thread(self._salva_esito, id_lavoro, **campi)
+        self._notifica()
+
+    async def _elabora(self, riga):
+        gestore, fasi = self._gestori[riga["tipo"]]
+        loop = asyncio.get_running_loop()
+
+        def fase(nome: str):
+            # Chiamata dai gestori senza await: la scrittura viene accodata al thread della coda
+            campi = {"fase": nome}
+            if nome in fasi:
+                campi["progresso"] = round(fasi.index(nome) / len(fasi), 3)
+            futuro = self._io.submit(self._scrivi, riga["id"], **campi)
+            futuro.add_done_callback(lambda _: loop.call_soon_threadsafe(self._notifica))
+
+        risultato = await gestore(json.loads(riga["file"]), json.loads(riga["parametri"]), fase)
+        if isinstance(risultato, tuple):
+            contenuto, media_type, nome_file = risultato
+        else:
+            contenuto, media_type, nome_file = json.dumps(risultato).encode("utf-8"), "application/json", None
+        await self._concludi(riga["id"], stato=COMPLETATO, fase=None, progresso=1.0,
+                       risultato=contenuto, media_type=media_type, nome_file=nome_file)
+        self._stats["completed"] += 1
+
+    async def _worker(self):
+        while True:
+            evento = self._evento
+            riga = await self._in_thread(self._prendi)
+            if riga is None:
+                await evento.wait()
+                continue
+            self._notifica()
+            try:
+                await self._elabora(riga)
+            except ExecutorBusyError:
+                # Pool saturi: il lavoro torna in coda senza consumare un tentativo
+                await self._aggiorna(riga["id"], stato=IN_CODA, fase=None, tentativi=riga["tentativi"])
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                # Arresto del server: il lavoro resta in corso e riparte al prossimo avvio
+                raise
+            except Exception as e:
+                log.error("Lavoro %s (%s) fallito: %s", riga["id"], riga["tipo"], e,
+                          extra={"lavoro": riga["id"], "tipo": riga["tipo"]})
+                await self._concludi(riga["id"], stato=ERRORE, errore=str(e))
+                self._stats["failed"] += 1
+
+    def _recupera(self):
+        """All'avvio i lavori rimasti in corso tornano in coda, o falliscono se hanno esaurito i tentativi"""
+        interrotti = self._esegui("SELECT id, tentativi FROM lavori WHERE stato = ?", (IN_CORSO,))
+        for riga in interrotti:
+            if riga["tentativi"] >= self.max_tentativi:
+                self._salva_esito(riga["id"], stato=ERRORE, errore="Lavoro interrotto dal riavvio del server troppe volte")
+            else:
+                self._scrivi(riga["id"], stato=IN_CODA)
+        if interrotti:
+            self._stats["recovered"] += len(interrotti)
+            log.warning("Lavori interrotti recuperati: %d", len(interrotti))
+
+    def pulisci(self) -> int:
+        """Elimina i lavori conclusi oltre la scadenza"""
+        scaduti = self._esegui("SELECT id FROM lavori WHERE scadenza IS NOT NULL AND scadenza < ?", (time.time(),))
+        for riga in scaduti:
+            shutil.rmtree(os.path.join(self.dir_file, riga["id"]), ignore_errors=True)
+        self._esegui("DELETE FROM lavori WHERE scadenza IS NOT NULL AND scadenza < ?", (time.time(),))
+        self._stats["expired"] += len(scaduti)
+        return len(scaduti)
+
+    async def _pulizia(self):
+        while True:
+            await asyncio.sleep(max(1, min(60, self.ttl)))
+            await self._in_thread(self.pulisci)
+
+    async def avvia(self):
+        """Recupera i lavori interrotti e avvia worker e pulizia nell'event loop corrente"""
+        self._evento = asyncio.Event()
+        await self._in_thread(self._recupera)
+        await self._in_thread(self.pulisci)
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(loop.create_task(self._pulizia()))
+
+    def chiudi(self):
+        """Ferma worker e pulizia: i lavori in corso riprenderanno al prossimo avvio"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self) -> dict:
+        conteggi = dict(self._esegui("SELECT stato, COUNT(*) FROM lavori GROUP BY stato"))
+        return {
+            "workers": self.workers,
+            "ttl": self.ttl,
+            "queued": conteggi.get(IN_CODA, 0),
+            "running": conteggi.get(IN_CORSO, 0),
+            "done": conteggi.get(COMPLETATO, 0),
+            "errors": conteggi.get(ERRORE, 0),
+            **self._stats,
+        }
@@ -0,0 +1,177 @@
+import io
+import re
+import zipfile
+from string import Formatter
+from fpdf import FPDF
+
+# Testo della diffida: (paragrafo con i segnaposto dei valori variabili, spazio dopo in mm)
+PARAGRAFI_DIFFIDA = (
+    ("Oggetto: Lettera di diffida per il Sig. {nome_completo} e proposta di stipula di convenzione di negoziazione assistita ai sensi degli artt. 2 e 3 del Decreto Legge n. 132/2014", 5),
+    ("Spett.le ______________,", 5),
+    ("scrivo la presente in nome e per conto del Sig. {nome_completo} (C.F. {codice_fiscale}), nato a {luogo_nascita} il {data_nascita}, per rappresentarVi quanto segue.", 5),
+    ("Alla luce delle verifiche effettuate sul rapporto contrattuale in oggetto - il quale invero è caratterizzato da una evidente genericità nella formulazione delle voci di costo applicate - è emerso che il Vostro istituto di credito ha illegittimamente trattenuto delle somme non dovute dal mio assistito e compiuto plurime violazioni della normativa di settore.", 5),
+    ("Difatti, avendo il mio assistito estinto anticipatamente il suindicato contratto di finanziamento quando ancora residuavano da versare {rate_residue} rate delle {durata_totale} convenute, lo stesso ha diritto, a norma dell'art. 125 sexies T.U.B., alla restituzione della corrispettiva quota delle commissioni, degli oneri, dei premi assicurativi sottoscritti a fronte del finanziamento e delle spese a lui imputate.", 5),
+    ("Nello specifico il mio assistito ha corrisposto complessivi {importo_rimborso} a titolo di commissioni, oneri, spese e polizze.", 5),
+    ("Di conseguenza - al netto dello storno di euro 0,00 applicato in sede estintiva, e fatta salva ogni maggior richiesta all'esito dell'analisi tecnico contabile - spetta la restituzione di complessivi {importo_rimborso} calcolati secondo il metodo pro rata temporis.", 5),
+    ("Inoltre il rapporto appare viziato anche sotto il profilo della trasparenza delle condizioni praticate e dei tassi applicati, integrando pertanto una condotta evidentemente contraria a buona fede e correttezza.", 5),
+    ("Pertanto Vi invito e diffido a restituire al mio assistito, entro e non oltre il termine di 15 giorni dal ricevimento della presente, la complessiva somma di {importo_rimborso} oltre interessi dal dì del dovuto sino al soddisfo e spese.", 10),
+    ("Avv. Gabriele Scappaticci", 0),
+)
+
+
+def valori_diffida(dati_contratto, dati_conteggio, calcoli) -> dict:
+    """Valori variabili della diffida, con gli stessi default della lettera singola"""
+    nome_completo = f"{dati_contratto.get('cognome', '')} {dati_contratto.get('nome', '')}".strip()
+    return {
+        "nome_completo": nome_completo or "Cliente",
+        "codice_fiscale": dati_contratto.get('codice_fiscale', 'Non disponibile'),
+        "data_nascita": dati_contratto.get('data_nascita', 'Non disponibile'),
+        "luogo_nascita": dati_contratto.get('luogo_nascita', 'Non disponibile'),
+        "rate_residue": calcoli.get('rate_residue', 0),
+        "durata_totale": calcoli.get('durata_totale', 0),
+        # I font standard del PDF non hanno il simbolo €: l'importo è scritto come nel resto della lettera
+        "importo_rimborso": "euro " + f"{calcoli.get('rimborso', 0):.2f}".replace('.', ','),
+    }
+
+
+class ModelloLettera:
+    """Lettera con impaginazione precompilata: cambiano solo i valori dei segnaposto.
+
+    Il costo di FPDF.multi_cell è quasi tutto nel calcolo degli a capo, carattere per
+    carattere. Qui i paragrafi senza segnaposto vengono spezzati in righe una volta
+    sola e le larghezze delle parole fisse sono calcolate in anticipo; per ogni lettera
+    si misurano solo le parole dei valori e ogni riga viene scritta direttamente.
+    Gli a capo seguono lo stesso criterio di multi_cell (a parole, allineamento a sinistra).
+    """
+
+    def __init__(self, paragrafi, font: str = "helvetica", dimensione: int = 12, altezza_riga: float = 10):
+        self.font = font
+        self.dimensione = dimensione
+        self.altezza_riga = altezza_riga
+        misura = FPDF()
+        misura.set_font(font, size=dimensione)
+        self.larghezza = misura.epw - 2 * misura.c_margin
+        self._misura = misura
+        self._caratteri = {}
+        self._parole = {}
+        self.spazio = self._larghezza_parola(" ")
+        self.paragrafi = []
+        for testo, spazio_dopo in paragrafi:
+            parti = list(Formatter().parse(testo))
+            campi = {nome for _, nome, _, _ in parti if nome}
+            for fisso, *_ in parti:
+                for parola in fisso.split(" "):
+                    self._parole[parola] = self._larghezza_parola(parola)
+            # Paragrafo fisso: righe pronte; con segnaposto: parole fisse già misurate
+            righe = tuple(self.a_capo(testo)) if not campi else None
+            self.paragrafi.append((testo, righe, spazio_dopo))
+
+    def _larghezza_parola(self, parola: str) -> float:
+        if parola in self._parole:
+            return self._parole[parola]
+        larghezza = 0.0
+        for carattere in parola:
+            misura = self._caratteri.get(carattere)
+            if misura is None:
+                misura = self._caratteri[carattere] = self._misura.get_string_width(carattere)
+            larghezza += misura
+        return larghezza
+
+    def a_capo(self, testo: str) -> list:
+        """Righe del paragrafo nella larghezza utile della pagina"""
+        righe, riga, larghezza = [], [], 0.0
+        for parola in testo.split(" "):
+            misura = self._larghezza_parola(parola)
+            if riga and larghezza + self.spazio + misura > self.larghezza:
+                righe.append(" ".join(riga))
+                riga, larghezza = [], 0.0
+            if misura > self.larghezza:
+                # Parola più lunga della riga: spezzata a caratteri come fa multi_cell
+                pezzo = ""
+                for carattere in parola:
+                    if pezzo and self._larghezza_parola(pezzo + carattere) > self.larghezza:
+                        righe.append(pezzo)
+                        pezzo = ""
+                    pezzo += carattere
+                parola, misura = pezzo, self._larghezza_parola(pezzo)
+            larghezza += (self.spazio if riga else 0) + misura
+            riga.append(parola)
+        if riga:
+            righe.append(" ".join(riga))
+        return righe
+
+    def _documento(self) -> FPDF:
+        pdf = FPDF()
+        pdf.set_font(self.font, size=self.dimensione)
+        return pdf
+
+    def _scrivi(self, pdf: FPDF, valori: dict):
+        pdf.add_page()
+        # Stessa posizione del testo di una cell allineata a sinistra, senza il suo costo
+        x = pdf.l_margin + pdf.c_margin
+        base = 0.5 * self.altezza_riga + 0.3 * pdf.font_size
+        for testo, righe, spazio_dopo in self.paragrafi:
+            for riga in righe or self.a_capo(testo.format(**valori)):
+                if pdf.y + self.altezza_riga > pdf.page_break_trigger:
+                    pdf.add_page()
+                pdf.text(x, pdf.y + base, riga)
+                pdf.y += self.altezza_riga
+            pdf.y += spazio_dopo
+
+    def rendi(self, valori: dict) -> bytes:
+        """PDF di una lettera"""
+        pdf = self._documento()
+        self._scrivi(pdf, valori)
+        return bytes(pdf.output())
+
+    def rendi_unico(self, lista_valori) -> bytes:
+        """Un solo PDF con tutte le lettere, ognuna dall'inizio di una pagina"""
+        pdf = self._documento()
+        for valori in lista_valori:
+            self._scrivi(pdf, valori)
+        return bytes(pdf.output())
+
+
+modello_diffida = ModelloLettera(PARAGRAFI_DIFFIDA)
+
+
+def rendi_lotto(lista_valori, unico: bool):
+    """Diffide di un lotto: un PDF unico o un PDF per lettera (eseguibile in un processo del pool)"""
+    if unico:
+        return modello_diffida.rendi_unico(lista_valori)
+    return [modello_diffida.rendi(valori) for valori in lista_valori]
+
+
+def unisci_pdf(parti) -> bytes:
+    """Concatena le pagine di più PDF in un unico documento"""
+    if len(parti) == 1:
+        return parti[0]
+    import pypdfium2 as pdfium
+    unito = pdfium.PdfDocument.new()
+    for parte in parti:
+        unito.import_pages(pdfium.PdfDocument(parte))
+    buffer = io.BytesIO()
+    unito.save(buffer)
+    return buffer.getvalue()
+
+
+def nome_file_lettera(identificativo, numero: int) -> str:
+    """Nome del PDF nell'archivio: dall'id della pratica se presente, altrimenti dal numero"""
+    if identificativo in (None, ""):
+        return f"diffida_{numero:05d}.pdf"
+    return "diffida_" + re.sub(r"[^\w.-]+", "_", str(identificativo)).strip("._")[:100] + ".pdf"
+
+
+def archivio_zip(nomi, documenti) -> bytes:
+    """ZIP dei PDF (già compressi: salvati senza ricomprimerli), con nomi resi univoci"""
+    buffer = io.BytesIO()
+    usati = set()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archivio:
+        for nome, documento in zip(nomi, documenti):
+            radice, n = nome[:-4], 1
+            while nome in usati:
+                n += 1
+                nome = f"{radice}_{n}.pdf"
+            usati.add(nome)
+            archivio.writestr(nome, documento)
+    return buffer.getvalue()
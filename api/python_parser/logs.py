@@ -0,0 +1,55 @@
+import json
+import logging
+import sys
+import time
+
+# Attributi di ogni LogRecord: il resto sono i campi strutturati passati con extra={...}
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def _campi(record) -> dict:
+    return {chiave: valore for chiave, valore in vars(record).items() if chiave not in _STANDARD}
+
+
+class FormatoJSON(logging.Formatter):
+    """Una riga JSON per evento: ora, livello, logger, messaggio e campi strutturati"""
+
+    def format(self, record):
+        voce = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "livello": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **_campi(record),
+        }
+        if record.exc_info:
+            voce["eccezione"] = self.formatException(record.exc_info)
+        return json.dumps(voce, ensure_ascii=False, default=str)
+
+
+class FormatoTesto(logging.Formatter):
+    """Messaggio leggibile seguito dai campi strutturati come chiave=valore"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        riga = super().format(record)
+        campi = _campi(record)
+        if campi:
+            riga += " " + " ".join(f"{chiave}={valore}" for chiave, valore in campi.items())
+        return riga
+
+
+def configura_log(livello: str = "INFO", formato: str = "testo"):
+    """Configura il logger dell'applicazione (pdf_parser.*): livello minimo e formato testo o json"""
+    gestore = logging.StreamHandler(sys.stdout)
+    gestore.setFormatter(FormatoJSON() if formato == "json" else FormatoTesto())
+    radice = logging.getLogger("pdf_parser")
+    radice.handlers[:] = [gestore]
+    radice.setLevel(livello.upper())
+    radice.propagate = False
+
+
+def get_logger(nome: str) -> logging.Logger:
+    return logging.getLogger(f"pdf_parser.{nome}")
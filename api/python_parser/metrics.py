@@ -0,0 +1,208 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from config import Config
+
+BUCKET_SECONDI = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BUCKET_PAGINE = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+BUCKET_TOKEN_SECONDO = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+# nome -> (tipo, descrizione, bucket degli istogrammi)
+DEFINIZIONI = {
+    "stage_seconds": ("histogram", "Durata delle fasi di elaborazione", BUCKET_SECONDI),
+    "http_request_seconds": ("histogram", "Durata delle richieste HTTP per route", BUCKET_SECONDI),
+    "http_requests_total": ("counter", "Richieste HTTP per route e codice di stato", None),
+    "upload_bytes_total": ("counter", "Byte ricevuti negli upload", None),
+    "document_pages": ("histogram", "Pagine dei documenti elaborati per richiesta", BUCKET_PAGINE),
+    "ocr_tokens_per_second": ("histogram", "Token generati al secondo da Nanonets per batch", BUCKET_TOKEN_SECONDO),
+    "ocr_generated_tokens_total": ("counter", "Token generati da Nanonets", None),
+    "ocr_pages_total": ("counter", "Pagine o ritagli trascritti da Nanonets", None),
+    "bulk_busy_retries_total": ("counter", "Tentativi ripetuti dall'estrazione massiva per pool saturi", None),
+    "model_load_seconds": ("gauge", "Durata dell'ultimo caricamento del modello (warm-up incluso)", None),
+    "model_loads_total": ("counter", "Caricamenti dei modelli per esito", None),
+}
+
+
+class Istogramma:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.conteggi = [0] * (len(bucket) + 1)
+        self.somma = 0.0
+
+    def osserva(self, valore: float):
+        self.conteggi[bisect_left(self.bucket, valore)] += 1
+        self.somma += valore
+
+
+class _Fase:
+    """Cronometra un blocco e registra la durata nell'istogramma delle fasi"""
+
+    __slots__ = ("metriche", "etichette", "inizio")
+
+    def __init__(self, metriche, etichette):
+        self.metriche = metriche
+        self.etichette = etichette
+
+    def __enter__(self):
+        self.inizio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metriche.osserva("stage_seconds", time.perf_counter() - self.inizio, **self.etichette)
+        return False
+
+
+class _Nulla:
+    """Contesto vuoto usato quando le metriche sono disabilitate"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULLA = _Nulla()
+
+
+def _escape(valore) -> str:
+    return str(valore).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etichette(etichette, extra=None) -> str:
+    coppie = list(etichette) + ([extra] if extra else [])
+    if not coppie:
+        return ""
+    return "{" + ",".join(f'{nome}="{_escape(valore)}"' for nome, valore in coppie) + "}"
+
+
+def _numero(valore) -> str:
+    return repr(float(valore)) if not float(valore).is_integer() else str(int(valore))
+
+
+class Metriche:
+    """Contatori, gauge e istogrammi in memoria, esportati in formato testo Prometheus.
+
+    Con enabled=False ogni registrazione ritorna subito e fase() restituisce un
+    contesto vuoto condiviso, quindi il costo sul percorso critico è trascurabile.
+    Le statistiche già raccolte dai componenti (pool, cache, coda) vengono esportate
+    come gauge al momento della lettura, tramite le funzioni registrate con raccogli().
+    """
+
+    def __init__(self, enabled: bool, prefisso: str = "pdf_parser"):
+        self.enabled = enabled
+        self.prefisso = prefisso
+        self._lock = threading.Lock()
+        self._serie = {}  # nome -> {etichette ordinate: valore o Istogramma}
+        self._raccolte = []
+
+    def fase(self, stage: str, **etichette):
+        """with metriche.fase("rendering"): ... registra la durata del blocco"""
+        if not self.enabled:
+            return _NULLA
+        return _Fase(self, {"stage": stage, **etichette})
+
+    def osserva(self, nome: str, valore: float, **etichette):
+        if not self.enabled:
+            return
+        chiave = tuple(sorted(etichette.items()))
+        with self._lock:
+            serie = self._serie.setdefault(nome, {})
+            istogramma = serie.get(chiave)
+            if istogramma is None:
+                istogramma = serie[chiave] = Istogramma(DEFINIZIONI[nome][2])
+            istogramma.osserva(valore)
+
+    def incrementa(self, nome: str, valore: float = 1, **etichette):
+        if not self.enabled:
+            return
+        chiave = tuple(sorted(etichette.items()))
+        with self._lock:
+            serie = self._serie.setdefault(nome, {})
+            serie[chiave] = serie.get(chiave, 0) + valore
+
+    def imposta(self, nome: str, valore: float, **etichette):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._serie.setdefault(nome, {})[tuple(sorted(etichette.items()))] = valore
+
+    def raccogli(self, nome: str, funzione):
+        """funzione() restituisce un dizionario (anche annidato): i valori numerici diventano gauge nome_chiave"""
+        self._raccolte.append((nome, funzione))
+
+    def _appiattisci(self, percorso: str, valore, righe: list):
+        if isinstance(valore, dict):
+            for chiave, figlio in valore.items():
+                self._appiattisci(f"{percorso}_{chiave}", figlio, righe)
+        elif isinstance(valore, (int, float)) and valore is not None:
+            righe.append((re.sub(r"[^a-zA-Z0-9_]", "_", percorso), valore))
+
+    def esporta(self) -> str:
+        """Tutte le metriche in formato testo Prometheus (version 0.0.4)"""
+        righe = []
+        with self._lock:
+            serie = {nome: dict(valori) for nome, valori in self._serie.items()}
+            istogrammi = {
+                nome: {chiave: (list(h.conteggi), h.somma) for chiave, h in valori.items()}
+                for nome, valori in serie.items() if DEFINIZIONI[nome][0] == "histogram"
+            }
+        for nome, (tipo, descrizione, bucket) in DEFINIZIONI.items():
+            if nome not in serie:
+                continue
+            completo = f"{self.prefisso}_{nome}"
+            righe += [f"# HELP {completo} {descrizione}", f"# TYPE {completo} {tipo}"]
+            for chiave in sorted(serie[nome]):
+                if tipo != "histogram":
+                    righe.append(f"{completo}{_etichette(chiave)} {_numero(serie[nome][chiave])}")
+                    continue
+                conteggi, somma = istogrammi[nome][chiave]
+                cumulato = 0
+                for limite, conteggio in zip(list(bucket) + ["+Inf"], conteggi):
+                    cumulato += conteggio
+                    righe.append(f"{completo}_bucket{_etichette(chiave, ('le', limite))} {cumulato}")
+                righe.append(f"{completo}_sum{_etichette(chiave)} {_numero(somma)}")
+                righe.append(f"{completo}_count{_etichette(chiave)} {cumulato}")
+
+        for nome, funzione in self._raccolte:
+            try:
+                valori = []
+                self._appiattisci(f"{self.prefisso}_{nome}", funzione(), valori)
+            except Exception:
+                continue
+            for completo, valore in valori:
+                righe += [f"# TYPE {completo} gauge", f"{completo} {_numero(valore)}"]
+        return "\n".join(righe) + "\n"
+
+
+class MetricheRichieste:
+    """Middleware ASGI: durata e codice di stato di ogni richiesta, per route (non per URL)"""
+
+    def __init__(self, app, metriche: Metriche):
+        self.app = app
+        self.metriche = metriche
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.metriche.enabled:
+            return await self.app(scope, receive, send)
+        inizio = time.perf_counter()
+        stato = 500
+
+        async def invia(messaggio):
+            nonlocal stato
+            if messaggio["type"] == "http.response.start":
+                stato = messaggio["status"]
+            await send(messaggio)
+
+        try:
+            await self.app(scope, receive, invia)
+        finally:
+            # La route viene impostata dal router: le richieste senza route non creano serie nuove
+            route = getattr(scope.get("route"), "path", "non_trovata")
+            self.metriche.osserva("http_request_seconds", time.perf_counter() - inizio,
+                                  route=route, method=scope["method"])
+            self.metriche.incrementa("http_requests_total", route=route, method=scope["method"], status=stato)
+
+
+metriche = Metriche(Config.METRICS_ENABLED)
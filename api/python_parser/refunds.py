@@ -0,0 +1,169 @@
+import csv
+import io
+import numpy as np
+from rules import euro
+
+METODI = ("pro_rata", "curva_interessi", "misto")
+COLONNE = ("costi_totali", "durata_mesi", "rate_scadute")
+COLONNE_OPZIONALI = ("tan", "costi_upfront")
+
+
+def quota_curva_interessi(durata, residue, tan=None):
+    """Quota degli interessi ancora da pagare sul totale, in un piano di ammortamento alla francese.
+
+    Con il TAN annuo (in percentuale) la quota è quella esatta del piano; senza TAN,
+    o con TAN zero, si usa il suo limite per tasso che tende a zero, la "regola del 78":
+    residue * (residue + 1) / (durata * (durata + 1)).
+    """
+    durata = np.asarray(durata, dtype=float)
+    residue = np.clip(np.asarray(residue, dtype=float), 0, durata)
+    quota = residue * (residue + 1) / np.where(durata > 0, durata * (durata + 1), 1)
+    if tan is None:
+        return quota
+    tasso = np.nan_to_num(np.asarray(tan, dtype=float)) / 1200
+    # Sotto lo 0,01% annuo la formula esatta perde precisione: coincide con la regola del 78
+    positivo = tasso > 1e-7
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sconto = 1 / (1 + tasso)
+        # Interessi residui / totali: ((n-k) - (1 - v^(n-k)) / i) / (n - (1 - v^n) / i)
+        residui = residue - (1 - sconto ** residue) / tasso
+        totali = durata - (1 - sconto ** durata) / tasso
+        esatta = np.where(totali > 0, residui / totali, 0)
+    return np.where(positivo, esatta, quota)
+
+
+def calcola_rimborsi(costi_totali, durata_mesi, rate_scadute, metodo: str = "pro_rata",
+                     tan=None, costi_upfront=None) -> dict:
+    """Calcola i rimborsi di molte pratiche insieme, con operazioni vettoriali.
+
+    - pro_rata: costi rimborsati in proporzione alle rate residue (come esegui_calcoli)
+    - curva_interessi: costi rimborsati in proporzione agli interessi residui
+    - misto: costi up-front (costi_upfront) con la curva degli interessi, il resto pro rata
+    Restituisce colonne NumPy con le stesse chiavi di esegui_calcoli, non arrotondate
+    (righe_rimborsi arrotonda come esegui_calcoli); "valida" è falsa per le righe con
+    durata zero, che hanno rimborso 0.
+    """
+    if metodo not in METODI:
+        raise ValueError(f"Metodo sconosciuto: {metodo}. Usa {', '.join(METODI)}")
+    costi_totali = np.asarray(costi_totali, dtype=float)
+    durata = np.asarray(durata_mesi, dtype=float)
+    rate_scadute = np.asarray(rate_scadute, dtype=float)
+    valida = durata != 0
+    rate_residue = durata - rate_scadute
+    durata_sicura = np.where(valida, durata, 1)
+
+    pro_rata = costi_totali / durata_sicura * rate_residue
+    if metodo == "pro_rata":
+        quota_non_goduta = pro_rata
+    elif metodo == "curva_interessi":
+        quota_non_goduta = costi_totali * quota_curva_interessi(durata, rate_residue, tan)
+    else:
+        upfront = np.zeros_like(costi_totali) if costi_upfront is None else np.asarray(costi_upfront, dtype=float)
+        upfront = np.clip(np.nan_to_num(upfront), 0, costi_totali)
+        quota_non_goduta = (upfront * quota_curva_interessi(durata, rate_residue, tan)
+                            + (costi_totali - upfront) / durata_sicura * rate_residue)
+
+    quota_non_goduta = np.where(valida, quota_non_goduta, 0)
+    return {
+        "rimborso": np.maximum(0, quota_non_goduta),
+        "quota_non_goduta": quota_non_goduta,
+        "rate_residue": rate_residue,
+        "durata_totale": durata,
+        "rate_scadute": rate_scadute,
+        "costi_totali": costi_totali,
+        "valida": valida,
+    }
+
+
+def righe_rimborsi(colonne: dict) -> list:
+    """Una riga per pratica nello stesso formato di esegui_calcoli"""
+    valida = colonne["valida"].tolist()
+    # round di Python, non np.round: gli importi coincidono al centesimo con esegui_calcoli
+    valori = {
+        "rimborso": [round(valore, 2) for valore in colonne["rimborso"].tolist()],
+        "quota_non_goduta": [round(valore, 2) for valore in colonne["quota_non_goduta"].tolist()],
+        # Rate e durata sono interi come nei dati estratti
+        "rate_residue": colonne["rate_residue"].astype(int).tolist(),
+        "durata_totale": colonne["durata_totale"].astype(int).tolist(),
+        "rate_scadute": colonne["rate_scadute"].astype(int).tolist(),
+        "costi_totali": colonne["costi_totali"].tolist(),
+    }
+    chiavi = list(valori)
+    righe = []
+    for n, ok in enumerate(valida):
+        if ok:
+            righe.append({chiave: valori[chiave][n] for chiave in chiavi})
+        else:
+            righe.append({"rimborso": 0, "errore": "Durata totale non può essere zero"})
+    return righe
+
+
+def numero(valore: str) -> float:
+    """Numero con punto decimale o in formato italiano (1.234,56); vuoto = NaN"""
+    valore = (valore or "").strip().replace("€", "").strip()
+    if not valore:
+        return float("nan")
+    return euro(valore) if "," in valore else float(valore)
+
+
+def leggi_csv(testo: str) -> dict:
+    """Colonne del CSV (separatore , ; o tab) come array: obbligatorie COLONNE, opzionali id, tan, costi_upfront"""
+    try:
+        dialetto = csv.Sniffer().sniff(testo.split("\n", 1)[0], delimiters=",;\t")
+    except csv.Error:
+        dialetto = csv.excel
+    righe = list(csv.DictReader(io.StringIO(testo), dialect=dialetto))
+    intestazione = set(righe[0]) if righe else set()
+    mancanti = [colonna for colonna in COLONNE if colonna not in intestazione]
+    if mancanti:
+        raise ValueError(f"Colonne mancanti nel CSV: {', '.join(mancanti)}")
+    colonne = {}
+    for colonna in COLONNE + COLONNE_OPZIONALI:
+        if colonna not in intestazione:
+            continue
+        try:
+            colonne[colonna] = np.array([numero(riga[colonna]) for riga in righe], dtype=float)
+        except ValueError as e:
+            raise ValueError(f"Valore non numerico nella colonna {colonna}: {e}")
+    for colonna in COLONNE:
+        # Valori mancanti come nei dati estratti: 0 (le righe con durata zero risultano in errore)
+        colonne[colonna] = np.nan_to_num(colonne[colonna])
+    if "id" in intestazione:
+        colonne["id"] = [riga["id"] for riga in righe]
+    return colonne
+
+
+def scrivi_csv(identificativi, righe: list) -> str:
+    """Risultati in CSV: una riga per pratica, con l'eventuale errore"""
+    campi = ["id", "rimborso", "quota_non_goduta", "rate_residue", "durata_totale", "rate_scadute",
+             "costi_totali", "errore"]
+    buffer = io.StringIO()
+    scrittore = csv.DictWriter(buffer, fieldnames=campi, extrasaction="ignore")
+    scrittore.writeheader()
+    for identificativo, riga in zip(identificativi, righe):
+        scrittore.writerow({"id": identificativo, **riga})
+    return buffer.getvalue()
+
+
+def rimborsi_portafoglio(testo_csv: str, metodo: str = "pro_rata") -> dict:
+    """Rimborsi di tutte le pratiche del CSV con il metodo scelto, più il totale di ogni metodo a confronto"""
+    colonne = leggi_csv(testo_csv)
+    ingressi = {colonna: colonne[colonna] for colonna in COLONNE}
+    opzionali = {colonna: colonne.get(colonna) for colonna in COLONNE_OPZIONALI}
+    risultati = calcola_rimborsi(**ingressi, metodo=metodo, **opzionali)
+    confronto = {
+        altro: round(float(calcola_rimborsi(**ingressi, metodo=altro, **opzionali)["rimborso"].round(2).sum()), 2)
+        for altro in METODI
+    }
+    numero_righe = len(risultati["valida"])
+    return {
+        "metodo": metodo,
+        "id": colonne.get("id") or [str(n) for n in range(1, numero_righe + 1)],
+        "righe": righe_rimborsi(risultati),
+        "totali": {
+            "pratiche": numero_righe,
+            "valide": int(risultati["valida"].sum()),
+            "rimborso": confronto[metodo],
+        },
+        "confronto_metodi": confronto,
+    }
@@ -0,0 +1,284 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+import psutil
+import torch
+from config import Config
+from logs import get_logger
+from metrics import metriche
+
+log = get_logger("registry")
+
+
+def _tensori(valore):
+    """Tensori contenuti in un valore dello state_dict (i Linear quantizzati salvano tuple)"""
+    if isinstance(valore, torch.Tensor):
+        yield valore
+    elif isinstance(valore, (tuple, list)):
+        for elemento in valore:
+            yield from _tensori(elemento)
+
+
+def dimensione_residente(risorse) -> int:
+    """Byte occupati dai pesi dei modelli torch contenuti nelle risorse (anche quantizzati)"""
+    totale = 0
+    visti = set()
+    for risorsa in risorse if isinstance(risorse, (tuple, list)) else (risorse,):
+        if isinstance(risorsa, torch.nn.Module):
+            for valore in risorsa.state_dict(keep_vars=True).values():
+                for tensore in _tensori(valore):
+                    # I pesi condivisi (es. embedding legati) si contano una volta
+                    chiave = (tensore.device, tensore.data_ptr()) if not tensore.is_quantized else id(tensore)
+                    if chiave not in visti:
+                        visti.add(chiave)
+                        totale += tensore.numel() * tensore.element_size()
+    return totale
+
+
+def dispositivo(risorse):
+    """Dispositivo del primo modello torch contenuto nelle risorse"""
+    for risorsa in risorse if isinstance(risorse, (tuple, list)) else (risorse,):
+        if isinstance(risorsa, torch.nn.Module):
+            return str(getattr(risorsa, "device", "cpu"))
+    return None
+
+
+class VoceModello:
+    """Stato di un modello registrato"""
+
+    def __init__(self, nome, loader, warmup=None, stato="in_attesa"):
+        self.nome = nome
+        self.loader = loader
+        self.warmup = warmup
+        self.risorse = None
+        self.stato = stato
+        self.errore = None
+        self.secondi = None
+        self.bytes = 0
+        self.dispositivo = None
+        self.in_uso = 0
+        self.ultimo_uso = None
+        self.caricamenti = 0
+        self.scaricamenti = 0
+        self.caricamento = None  # threading.Event mentre un thread sta caricando il modello
+
+
+class RegistroModelli:
+    """Registro dei modelli in memoria, condiviso tra richieste concorrenti.
+
+    - caricamento single-flight: se più richieste chiedono lo stesso modello
+      non ancora caricato, una sola lo carica e le altre attendono
+    - budget di memoria: prima e dopo un caricamento vengono scaricati i
+      modelli inattivi usati meno di recente finché si rientra nel budget
+    - timeout di inattività: i modelli non usati da più di idle_timeout
+      secondi vengono scaricati e ricaricati alla richiesta successiva
+    I modelli in uso (dentro acquisisci) non vengono mai scaricati.
+    """
+
+    def __init__(self, memory_budget_mb: int, idle_timeout: int, warmup: bool):
+        self.memory_budget_bytes = memory_budget_mb * 1024 * 1024
+        self.idle_timeout = idle_timeout
+        self.warmup_enabled = warmup
+        self._lock = threading.Lock()
+        self._voci = {}
+
+    def registra(self, nome: str, loader, warmup=None, stato: str = "in_attesa"):
+        """Registra un modello: loader() restituisce le risorse, warmup(risorse) le riscalda"""
+        with self._lock:
+            self._voci[nome] = VoceModello(nome, loader, warmup, stato)
+
+    def imposta_stato(self, nome: str, stato: str):
+        """Permette al loader di segnalare le fasi intermedie (es. download)"""
+        with self._lock:
+            self._voci[nome].stato = stato
+
+    def stato(self, nome: str) -> str:
+        with self._lock:
+            return self._voci[nome].stato
+
+    def caricato(self, nome: str) -> bool:
+        with self._lock:
+            return self._voci[nome].risorse is not None
+
+    def corrente(self, nome: str):
+        """Risorse del modello se già in memoria, senza caricarlo né segnarlo come usato"""
+        with self._lock:
+            return self._voci[nome].risorse
+
+    def _residente(self) -> int:
+        return sum(voce.bytes for voce in self._voci.values() if voce.risorse is not None)
+
+    def _scarica(self, voce):
+        """Rilascia le risorse del modello (chiamato con il lock acquisito)"""
+        log.info("Scaricamento modello %s (%.0f MB)", voce.nome, voce.bytes / 1024 / 1024)
+        voce.risorse = None
+        voce.stato = "scaricato"
+        voce.scaricamenti += 1
+
+    def _libera_spazio(self, escludi: str, richiesti: int = 0) -> bool:
+        """Scarica i modelli inattivi meno usati finché si rientra nel budget (con il lock acquisito)"""
+        if self.memory_budget_bytes <= 0:
+            return False
+        candidati = sorted(
+            (voce for voce in self._voci.values()
+             if voce.nome != escludi and voce.risorse is not None and voce.in_uso == 0),
+            key=lambda voce: voce.ultimo_uso or 0
+        )
+        scaricati = False
+        for voce in candidati:
+            if self._residente() + richiesti <= self.memory_budget_bytes:
+                break
+            self._scarica(voce)
+            scaricati = True
+        if self._residente() + richiesti > self.memory_budget_bytes:
+            log.warning("Budget memoria modelli superato: %.0f MB su %.0f MB",
+                        (self._residente() + richiesti) / 1024 / 1024, self.memory_budget_bytes / 1024 / 1024)
+        return scaricati
+
+    @staticmethod
+    def _rilascia_memoria():
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _carica(self, voce):
+        """Carica ed eventualmente riscalda il modello (senza lock: può durare minuti)"""
+        inizio = time.perf_counter()
+        log.info("Caricamento modello %s...", voce.nome)
+        risorse = voce.loader()
+        if self.warmup_enabled and voce.warmup is not None:
+            self.imposta_stato(voce.nome, "warmup")
+            inizio_warmup = time.perf_counter()
+            voce.warmup(risorse)
+            log.info("Warm-up %s completato in %.1fs", voce.nome, time.perf_counter() - inizio_warmup)
+        secondi = time.perf_counter() - inizio
+        metriche.imposta("model_load_seconds", secondi, model=voce.nome)
+        return risorse, round(secondi, 1)
+
+    def carica(self, nome: str, uso: bool = False):
+        """Restituisce le risorse del modello, caricandolo una sola volta anche con richieste concorrenti"""
+        while True:
+            with self._lock:
+                voce = self._voci[nome]
+                if voce.risorse is not None:
+                    voce.ultimo_uso = time.monotonic()
+                    if uso:
+                        voce.in_uso += 1
+                    return voce.risorse
+                evento = voce.caricamento
+                if evento is None:
+                    # Questo thread carica il modello, gli altri attendono l'evento
+                    evento = voce.caricamento = threading.Event()
+                    responsabile = True
+                    liberato = self._libera_spazio(escludi=nome, richiesti=voce.bytes)
+                else:
+                    responsabile = False
+
+            if not responsabile:
+                evento.wait()
+                with self._lock:
+                    if voce.risorse is None and voce.stato == "errore":
+                        raise RuntimeError(f"Caricamento modello {nome} fallito: {voce.errore}")
+                continue
+
+            if liberato:
+                self._rilascia_memoria()
+            try:
+                risorse, secondi = self._carica(voce)
+            except Exception as e:
+                log.error("Errore caricamento modello %s: %s", nome, e)
+                metriche.incrementa("model_loads_total", model=nome, esito="errore")
+                with self._lock:
+                    voce.stato = "errore"
+                    voce.errore = str(e)
+                    voce.caricamento = None
+                evento.set()
+                raise
+
+            with self._lock:
+                voce.risorse = risorse
+                voce.stato = "pronto"
+                voce.errore = None
+                voce.secondi = secondi
+                voce.bytes = dimensione_residente(risorse)
+                voce.dispositivo = dispositivo(risorse)
+                voce.caricamenti += 1
+                voce.ultimo_uso = time.monotonic()
+                voce.caricamento = None
+                liberato = self._libera_spazio(escludi=nome)
+            evento.set()
+            if liberato:
+                self._rilascia_memoria()
+            metriche.incrementa("model_loads_total", model=nome, esito="ok")
+            log.info("Modello %s caricato in %ss (%.0f MB)", nome, secondi, voce.bytes / 1024 / 1024,
+                     extra={"modello": nome, "secondi": secondi})
+
+    @contextmanager
+    def acquisisci(self, nome: str):
+        """Usa il modello nel blocco: finché il blocco è attivo il modello non viene scaricato"""
+        risorse = self.carica(nome, uso=True)
+        try:
+            yield risorse
+        finally:
+            with self._lock:
+                voce = self._voci[nome]
+                voce.in_uso -= 1
+                voce.ultimo_uso = time.monotonic()
+
+    def scarica(self, nome: str) -> bool:
+        """Scarica il modello se è in memoria e non è in uso"""
+        with self._lock:
+            voce = self._voci[nome]
+            if voce.risorse is None or voce.in_uso > 0:
+                return False
+            self._scarica(voce)
+        self._rilascia_memoria()
+        return True
+
+    def scarica_inattivi(self) -> list:
+        """Scarica i modelli non usati da più di idle_timeout secondi"""
+        if self.idle_timeout <= 0:
+            return []
+        adesso = time.monotonic()
+        with self._lock:
+            inattivi = [
+                voce for voce in self._voci.values()
+                if voce.risorse is not None and voce.in_uso == 0
+                and voce.ultimo_uso is not None and adesso - voce.ultimo_uso > self.idle_timeout
+            ]
+            for voce in inattivi:
+                self._scarica(voce)
+        if inattivi:
+            self._rilascia_memoria()
+        return [voce.nome for voce in inattivi]
+
+    def stats(self) -> dict:
+        """Stato, memoria residente e utilizzo di ogni modello"""
+        adesso = time.monotonic()
+        with self._lock:
+            modelli = {
+                voce.nome: {
+                    "stato": voce.stato,
+                    "errore": voce.errore,
+                    "secondi": voce.secondi,
+                    "residente_mb": round(voce.bytes / 1024 / 1024, 1) if voce.risorse is not None else 0,
+                    "dispositivo": voce.dispositivo if voce.risorse is not None else None,
+                    "in_uso": voce.in_uso,
+                    "inattivo_da_s": round(adesso - voce.ultimo_uso) if voce.ultimo_uso is not None else None,
+                    "caricamenti": voce.caricamenti,
+                    "scaricamenti": voce.scaricamenti,
+                }
+                for voce in self._voci.values()
+            }
+            residente = self._residente()
+        return {
+            "budget_mb": self.memory_budget_bytes // (1024 * 1024),
+            "idle_timeout": self.idle_timeout,
+            "residente_mb": round(residente / 1024 / 1024, 1),
+            "processo_rss_mb": round(psutil.Process().memory_info().rss / 1024 / 1024, 1),
+            "modelli": modelli,
+        }
+
+
+registro_modelli = RegistroModelli(**Config.get_registry_config())
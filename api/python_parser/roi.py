@@ -0,0 +1,90 @@
+import numpy as np
+from rules import CF_REGEX, regex_ancore
+
+
+def righe_parole(parole, tolleranza: float = 3.0) -> list:
+    """Raggruppa le parole di pdfplumber in righe (stessa altezza entro la tolleranza)"""
+    righe = []
+    for parola in sorted(parole, key=lambda p: (round(p["top"]), p["x0"])):
+        if righe and abs(righe[-1]["top"] - parola["top"]) <= tolleranza:
+            riga = righe[-1]
+            riga["parole"].append(parola)
+            riga["bottom"] = max(riga["bottom"], parola["bottom"])
+        else:
+            righe.append({"top": parola["top"], "bottom": parola["bottom"], "parole": [parola]})
+    for riga in righe:
+        riga["testo"] = " ".join(p["text"] for p in sorted(riga["parole"], key=lambda p: p["x0"]))
+    return righe
+
+
+def regioni_candidate(parole, larghezza, altezza, file_type, righe_sotto: int = 2, max_regioni: int = 8) -> list:
+    """Riquadri (x0, top, x1, bottom, in punti PDF) attorno alle righe che contengono
+    le parole chiave delle regole o un codice fiscale.
+
+    Ogni regione è una fascia larga quanto il testo della pagina, perché il
+    valore può stare lontano dall'etichetta, estesa di righe_sotto righe per i
+    valori che vanno a capo. Le fasce sovrapposte vengono unite.
+    """
+    ancore = regex_ancore(file_type)
+    # Larghezza limitata all'area occupata dal testo della pagina
+    margine = 6.0
+    sinistra = max(0.0, min(p["x0"] for p in parole) - margine)
+    destra = min(larghezza, max(p["x1"] for p in parole) + margine)
+    fasce = []
+    for riga in righe_parole(parole):
+        if not (ancore.search(riga["testo"].lower()) or CF_REGEX.search(riga["testo"])):
+            continue
+        interlinea = max(riga["bottom"] - riga["top"], 1.0)
+        fasce.append([
+            max(0.0, riga["top"] - interlinea * 0.5),
+            min(altezza, riga["bottom"] + interlinea * (1.5 * righe_sotto + 0.5)),
+        ])
+
+    unite = []
+    for fascia in sorted(fasce):
+        if unite and fascia[0] <= unite[-1][1]:
+            unite[-1][1] = max(unite[-1][1], fascia[1])
+        else:
+            unite.append(fascia)
+    return [(sinistra, top, destra, bottom) for top, bottom in unite[:max_regioni]]
+
+
+def ritaglia(immagine, regioni, larghezza, altezza) -> list:
+    """Ritaglia le regioni (in punti PDF) dall'immagine renderizzata della pagina"""
+    scala_x = immagine.width / larghezza
+    scala_y = immagine.height / altezza
+    return [
+        immagine.crop((round(x0 * scala_x), round(top * scala_y), round(x1 * scala_x), round(bottom * scala_y)))
+        for x0, top, x1, bottom in regioni
+    ]
+
+
+def ritaglia_contenuto(immagine, soglia: int = 245, margine: int = 16):
+    """Passata di layout economica per le scansioni: elimina i margini bianchi attorno al contenuto"""
+    grigi = np.asarray(immagine.convert("L"))
+    righe = np.flatnonzero((grigi < soglia).any(axis=1))
+    colonne = np.flatnonzero((grigi < soglia).any(axis=0))
+    if righe.size == 0 or colonne.size == 0:
+        return immagine
+    return immagine.crop((
+        max(0, int(colonne[0]) - margine),
+        max(0, int(righe[0]) - margine),
+        min(immagine.width, int(colonne[-1]) + margine + 1),
+        min(immagine.height, int(righe[-1]) + margine + 1),
+    ))
+
+
+def immagini_roi(documento, indice, file_type, resolution=300, righe_sotto=2, max_regioni=8) -> list:
+    """Ritagli da inviare al modello per una pagina.
+
+    Pagine native: solo le fasce attorno alle parole chiave (nessuna se la
+    pagina non ne contiene). Scansioni: la pagina senza margini bianchi.
+    """
+    parole, larghezza, altezza = documento.parole_pagina(indice)
+    if not parole:
+        return [ritaglia_contenuto(documento.immagine_pagina(indice, resolution=resolution))]
+    regioni = regioni_candidate(parole, larghezza, altezza, file_type, righe_sotto, max_regioni)
+    if not regioni:
+        # Nessuna parola chiave: la pagina non viene nemmeno renderizzata
+        return []
+    return ritaglia(documento.immagine_pagina(indice, resolution=resolution), regioni, larghezza, altezza)
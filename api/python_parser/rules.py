@@ -0,0 +1,230 @@
+import hashlib
+import re
+from metrics import metriche
+
+# === Convertitori dei valori estratti ===
+
+def testo(valore: str) -> str:
+    valore = valore.strip()
+    if not valore:
+        raise ValueError("valore vuoto")
+    return valore
+
+def maiuscolo(valore: str) -> str:
+    return testo(valore).upper()
+
+def euro(valore: str) -> float:
+    """Converte un importo in formato italiano (1.234,56) in float"""
+    return float(valore.replace('.', '').replace(',', '.'))
+
+def intero(valore: str) -> int:
+    return int(valore)
+
+def data(valore: str) -> str:
+    """Accetta solo date gg/mm/aaaa (anche con cifre singole)"""
+    if not re.fullmatch(r"\d{1,2}/\d{1,2}/\d{2,4}", valore):
+        raise ValueError(f"data non valida: {valore}")
+    return valore
+
+
+# Ampiezza di default del testo esaminato dopo l'àncora di una regola
+FINESTRA = 300
+
+
+class Regola:
+    """Regola di estrazione: un pattern che valorizza uno o più campi.
+
+    I campi ricevono i gruppi del pattern in ordine; se i campi sono più dei
+    gruppi, quelli in eccesso ricevono l'ultimo gruppo (es. durata_mesi e
+    numero_rate dallo stesso numero). Priorità più bassa = regola preferita.
+
+    L'àncora è una parola chiave (minuscola) che compare in ogni match: il
+    pattern completo viene cercato solo nella finestra [àncora - indietro,
+    àncora + avanti]. Le regole senza àncora (es. il solo codice fiscale)
+    vengono cercate una volta sull'intero testo.
+    """
+
+    def __init__(self, campi, pattern, priorita, convertitore=testo, ancora=None, indietro=0, avanti=FINESTRA,
+                 ignore_case=True):
+        self.campi = (campi,) if isinstance(campi, str) else tuple(campi)
+        self.pattern = pattern
+        self.priorita = priorita
+        self.convertitore = convertitore
+        self.ancora = ancora
+        self.indietro = indietro
+        self.avanti = avanti
+        self.regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        self.gruppi = self.regex.groups
+
+    def valori(self, match):
+        """Converte i gruppi del match nei valori dei campi (ValueError se non validi)"""
+        return [
+            self.convertitore(match.group(1 + min(k, self.gruppi - 1)))
+            for k in range(len(self.campi))
+        ]
+
+
+NOME = r"[A-Za-zÀ-ÖØ-öø-ÿ\s']"
+CF = r"[A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z]"
+DATA = r"\d{1,2}\/\d{1,2}\/\d{4}"
+
+# Una tabella per tipo di documento: usata sia sull'output dei modelli sia sul testo pdfplumber.
+# Regola(campi, pattern, priorità, convertitore, àncora, indietro, avanti)
+REGOLE = {
+    "contratto": [
+        Regola(("cognome", "nome"), rf"COGNOME\s*:?\s*({NOME}+?)\s+NOME\s*:?\s*({NOME}+)", 0, testo, r"cognome"),
+        Regola(("cognome", "nome"), rf"TITOLARE\s*:?\s*({NOME}+?)\s+({NOME}+)", 1, testo, r"titolare"),
+        Regola(("cognome", "nome"), rf"CLIENTE\s*:?\s*({NOME}+?)\s+({NOME}+)", 2, testo, r"cliente"),
+        Regola(("cognome", "nome"), rf"({NOME}+?)\s+({NOME}+?)\s+CF\s*:?\s*{CF}", 3, testo, r"cf", 100, 30),
+
+        # Il codice fiscale è sempre maiuscolo: la ricerca esatta è molto più veloce
+        Regola("codice_fiscale", rf"({CF})", 0, maiuscolo, ignore_case=False),
+        Regola("codice_fiscale", rf"CF\s*:?\s*({CF})", 1, maiuscolo, r"cf", 0, 30),
+        Regola("codice_fiscale", rf"C\.?F\.?\s*:?\s*({CF})", 2, maiuscolo, r"c\.?f", 0, 30),
+
+        Regola("data_nascita", rf"nato\s*a\s*[^,]*\s*il\s*({DATA})", 0, data, r"nato"),
+        Regola("data_nascita", rf"data\s*nascita\s*:?\s*({DATA})", 1, data, r"data\s*nascita"),
+        Regola("data_nascita", rf"nato\s*il\s*({DATA})", 2, data, r"nato"),
+        # Ultima risorsa: la prima data del documento
+        Regola("data_nascita", rf"({DATA})", 3, data),
+
+        Regola("luogo_nascita", r"nato\s*a\s*([^,]*?)\s*il", 0, testo, r"nato"),
+        Regola("luogo_nascita", rf"luogo\s*nascita\s*:?\s*({NOME}+)", 1, testo, r"luogo\s*nascita"),
+
+        Regola("costi_totali", r"CT\s+€\s*([\d.,]+)\s+COSTI TOTALI", 0, euro, r"costi totali", 40),
+        Regola("costi_totali", r"COSTI TOTALI\s*:?\s*€?\s*([\d.,]+)", 1, euro, r"costi totali"),
+        Regola("costi_totali", r"TOTALE COSTI\s*:?\s*€?\s*([\d.,]+)", 2, euro, r"totale costi"),
+        Regola("costi_totali", r"([\d.,]+)\s*€\s*COSTI TOTALI", 3, euro, r"costi totali", 40),
+        Regola("costi_totali", r"COSTI\s*:?\s*€?\s*([\d.,]+)", 4, euro, r"costi"),
+
+        Regola(("durata_mesi", "numero_rate"), r"DURATA\s*:?\s*(\d+)\s*MESI", 0, intero, r"durata"),
+        Regola(("durata_mesi", "numero_rate"), r"(\d+)\s*MESI\s*DI\s*DURATA", 1, intero, r"durata", 30),
+        Regola(("durata_mesi", "numero_rate"), r"DURATA\s*TOTALE\s*:?\s*(\d+)\s*MESI", 2, intero, r"durata"),
+    ],
+    "conteggio": [
+        Regola("rate_scadute", r"RATE\s*SCADUTE[^\d\n]*:?\s*\(?(\d{1,3})\s*MESI?", 0, intero, r"rate\s*scadute"),
+        Regola("rate_scadute", r"(\d{1,3})\s*RATE\s*SCADUTE", 1, intero, r"rate\s*scadute", 10),
+        Regola("rate_scadute", r"SCADUTE\s*:?\s*(\d{1,3})\s*RATE", 2, intero, r"scadute"),
+        Regola("rate_scadute", r"RATE\s*PAGATE\s*:?\s*(\d{1,3})", 3, intero, r"rate\s*pagate"),
+        Regola("rate_scadute", r"(\d{1,3})\s*MESI?\s*SCADUTI", 4, intero, r"scaduti", 15),
+
+        Regola("data_chiusura", r"DATA\s*ELABORAZIONE\s*CONTEGGIO\s*ESTINTIVO\s*([\d\/]+)", 0, data, r"data\s*elaborazione"),
+        Regola("data_chiusura", r"DATA\s*CHIUSURA\s*:?\s*([\d\/]+)", 1, data, r"data\s*chiusura"),
+        Regola("data_chiusura", r"ELABORATO\s*IL\s*([\d\/]+)", 2, data, r"elaborato"),
+        Regola("data_chiusura", r"DATA\s*:?\s*([\d\/]+)\s*CONTEGGIO", 3, data, r"data"),
+    ],
+}
+
+
+class ScannerCampi:
+    """Compila una tabella di regole in un unico scanner che valorizza tutti i campi in una passata.
+
+    Le àncore di tutte le regole formano una sola regex di parole chiave,
+    applicata al testo in minuscolo: il testo viene percorso una volta e, a
+    ogni àncora trovata, si provano solo le regole di quell'àncora che possono
+    ancora migliorare un campo, nella loro finestra. Per ogni campo vince la
+    regola con priorità migliore e, a parità, la prima occorrenza. La scansione
+    si ferma appena ogni campo è stato valorizzato dalla sua regola migliore.
+    """
+
+    def __init__(self, regole):
+        self.regole = sorted(regole, key=lambda r: r.priorita)
+
+        # Regole raggruppate per àncora, nell'ordine di priorità
+        self._ancore = {}
+        self._libere = []
+        for regola in self.regole:
+            if regola.ancora is None:
+                self._libere.append(regola)
+            else:
+                self._ancore.setdefault(regola.ancora, []).append(regola)
+        self._regex_ancore = {ancora: re.compile(ancora) for ancora in self._ancore}
+        self.regex_ancore = re.compile("|".join(f"(?:{ancora})" for ancora in self._ancore))
+
+        self.campi = []
+        self._priorita_migliore = {}
+        for regola in self.regole:
+            for campo in regola.campi:
+                if campo not in self._priorita_migliore:
+                    self.campi.append(campo)
+                    self._priorita_migliore[campo] = regola.priorita
+
+    def _completo(self, trovati) -> bool:
+        return len(trovati) == len(self.campi) and all(
+            trovati[campo][0] == self._priorita_migliore[campo] for campo in self.campi
+        )
+
+    @staticmethod
+    def _applica(regola, text, trovati, inizio=0, fine=None):
+        """Cerca la regola nel tratto di testo indicato e aggiorna i campi che migliora"""
+        migliorabili = [
+            campo for campo in regola.campi
+            if campo not in trovati or trovati[campo][0] > regola.priorita
+        ]
+        if not migliorabili:
+            return
+        match = regola.regex.search(text, inizio, len(text) if fine is None else fine)
+        if match is None:
+            return
+        try:
+            valori = regola.valori(match)
+        except (ValueError, TypeError):
+            return
+        for campo, valore in zip(regola.campi, valori):
+            if campo in migliorabili:
+                trovati[campo] = (regola.priorita, valore)
+
+    def estrai(self, text: str) -> dict:
+        """Restituisce i campi trovati nel testo (i campi assenti non compaiono)"""
+        trovati = {}
+        # Regole senza àncora che sono già le migliori per il loro campo (es. codice fiscale)
+        for regola in self._libere:
+            if all(self._priorita_migliore[campo] == regola.priorita for campo in regola.campi):
+                self._applica(regola, text, trovati)
+
+        minuscolo = text.lower()
+        if len(minuscolo) != len(text):
+            # Alcuni caratteri cambiano lunghezza in minuscolo: le posizioni non coinciderebbero
+            minuscolo = text
+
+        pos = 0
+        while not self._completo(trovati):
+            match = self.regex_ancore.search(minuscolo, pos)
+            if match is None:
+                break
+            posizione = match.start()
+            # Più àncore possono iniziare nello stesso punto (es. "costi" e "costi totali")
+            for ancora, regole in self._ancore.items():
+                if not self._regex_ancore[ancora].match(minuscolo, posizione):
+                    continue
+                for regola in regole:
+                    self._applica(regola, text, trovati, max(0, posizione - regola.indietro), posizione + regola.avanti)
+            pos = posizione + 1
+
+        # Regole senza àncora di ultima risorsa, solo per i campi ancora mancanti
+        for regola in self._libere:
+            self._applica(regola, text, trovati)
+
+        return {campo: valore for campo, (_, valore) in trovati.items()}
+
+
+SCANNER = {tipo: ScannerCampi(regole) for tipo, regole in REGOLE.items()}
+
+# Codice fiscale isolato, usato anche per localizzare le regioni da ritagliare (roi.py)
+CF_REGEX = re.compile(CF)
+
+# Impronta delle regole: cambia quando cambia la tabella (usata nelle chiavi di cache)
+VERSIONE_REGOLE = hashlib.sha256(
+    repr([(tipo, [(r.campi, r.pattern, r.priorita, r.ancora) for r in regole]) for tipo, regole in REGOLE.items()]).encode("utf-8")
+).hexdigest()[:16]
+
+
+def estrai_campi(file_type: str, text: str) -> dict:
+    """Applica le regole del tipo di documento al testo in una sola passata"""
+    with metriche.fase("regole", file_type=file_type):
+        return SCANNER[file_type].estrai(text or "")
+
+
+def regex_ancore(file_type: str):
+    """Regex delle parole chiave delle regole del tipo di documento (da applicare al testo minuscolo)"""
+    return SCANNER[file_type].regex_ancore
@@ -0,0 +1,190 @@
+import json
+import threading
+import weakref
+import torch
+from transformers import LogitsProcessor
+from rules import CF_REGEX, data, euro, maiuscolo, testo
+
+
+class TipoValore:
+    """Tipo di un valore dello schema: caratteri ammessi, lunghezza massima e conversione.
+
+    Tutti i valori sono stringhe JSON: l'oggetto resta valido anche se un
+    numero è scritto male, e si scarta solo quel campo.
+    """
+
+    def __init__(self, ammesso, max_caratteri: int, converti):
+        self.ammesso = ammesso
+        self.max_caratteri = max_caratteri
+        self.converti = converti
+
+
+def codice_fiscale(valore: str) -> str:
+    valore = maiuscolo(valore)
+    if not CF_REGEX.fullmatch(valore):
+        raise ValueError(f"codice fiscale non valido: {valore}")
+    return valore
+
+
+def importo(valore: str) -> float:
+    """Importo con punto decimale o in formato italiano (1.234,56)"""
+    return euro(valore) if "," in valore else float(valore)
+
+
+TIPI = {
+    "testo": TipoValore(lambda c: c.isalpha() or c in " '-", 40, testo),
+    "codice_fiscale": TipoValore(lambda c: c.isascii() and c.isalnum() and not c.islower(), 16, codice_fiscale),
+    "numero": TipoValore(lambda c: c.isascii() and (c.isdigit() or c in ".,"), 12, importo),
+    "intero": TipoValore(lambda c: c.isascii() and c.isdigit(), 4, int),
+    "data": TipoValore(lambda c: c.isascii() and (c.isdigit() or c == "/"), 10, data),
+}
+
+# Campi che servono a esegui_calcoli e alla lettera: (tipo, descrizione per il prompt)
+SCHEMI = {
+    "contratto": {
+        "nome": ("testo", "first name of the customer"),
+        "cognome": ("testo", "surname of the customer"),
+        "codice_fiscale": ("codice_fiscale", "Italian tax code of the customer, 16 characters"),
+        "costi_totali": ("numero", "total costs in euro (COSTI TOTALI)"),
+        "durata_mesi": ("intero", "loan duration in months (DURATA)"),
+    },
+    "conteggio": {
+        "rate_scadute": ("intero", "number of instalments already due (RATE SCADUTE)"),
+        "data_chiusura": ("data", "date of the statement, dd/mm/yyyy"),
+    },
+}
+
+
+def prompt_json(file_type: str) -> str:
+    """Prompt della modalità json: descrive i campi dell'oggetto da compilare"""
+    campi = "; ".join(f"{campo}: {descrizione}" for campo, (_, descrizione) in SCHEMI[file_type].items())
+    return ("Read the document and return only a JSON object with these fields: " + campi + ". "
+            "Copy the values as printed in the document. Use \"\" for missing values.")
+
+
+def scheletro(file_type: str) -> list:
+    """Parti fisse e valori dell'oggetto JSON, in ordine: stringhe e coppie (campo, tipo)"""
+    parti = []
+    for n, (campo, (tipo, _)) in enumerate(SCHEMI[file_type].items()):
+        parti += [("{" if n == 0 else '", ') + f'"{campo}": "', (campo, tipo)]
+    parti.append('"}')
+    return parti
+
+
+def converti_json(testo_json: str, file_type: str) -> dict:
+    """Campi validi dell'oggetto generato, con gli stessi tipi delle regole (vuoti e non validi esclusi)"""
+    try:
+        valori = json.loads(testo_json)
+    except ValueError:
+        return {}
+    campi = {}
+    for campo, (tipo, _) in SCHEMI[file_type].items():
+        try:
+            valore = TIPI[tipo].converti(str(valori[campo]))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if valore not in ("", 0, 0.0):
+            campi[campo] = valore
+    # Come nelle regole, il numero di rate coincide con la durata in mesi
+    if "durata_mesi" in campi:
+        campi["numero_rate"] = campi["durata_mesi"]
+    return campi
+
+
+# Testo di ogni token e maschere dei tipi, calcolati una volta per tokenizer
+_vocabolari = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _vocabolario(tokenizer) -> dict:
+    with _lock:
+        voce = _vocabolari.get(tokenizer)
+        if voce is None:
+            pezzi = tokenizer.batch_decode([[i] for i in range(len(tokenizer))])
+            voce = _vocabolari[tokenizer] = {
+                "lunghezze": [len(pezzo) for pezzo in pezzi],
+                "maschere": {
+                    nome: torch.tensor([bool(pezzo) and all(map(tipo.ammesso, pezzo)) for pezzo in pezzi])
+                    for nome, tipo in TIPI.items()
+                },
+                "letterali": {},
+            }
+        return voce
+
+
+class VincoloJSON(LogitsProcessor):
+    """Vincola la generazione all'oggetto JSON dello schema del tipo di documento.
+
+    Le parti fisse (parentesi, nomi dei campi, virgolette) vengono imposte token
+    per token; nei valori sono ammessi solo i token composti da caratteri del
+    tipo del campo, più il primo token della parte fissa successiva che chiude
+    il valore. Ogni valore ha una lunghezza massima, quindi anche i token da
+    generare sono limitati (massimo_token).
+    """
+
+    def __init__(self, tokenizer, lunghezza_prompt: int, file_type: str):
+        self.lunghezza_prompt = lunghezza_prompt
+        self.eos = tokenizer.eos_token_id
+        vocabolario = _vocabolario(tokenizer)
+        self.lunghezze = vocabolario["lunghezze"]
+        self.maschere = vocabolario["maschere"]
+        self.parti = []
+        for parte in scheletro(file_type):
+            if isinstance(parte, str):
+                with _lock:
+                    ids = vocabolario["letterali"].get(parte)
+                    if ids is None:
+                        ids = vocabolario["letterali"][parte] = tokenizer.encode(parte, add_special_tokens=False)
+                self.parti.append(ids)
+            else:
+                self.parti.append(parte[1])
+        self.massimo_token = sum(
+            len(parte) if isinstance(parte, list) else TIPI[parte].max_caratteri for parte in self.parti
+        ) + 1
+        self._stati = None
+        self._maschere_dispositivo = {}
+
+    def _avanza(self, stato, token: int):
+        """Aggiorna [parte, posizione, caratteri] della riga con l'ultimo token generato"""
+        parte = stato[0]
+        if parte >= len(self.parti):
+            return
+        if isinstance(self.parti[parte], list):
+            stato[1] += 1
+        elif token == self.parti[parte + 1][0]:
+            # Il valore è chiuso dal primo token della parte fissa successiva
+            stato[0], stato[1], stato[2] = parte + 1, 1, 0
+        else:
+            stato[2] += self.lunghezze[token] if token < len(self.lunghezze) else 1
+            return
+        if stato[1] >= len(self.parti[stato[0]]):
+            stato[0], stato[1] = stato[0] + 1, 0
+
+    def _maschera(self, nome, dispositivo, dimensione):
+        chiave = (nome, dispositivo)
+        if chiave not in self._maschere_dispositivo:
+            maschera = torch.zeros(dimensione, dtype=torch.bool)
+            n = min(dimensione, len(self.maschere[nome]))
+            maschera[:n] = self.maschere[nome][:n]
+            self._maschere_dispositivo[chiave] = maschera.to(dispositivo)
+        return self._maschere_dispositivo[chiave]
+
+    def __call__(self, input_ids, scores):
+        if self._stati is None:
+            self._stati = [[0, 0, 0] for _ in range(input_ids.shape[0])]
+        elif input_ids.shape[1] > self.lunghezza_prompt:
+            for riga, stato in enumerate(self._stati):
+                self._avanza(stato, int(input_ids[riga, -1]))
+
+        ammessi = torch.zeros_like(scores, dtype=torch.bool)
+        for riga, (parte, posizione, caratteri) in enumerate(self._stati):
+            if parte >= len(self.parti):
+                ammessi[riga, self.eos] = True
+            elif isinstance(self.parti[parte], list):
+                ammessi[riga, self.parti[parte][posizione]] = True
+            else:
+                tipo = TIPI[self.parti[parte]]
+                if caratteri < tipo.max_caratteri:
+                    ammessi[riga] = self._maschera(self.parti[parte], scores.device, scores.shape[-1])
+                ammessi[riga, self.parti[parte + 1][0]] = True
+        return scores.masked_fill(~ammessi, float("-inf"))
@@ -1,12 +1,46 @@
 #!/usr/bin/env python3
 """
 Script di test per l'API PDF Parser
+
+Senza opzioni verifica health, home e OCR con una richiesta ciascuno.
+Con --carico genera traffico concorrente su /estrai-dati/, /genera-diffida/,
+/ocr-nanonets/ e /ocr-nanonets/stream/ con un mix di documenti del corpus
+sintetico (benchmarks/corpus.py) e riporta throughput, latenza p50/p95/p99,
+tempo al primo byte ed errori per endpoint. Il carico è a concorrenza fissa
+(--concorrenza, ogni utente invia la richiesta successiva appena riceve la
+risposta) o a frequenza di arrivo (--frequenza, arrivi di Poisson: la latenza
+conta anche l'attesa lato client, così la saturazione non viene nascosta).
+Più valori separati da virgola (es. --concorrenza 1,2,4,8) eseguono un gradino
+per valore, per trovare il punto di saturazione di un worker.
+
+Uso: python test_api.py <base_url> [test_file]
+     python test_api.py <base_url> --carico [--concorrenza 1,2,4,8 | --frequenza 0.5,1,2]
+                        [--durata 30] [--mix estrai-dati=4,genera-diffida=2,ocr-nanonets=3,ocr-stream=1]
+                        [--pagine 1,5] [--cartella corpus/] [--server-finto] [--output carico.json]
+
+Con --server-finto il server viene avviato in locale sulla porta di base_url
+con il backend finto (OCR_BACKEND=finto, LAYOUT_BACKEND=finto) e la cache
+disabilitata; le variabili già impostate nell'ambiente hanno la precedenza
+(es. FAKE_OCR_LATENCY_MS=500).
 """
 
-import requests
+import argparse
 import json
+import math
+import os
+import random
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
 
 def test_health_endpoint(base_url):
     """Test dell'endpoint health"""
@@ -75,16 +109,302 @@ def test_ocr_endpoint(base_url, test_file=None):
         print(f"❌ Errore OCR endpoint: {e}")
         return False
 
+# === Test di carico ===
+
+SCENARI = {
+    "estrai-dati": "/estrai-dati/",
+    "genera-diffida": "/genera-diffida/",
+    "ocr-nanonets": "/ocr-nanonets/",
+    "ocr-stream": "/ocr-nanonets/stream/",
+}
+
+def carica_campioni(cartella=None, pagine=(1, 5)):
+    """Coppie contratto/conteggio in memoria: dal manifest.json di una cartella
+    (python benchmarks/corpus.py <cartella>) o generate al volo, con e senza strato di testo"""
+    if cartella:
+        with open(Path(cartella) / "manifest.json", encoding="utf-8") as f:
+            manifest = json.load(f)
+        return [
+            {"id": voce["id"], **{ruolo: (Path(cartella) / voce[ruolo]).read_bytes() for ruolo in ("contratto", "conteggio")}}
+            for voce in manifest
+        ]
+    sys.path.insert(0, str(Path(__file__).resolve().parent / "benchmarks"))
+    from corpus import genera_corpus
+    return [
+        {"id": coppia["id"], "contratto": coppia["contratto"]["contenuto"], "conteggio": coppia["conteggio"]["contenuto"]}
+        for coppia in genera_corpus(pagine)
+    ]
+
+def percentile(valori, p):
+    """Percentile con interpolazione lineare tra i due valori più vicini"""
+    if not valori:
+        return None
+    ordinati = sorted(valori)
+    k = (len(ordinati) - 1) * p / 100
+    f = math.floor(k)
+    c = min(f + 1, len(ordinati) - 1)
+    return ordinati[f] + (ordinati[c] - ordinati[f]) * (k - f)
+
+def stream_completo(corpo):
+    """L'ultimo evento di uno stream riuscito è {"done": true}; un errore a metà arriva come {"errore": ...}"""
+    righe = [riga.strip() for riga in corpo.decode("utf-8", "replace").splitlines() if riga.strip()]
+    if not righe:
+        return False
+    ultima = righe[-1][len("data:"):].strip() if righe[-1].startswith("data:") else righe[-1]
+    try:
+        return bool(json.loads(ultima).get("done"))
+    except ValueError:
+        return False
+
+def esegui_richiesta(sessione, base_url, scenario, campione, timeout, partenza=None):
+    """Una richiesta in streaming: latenza e tempo al primo byte sono misurati da partenza
+    (l'istante di arrivo previsto nel carico a frequenza, altrimenti l'invio)"""
+    partenza = partenza or time.perf_counter()
+    if scenario in ("estrai-dati", "genera-diffida"):
+        files = {
+            "file_contratto": ("contratto.pdf", campione["contratto"], "application/pdf"),
+            "file_conteggio": ("conteggio.pdf", campione["conteggio"], "application/pdf"),
+        }
+    else:
+        files = {"file": ("documento.pdf", campione["contratto"], "application/pdf")}
+    
+    esito = {"scenario": scenario, "campione": campione["id"], "stato": None, "errore": None,
+             "latenza": None, "ttfb": None, "byte": 0}
+    corpo = bytearray()
+    try:
+        with sessione.post(f"{base_url}{SCENARI[scenario]}", files=files, timeout=timeout, stream=True) as risposta:
+            for blocco in risposta.iter_content(chunk_size=None):
+                if esito["ttfb"] is None and blocco:
+                    esito["ttfb"] = time.perf_counter() - partenza
+                esito["byte"] += len(blocco)
+                if risposta.status_code != 200 or scenario == "ocr-stream":
+                    corpo += blocco
+            esito["stato"] = risposta.status_code
+        if esito["stato"] != 200:
+            esito["errore"] = corpo[:200].decode("utf-8", "replace")
+        elif scenario == "ocr-stream" and not stream_completo(corpo):
+            esito["errore"] = "stream interrotto"
+    except requests.RequestException as e:
+        esito["errore"] = type(e).__name__
+    esito["latenza"] = time.perf_counter() - partenza
+    return esito
+
+def scegli(rng, mix, campioni):
+    return rng.choices(list(mix), weights=list(mix.values()))[0], rng.choice(campioni)
+
+def carico_concorrenza(base_url, mix, campioni, concorrenza, durata, richieste, timeout, seme=0):
+    """concorrenza utenti in ciclo chiuso: ognuno invia la richiesta successiva appena riceve la risposta"""
+    risultati = []
+    inviate = 0
+    lock = threading.Lock()
+    fine = time.perf_counter() + durata
+    
+    def utente(indice):
+        nonlocal inviate
+        rng = random.Random(f"{seme}-{indice}")
+        with requests.Session() as sessione:
+            while time.perf_counter() < fine:
+                with lock:
+                    if richieste and inviate >= richieste:
+                        return
+                    inviate += 1
+                scenario, campione = scegli(rng, mix, campioni)
+                risultati.append(esegui_richiesta(sessione, base_url, scenario, campione, timeout))
+    
+    inizio = time.perf_counter()
+    utenti = [threading.Thread(target=utente, args=(indice,)) for indice in range(concorrenza)]
+    for thread in utenti:
+        thread.start()
+    for thread in utenti:
+        thread.join()
+    return risultati, time.perf_counter() - inizio
+
+def carico_frequenza(base_url, mix, campioni, frequenza, durata, richieste, timeout, max_connessioni, seme=0):
+    """Arrivi di Poisson a frequenza richieste/s, indipendenti dalle risposte (ciclo aperto)"""
+    rng = random.Random(seme)
+    locale = threading.local()
+    
+    def invia(scenario, campione, partenza):
+        if not hasattr(locale, "sessione"):
+            locale.sessione = requests.Session()
+        return esegui_richiesta(locale.sessione, base_url, scenario, campione, timeout, partenza)
+    
+    futuri = []
+    inizio = time.perf_counter()
+    prossimo = inizio
+    with ThreadPoolExecutor(max_workers=max_connessioni) as pool:
+        while prossimo < inizio + durata and (not richieste or len(futuri) < richieste):
+            attesa = prossimo - time.perf_counter()
+            if attesa > 0:
+                time.sleep(attesa)
+            futuri.append(pool.submit(invia, *scegli(rng, mix, campioni), prossimo))
+            prossimo += rng.expovariate(frequenza)
+        risultati = [futuro.result() for futuro in futuri]
+    return risultati, time.perf_counter() - inizio
+
+def riepiloga(risultati, secondi):
+    """Per scenario e in totale: richieste, errori, throughput, latenza e tempo al primo byte in ms"""
+    gruppi = {"totale": risultati}
+    for esito in risultati:
+        gruppi.setdefault(esito["scenario"], []).append(esito)
+    
+    riepilogo = {}
+    for nome, esiti in gruppi.items():
+        riuscite = [esito for esito in esiti if esito["errore"] is None]
+        latenze = [esito["latenza"] * 1000 for esito in riuscite]
+        ttfb = [esito["ttfb"] * 1000 for esito in riuscite if esito["ttfb"] is not None]
+        riepilogo[nome] = {
+            "richieste": len(esiti),
+            "riuscite": len(riuscite),
+            "tasso_errori": round(1 - len(riuscite) / len(esiti), 4) if esiti else 0.0,
+            "stati": dict(Counter(str(esito["stato"] or esito["errore"]) for esito in esiti)),
+            "throughput": round(len(riuscite) / secondi, 3) if secondi else 0.0,
+            "latenza_ms": {f"p{p}": percentile(latenze, p) for p in (50, 95, 99)} | {"max": max(latenze, default=None)},
+            "ttfb_ms": {f"p{p}": percentile(ttfb, p) for p in (50, 95, 99)},
+        }
+    return riepilogo
+
+def formatta_ms(valore):
+    return "-" if valore is None else f"{valore:.0f}"
+
+def stampa_riepilogo(riepilogo):
+    print(f"   {'scenario':<16}{'rich.':>7}{'err%':>7}{'req/s':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'ttfb50':>8}{'ttfb95':>8}")
+    for nome, voce in riepilogo.items():
+        latenza, ttfb = voce["latenza_ms"], voce["ttfb_ms"]
+        print(f"   {nome:<16}{voce['richieste']:>7}{voce['tasso_errori'] * 100:>6.1f}%{voce['throughput']:>8.2f}"
+              f"{formatta_ms(latenza['p50']):>8}{formatta_ms(latenza['p95']):>8}{formatta_ms(latenza['p99']):>8}"
+              f"{formatta_ms(ttfb['p50']):>8}{formatta_ms(ttfb['p95']):>8}")
+    errori = {stato: n for stato, n in riepilogo["totale"]["stati"].items() if stato != "200"}
+    if errori:
+        print(f"   errori: {errori}")
+
+def avvia_server_finto(base_url, timeout=180):
+    """Avvia uvicorn in locale con il backend finto e attende /ready: restituisce il processo e la cartella dei lavori"""
+    url = urlparse(base_url)
+    cartella = tempfile.mkdtemp(prefix="carico_")
+    ambiente = dict(os.environ)
+    for chiave, valore in {
+        "OCR_BACKEND": "finto", "LAYOUT_BACKEND": "finto", "PRELOAD_NANONETS": "true", "CACHE_ENABLED": "false",
+        "LOG_LEVEL": "WARNING", "JOBS_DB": os.path.join(cartella, "lavori.sqlite3"), "JOBS_DIR": os.path.join(cartella, "file"),
+    }.items():
+        ambiente.setdefault(chiave, valore)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "index:app", "--host", url.hostname, "--port", str(url.port or 80),
+         "--log-level", "warning"],
+        cwd=Path(__file__).resolve().parent, env=ambiente
+    )
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite and server.poll() is None:
+        try:
+            if requests.get(f"{base_url}/ready", timeout=2).status_code == 200:
+                return server, cartella
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    shutil.rmtree(cartella, ignore_errors=True)
+    raise RuntimeError("Il server locale non è diventato pronto")
+
+def interpreta_mix(testo):
+    mix = {}
+    for voce in testo.split(","):
+        nome, _, peso = voce.partition("=")
+        if nome.strip() not in SCENARI:
+            raise ValueError(f"Scenario sconosciuto: {nome} (disponibili: {', '.join(SCENARI)})")
+        mix[nome.strip()] = float(peso or 1)
+    return mix
+
+def test_carico(base_url, parametri):
+    """Esegue un gradino per ogni concorrenza (o frequenza) e riporta dove il throughput smette di crescere"""
+    mix = interpreta_mix(parametri.mix)
+    print("📁 Preparazione campioni...")
+    campioni = carica_campioni(parametri.cartella, [int(p) for p in parametri.pagine.split(",")])
+    print(f"   {len(campioni)} coppie contratto/conteggio, mix: {mix}")
+    
+    cache = requests.get(f"{base_url}/health", timeout=10).json().get("cache", {})
+    if cache.get("enabled"):
+        print("⚠️  La cache del server è attiva: i campioni ripetuti misurano la cache, non l'elaborazione")
+    
+    # Riscaldamento: una richiesta per scenario, esclusa dalle misure
+    with requests.Session() as sessione:
+        for scenario in mix:
+            esegui_richiesta(sessione, base_url, scenario, campioni[0], parametri.timeout)
+    
+    if parametri.frequenza:
+        gradini = [("frequenza", float(valore)) for valore in parametri.frequenza.split(",")]
+    else:
+        gradini = [("concorrenza", int(valore)) for valore in parametri.concorrenza.split(",")]
+    
+    risultati = []
+    for modo, valore in gradini:
+        print(f"\n📈 {modo} {valore} per {parametri.durata}s")
+        if modo == "frequenza":
+            esiti, secondi = carico_frequenza(base_url, mix, campioni, valore, parametri.durata, parametri.richieste,
+                                             parametri.timeout, parametri.max_connessioni, parametri.seme)
+        else:
+            esiti, secondi = carico_concorrenza(base_url, mix, campioni, valore, parametri.durata, parametri.richieste,
+                                               parametri.timeout, parametri.seme)
+        riepilogo = riepiloga(esiti, secondi)
+        stampa_riepilogo(riepilogo)
+        risultati.append({modo: valore, "secondi": round(secondi, 3), "riepilogo": riepilogo})
+    
+    # Saturazione: primo gradino dopo cui il throughput cresce meno del 10%
+    throughput = [gradino["riepilogo"]["totale"]["throughput"] for gradino in risultati]
+    saturazione = next(
+        (risultati[i] for i in range(len(risultati) - 1) if throughput[i + 1] < throughput[i] * 1.1),
+        None
+    )
+    print("\n" + "=" * 50)
+    migliore = max(risultati, key=lambda gradino: gradino["riepilogo"]["totale"]["throughput"])
+    print(f"🎯 Throughput massimo: {migliore['riepilogo']['totale']['throughput']:.2f} req/s con {modo} {migliore[modo]}")
+    if saturazione and len(risultati) > 1:
+        print(f"   Il throughput smette di crescere oltre {modo} {saturazione[modo]}")
+    
+    if parametri.output:
+        with open(parametri.output, "w", encoding="utf-8") as f:
+            json.dump({"base_url": base_url, "mix": mix, "campioni": len(campioni), "gradini": risultati}, f, indent=2)
+        print(f"💾 Risultati salvati in {parametri.output}")
+    return all(gradino["riepilogo"]["totale"]["riuscite"] for gradino in risultati)
+
 def main():
     """Funzione principale di test"""
-    if len(sys.argv) < 2:
-        print("Usage: python test_api.py <base_url> [test_file]")
-        print("Example: python test_api.py https://your-space.hf.space test.pdf")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Test funzionali e di carico dell'API PDF Parser")
+    parser.add_argument("base_url", help="es. https://your-space.hf.space o http://127.0.0.1:7860")
+    parser.add_argument("test_file", nargs="?", help="file per il test OCR")
+    parser.add_argument("--carico", action="store_true", help="test di carico invece dei test funzionali")
+    parser.add_argument("--concorrenza", default="1,2,4,8", help="utenti simultanei, un gradino per valore")
+    parser.add_argument("--frequenza", help="richieste al secondo (arrivi di Poisson), un gradino per valore")
+    parser.add_argument("--durata", type=float, default=30, help="secondi per gradino")
+    parser.add_argument("--richieste", type=int, default=0, help="richieste massime per gradino (0 = solo durata)")
+    parser.add_argument("--mix", default="estrai-dati=4,genera-diffida=2,ocr-nanonets=3,ocr-stream=1",
+                        help="scenari con peso relativo")
+    parser.add_argument("--pagine", default="1,5", help="pagine dei documenti generati")
+    parser.add_argument("--cartella", help="corpus salvato con benchmarks/corpus.py invece di generarlo")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--max-connessioni", type=int, default=64, help="richieste aperte al massimo con --frequenza")
+    parser.add_argument("--seme", type=int, default=0)
+    parser.add_argument("--server-finto", action="store_true", help="avvia il server in locale con il backend finto")
+    parser.add_argument("--output", help="file JSON con i risultati del test di carico")
+    parametri = parser.parse_intermixed_args()
     
-    base_url = sys.argv[1].rstrip('/')
-    test_file = sys.argv[2] if len(sys.argv) > 2 else None
+    base_url = parametri.base_url.rstrip('/')
+    test_file = parametri.test_file
     
+    server, cartella = avvia_server_finto(base_url) if parametri.server_finto else (None, None)
+    try:
+        if parametri.carico:
+            print(f"🚀 Test di carico su: {base_url}")
+            print("=" * 50)
+            sys.exit(0 if test_carico(base_url, parametri) else 1)
+        esegui_test(base_url, test_file)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(cartella, ignore_errors=True)
+
+def esegui_test(base_url, test_file):
+    """Test funzionali: una richiesta per endpoint"""
     print(f"🚀 Testando API su: {base_url}")
     print("=" * 50)
     
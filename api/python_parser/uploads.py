@@ -0,0 +1,179 @@
+import os
+from tempfile import NamedTemporaryFile
+from starlette.responses import JSONResponse
+from metrics import metriche
+
+# Firme iniziali dei formati accettati: l'estensione da sola non basta
+FIRME = {
+    ".pdf": (b"%PDF-",),
+    ".png": (b"\x89PNG\r\n\x1a\n",),
+    ".jpg": (b"\xff\xd8\xff",),
+    ".jpeg": (b"\xff\xd8\xff",),
+    ".zip": (b"PK\x03\x04",),
+    ".csv": (b"",),  # testo: nessuna firma, il contenuto viene validato durante la lettura
+}
+
+BLOCCO = 1024 * 1024
+
+
+class UploadRifiutato(Exception):
+    """File caricato rifiutato: troppo grande (413) o di tipo non ammesso (415)"""
+
+    def __init__(self, messaggio: str, status_code: int):
+        super().__init__(messaggio)
+        self.status_code = status_code
+
+
+def estensione(nome: str, estensioni) -> str:
+    """Estensione del file in minuscolo, se ammessa (altrimenti UploadRifiutato)"""
+    suffix = os.path.splitext(nome or "")[-1].lower()
+    if suffix not in estensioni:
+        raise UploadRifiutato(f"Estensione non ammessa per {nome}: usa {', '.join(sorted(estensioni))}", 415)
+    return suffix
+
+
+class CopiaVerificata:
+    """File temporaneo scritto a blocchi con controllo di firma e dimensione.
+
+    La firma viene verificata sul primo blocco e la dimensione a ogni blocco:
+    appena un controllo fallisce il file parziale viene eliminato e si
+    solleva UploadRifiutato. In memoria resta al più un blocco.
+    """
+
+    def __init__(self, nome: str, suffix: str, max_bytes: int):
+        self.nome = nome
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.scritti = 0
+        self._tmp = NamedTemporaryFile(delete=False, suffix=suffix)
+
+    def scrivi(self, blocco: bytes):
+        if self.scritti == 0 and not blocco.startswith(FIRME[self.suffix]):
+            raise UploadRifiutato(f"Il contenuto di {self.nome} non è un file {self.suffix} valido", 415)
+        self.scritti += len(blocco)
+        if self.max_bytes > 0 and self.scritti > self.max_bytes:
+            raise UploadRifiutato(
+                f"{self.nome} supera la dimensione massima di {self.max_bytes // (1024 * 1024)} MB", 413
+            )
+        self._tmp.write(blocco)
+
+    def chiudi(self) -> str:
+        """Chiude il file e ne restituisce il percorso"""
+        if self.scritti == 0:
+            raise UploadRifiutato(f"{self.nome} è vuoto", 415)
+        self._tmp.close()
+        return self._tmp.name
+
+    def scarta(self):
+        self._tmp.close()
+        rimuovi(self._tmp.name)
+
+
+async def salva_upload(file, estensioni, max_bytes: int) -> str:
+    """Copia l'upload a blocchi in un file temporaneo e ne restituisce il percorso.
+
+    L'estensione viene controllata prima di leggere, firma e dimensione
+    durante la copia: il rifiuto arriva al primo blocco non valido.
+    """
+    copia = CopiaVerificata(file.filename, estensione(file.filename, estensioni), max_bytes)
+    try:
+        with metriche.fase("upload"):
+            while True:
+                blocco = await file.read(BLOCCO)
+                if not blocco:
+                    break
+                copia.scrivi(blocco)
+            return copia.chiudi()
+    except BaseException:
+        copia.scarta()
+        raise
+    finally:
+        metriche.incrementa("upload_bytes_total", copia.scritti)
+
+
+def salva_stream(sorgente, nome: str, estensioni, max_bytes: int) -> str:
+    """Come salva_upload, per uno stream sincrono (es. un file dentro un archivio ZIP)"""
+    copia = CopiaVerificata(nome, estensione(nome, estensioni), max_bytes)
+    try:
+        for blocco in iter(lambda: sorgente.read(BLOCCO), b""):
+            copia.scrivi(blocco)
+        return copia.chiudi()
+    except BaseException:
+        copia.scarta()
+        raise
+
+
+def rimuovi(*percorsi):
+    """Elimina i file temporanei, ignorando quelli già rimossi"""
+    for percorso in percorsi:
+        if percorso is None:
+            continue
+        try:
+            os.remove(percorso)
+        except FileNotFoundError:
+            pass
+
+
+class RichiestaTroppoGrande(Exception):
+    pass
+
+
+class LimiteRichiesta:
+    """Middleware ASGI che rifiuta con 413 le richieste oltre max_bytes.
+
+    Con Content-Length la richiesta viene respinta prima di leggere il corpo;
+    senza (transfer chunked) i byte vengono contati durante la ricezione e
+    il parsing del multipart si interrompe appena si supera il limite.
+    limiti_percorso assegna limiti diversi a percorsi specifici (es. upload massivi).
+    """
+
+    def __init__(self, app, max_bytes: int, limiti_percorso: dict = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.limiti_percorso = limiti_percorso or {}
+
+    @staticmethod
+    def _rifiuta(max_bytes):
+        return JSONResponse(
+            {"detail": f"Richiesta oltre la dimensione massima di {max_bytes // (1024 * 1024)} MB"},
+            status_code=413
+        )
+
+    async def __call__(self, scope, receive, send):
+        max_bytes = self.limiti_percorso.get(scope.get("path"), self.max_bytes) if scope["type"] == "http" else 0
+        if max_bytes <= 0:
+            return await self.app(scope, receive, send)
+
+        lunghezza = dict(scope["headers"]).get(b"content-length")
+        if lunghezza is not None and lunghezza.isdigit() and int(lunghezza) > max_bytes:
+            return await self._rifiuta(max_bytes)(scope, receive, send)
+
+        ricevuti = 0
+        superato = False
+        risposta_iniziata = False
+
+        async def ricevi():
+            nonlocal ricevuti, superato
+            messaggio = await receive()
+            if messaggio["type"] == "http.request":
+                ricevuti += len(messaggio.get("body", b""))
+                if ricevuti > max_bytes:
+                    superato = True
+                    raise RichiestaTroppoGrande()
+            return messaggio
+
+        async def invia(messaggio):
+            nonlocal risposta_iniziata
+            # FastAPI trasforma l'interruzione del parsing in un 400: la risposta viene sostituita dal 413
+            if superato and not risposta_iniziata:
+                return
+            if messaggio["type"] == "http.response.start":
+                risposta_iniziata = True
+            await send(messaggio)
+
+        try:
+            await self.app(scope, ricevi, invia)
+        except RichiestaTroppoGrande:
+            pass
+        if superato and not risposta_iniziata:
+            await self._rifiuta(max_bytes)(scope, receive, send)